@@ -1,11 +1,25 @@
 import argparse
+import datetime
+import json
 import logging
 import sys
 import os
+import re
 import time
 import yaml
 
 from remoteOperations import RemoteOperations
+from localOperations import LocalOperations, SourceScan
+from rsyncLogIndex import RsyncLogIndex
+from snapshotDiffCache import SnapshotDiffCache
+from capacityHistory import CapacityHistory
+from scrubPolicy import ScrubPolicy
+from costModel import CostModel
+from transferProfiles import TransferProfiles
+from chunkStore import ChunkStore
+from datasetLayout import DatasetLayout
+from resourceGovernor import ResourceGovernor
+from treeProfile import TreeProfile
 
 # the current and root directories
 currentDirectory = os.path.dirname(os.path.realpath(__file__))
@@ -25,6 +39,15 @@ fileHandler.setLevel(logging.DEBUG)
 fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logging.getLogger("").addHandler(fileHandler)
 
+greenText   = lambda text: "\x1b[32m"       + text + "\x1b[0m"
+redText     = lambda text: "\x1b[38;5;196m" + text + "\x1b[0m"
+#blueText    = lambda text: "\x1b[38;5;39m"  + text + "\x1b[0m"
+#yellowText  = lambda text: "\x1b[38;5;226m" + text + "\x1b[0m"
+#boldRedText = lambda text: "\x1b[31;1m"     + text + "\x1b[0m"
+
+# convert boolean True and False to PASS/FAIL
+_convertBoolToStr = lambda boolValue: "[" + (greenText("PASS") if boolValue else redText("FAIL")) + "]"
+
 
 def parseConfigFile(fileLoc: str):
   """
@@ -55,6 +78,36 @@ def parseConfigFile(fileLoc: str):
   }
 
 
+  # optional yaml config file attributes, and their default values
+  optionalAttributes = {
+    "localStateDir":       os.path.join(os.path.dirname(os.path.abspath(fileLoc)), "remoteBackupState"),
+    "capacityWarningDays": 30,
+    "storageBackend":      "rsync",
+    "deadlineReserveMinutes": 10,
+    "governorOptions":     {}
+  }
+  optionalSubAttributes = {
+    "rsyncOptions":     {"logRetention": "compress", "parallelStreams": 1, "autoProfile": False, "profiles": {},
+                         "largeFileBytes": 0, "largeFileStreams": 4, "largeFileRangeBytes": 64 * 1024 * 1024,
+                         "priorities": {}},
+    "remoteZFSOptions": {"diffSnapshots": False, "scrubMaxAgeDays": 35, "scrubMaxBytesWritten": 0,
+                         "scrubMaxBlockingMinutes": 0, "datasetPerSource": False,
+                         "encryption": "none", "encryptionRoot": "", "keyFile": ""},
+    "governorOptions":  {"niceLevel": 0, "ioniceClass": "none", "cgroupSlice": "", "cpuWeight": 0, "ioWeight": 0,
+                         "remoteNiceLevel": 0, "remoteIoniceClass": "none", "maxLoadPerCPU": 0, "maxIOPressure": 0}
+  }
+  
+  # fill in any optional attributes that weren't given
+  for attributeName, defaultValue in optionalAttributes.items():
+    if configData.get(attributeName, None) is None:
+      configData[attributeName] = defaultValue
+  for attributeName, subAttributes in optionalSubAttributes.items():
+    if isinstance(configData.get(attributeName, None), dict):
+      for attributeSubName, defaultValue in subAttributes.items():
+        if configData[attributeName].get(attributeSubName, None) is None:
+          configData[attributeName][attributeSubName] = defaultValue
+  
+
   # CHECK: config data attributes exist
   for attributeName in attributes.keys():
     if configData.get(attributeName, None) is None:
@@ -74,10 +127,9 @@ def parseConfigFile(fileLoc: str):
   
   
   # CHECK: no extra config file attributes
-  if not len(attributes) == len(configData):
-    for attributeName in attributes:
-      del configData[attributeName]
-    raise ValueError(f"Config file: got unknown config file attributes: {list(configData.keys())}")
+  unknownAttributes = [name for name in configData.keys() if name not in attributes and name not in optionalAttributes]
+  if len(unknownAttributes) > 0:
+    raise ValueError(f"Config file: got unknown config file attributes: {unknownAttributes}")
   
   
   # CHECK: remote and local paths are absolute
@@ -86,64 +138,386 @@ def parseConfigFile(fileLoc: str):
   for dirLoc in configData["localSourceDirs"]:
     if not os.path.isabs(dirLoc):
       raise ValueError(f"localSourceDirs path must be absolute: {dirLoc}")
+  if not os.path.isabs(configData["localStateDir"]):
+    raise ValueError(f"localStateDir path must be absolute: {configData['localStateDir']}")
   
   
   # CHECK: numbers
   #  -SSH port is >= 0
-  #  -ZFS snapshot is >=0
+  #  -rsync parallel streams >= 1
+  #  -large file size >= 0, streams and range size >= 1
+  #  -capacity warning days and deadline reserve minutes >= 0
+  #  -ZFS snapshot and scrub policy numbers are >=0
   if not isinstance(configData["sshOptions"]["sshPort"], int) or configData["sshOptions"]["sshPort"] < 0:
     raise ValueError("Config file: sshOptions.sshPort must be a number >= 0")
-  if configData["remoteZFSOptions"]["enable"]:
+  if not isinstance(configData["rsyncOptions"]["parallelStreams"], int) or configData["rsyncOptions"]["parallelStreams"] < 1:
+    raise ValueError("Config file: rsyncOptions.parallelStreams must be a number >= 1")
+  if not isinstance(configData["rsyncOptions"]["largeFileBytes"], int) or configData["rsyncOptions"]["largeFileBytes"] < 0:
+    raise ValueError("Config file: rsyncOptions.largeFileBytes must be a number >= 0")
+  for rsyncKey in ["largeFileStreams", "largeFileRangeBytes"]:
+    if not isinstance(configData["rsyncOptions"][rsyncKey], int) or configData["rsyncOptions"][rsyncKey] < 1:
+      raise ValueError(f"Config file: rsyncOptions.{rsyncKey} must be a number >= 1")
+  if not isinstance(configData["capacityWarningDays"], int) or configData["capacityWarningDays"] < 0:
+    raise ValueError("Config file: capacityWarningDays must be a number >= 0")
+  if not isinstance(configData["deadlineReserveMinutes"], int) or configData["deadlineReserveMinutes"] < 0:
+    raise ValueError("Config file: deadlineReserveMinutes must be a number >= 0")
+  if configData["remoteZFSOptions"]["enable"] or configData["storageBackend"] == "chunkStore":
     if not isinstance(configData["remoteZFSOptions"]["snapshotLimit"], int) or\
        configData["remoteZFSOptions"]["snapshotLimit"] < 0:
       raise ValueError("Config file: remoteZFSOptions.snapshotLimit must be a number >= 0")
+  if configData["remoteZFSOptions"]["enable"]:
+    for zfsKey in ["scrubMaxAgeDays", "scrubMaxBytesWritten", "scrubMaxBlockingMinutes"]:
+      if not isinstance(configData["remoteZFSOptions"][zfsKey], int) or configData["remoteZFSOptions"][zfsKey] < 0:
+        raise ValueError(f"Config file: remoteZFSOptions.{zfsKey} must be a number >= 0")
+  
+  
+  # CHECK: resource governor
+  #  -nice levels 0-19, cgroup weights 0 (unset) to 10000
+  #  -load and I/O pressure limits >= 0 (0 for no limit)
+  #  -ionice classes, and a slice unit name
+  if not isinstance(configData["governorOptions"], dict):
+    raise ValueError("Config file: governorOptions must be a mapping")
+  for governorKey in ["niceLevel", "remoteNiceLevel"]:
+    if not isinstance(configData["governorOptions"][governorKey], int) or \
+       not 0 <= configData["governorOptions"][governorKey] <= 19:
+      raise ValueError(f"Config file: governorOptions.{governorKey} must be a number from 0 to 19")
+  for governorKey in ["cpuWeight", "ioWeight"]:
+    if not isinstance(configData["governorOptions"][governorKey], int) or \
+       not 0 <= configData["governorOptions"][governorKey] <= 10000:
+      raise ValueError(f"Config file: governorOptions.{governorKey} must be a number from 0 to 10000")
+  for governorKey in ["maxLoadPerCPU", "maxIOPressure"]:
+    if not isinstance(configData["governorOptions"][governorKey], (int, float)) or \
+       configData["governorOptions"][governorKey] < 0:
+      raise ValueError(f"Config file: governorOptions.{governorKey} must be a number >= 0")
+  for governorKey in ["ioniceClass", "remoteIoniceClass"]:
+    if configData["governorOptions"][governorKey] not in ResourceGovernor.IONICE_CLASSES:
+      raise ValueError(f"Config file: governorOptions.{governorKey} must be one of: "
+                       f"{', '.join(ResourceGovernor.IONICE_CLASSES)}")
+  cgroupSlice = configData["governorOptions"]["cgroupSlice"]
+  if not isinstance(cgroupSlice, str) or (cgroupSlice and not re.fullmatch(r"[A-Za-z0-9_.:-]+\.slice", cgroupSlice)):
+    raise ValueError("Config file: governorOptions.cgroupSlice must be a slice unit name, e.g., backup.slice")
   
   
   # CHECK: bools
-  #  -ZFS:   enable, importPool, exportPool, scrubAfterBackup
+  #  -ZFS:   enable, importPool, exportPool, diffSnapshots, datasetPerSource
   #  -LUKS:  enable
-  #  -rsync: logOutput
-  for zfsKey in ["enable", "importPool", "exportPool", "scrubAfterBackup"]:
+  #  -rsync: logOutput, autoProfile
+  for zfsKey in ["enable", "importPool", "exportPool", "diffSnapshots", "datasetPerSource"]:
     if not isinstance(configData["remoteZFSOptions"][zfsKey], bool):
       raise ValueError(f"Config file: remoteZFSOptions.{zfsKey} must be a boolean")
   for luksKey in ["enable"]:
     if not isinstance(configData["remoteLUKSOptions"][luksKey], bool):
       raise ValueError(f"Config file: remoteLUKSOptions.{luksKey} must be a boolean")
-  for rsyncKey in ["logOutput"]:
+  for rsyncKey in ["logOutput", "autoProfile"]:
     if not isinstance(configData["rsyncOptions"][rsyncKey], bool):
       raise ValueError(f"Config file: rsyncOptions.{rsyncKey} must be a boolean")
   
   
+  # CHECK: choices
+  #  -ZFS:   scrubAfterBackup
+  #  -rsync: logRetention
+  #  -storageBackend
+  if configData["remoteZFSOptions"]["scrubAfterBackup"] not in [True, False, "auto"]:
+    raise ValueError("Config file: remoteZFSOptions.scrubAfterBackup must be true, false or auto")
+  if configData["rsyncOptions"]["logRetention"] not in ["compress", "delete", "keep"]:
+    raise ValueError("Config file: rsyncOptions.logRetention must be one of: compress, delete, keep")
+  if configData["storageBackend"] not in ["rsync", "chunkStore"]:
+    raise ValueError("Config file: storageBackend must be one of: rsync, chunkStore")
+  if configData["remoteZFSOptions"]["encryption"] not in ["none", "native"]:
+    raise ValueError("Config file: remoteZFSOptions.encryption must be one of: none, native")
+  
+  
+  # CHECK: rsync arguments
+  #  -the run's own log file is indexed, which needs the log format it asks for;
+  #   with a --log-file of your own, no log is indexed and any format will do
+  rsyncArguments = configData["rsyncOptions"]["arguments"]
+  if "--log-file-format" in rsyncArguments and "--log-file=" not in rsyncArguments:
+    raise ValueError("Config file: rsyncOptions.arguments: --log-file-format can only be given along with --log-file, "
+                     "as the log index needs its own format")
+  
+  
+  # CHECK: ZFS native encryption
+  #  -replaces the LUKS container, rather than encrypting twice
+  #  -the encryption root is the pool or one of its datasets
+  #  -a local key file path is absolute
+  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["encryption"] == "native":
+    if configData["remoteLUKSOptions"]["enable"]:
+      raise ValueError("Config file: remoteZFSOptions.encryption native replaces the LUKS container; "
+                       "disable remoteLUKSOptions")
+    encryptionRoot = configData["remoteZFSOptions"]["encryptionRoot"]
+    if encryptionRoot and encryptionRoot != configData["remoteZFSOptions"]["poolName"] and \
+       not encryptionRoot.startswith(configData["remoteZFSOptions"]["poolName"] + "/"):
+      raise ValueError(f"Config file: remoteZFSOptions.encryptionRoot must be the pool or one of its datasets: "
+                       f"{encryptionRoot}")
+    if configData["remoteZFSOptions"]["keyFile"] and not os.path.isabs(configData["remoteZFSOptions"]["keyFile"]):
+      raise ValueError(f"remoteZFSOptions.keyFile path must be absolute: {configData['remoteZFSOptions']['keyFile']}")
+  
+  
+  # CHECK: each source directory gets its own dataset
+  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["datasetPerSource"]:
+    datasetNames = [DatasetLayout.datasetName(configData["remoteZFSOptions"]["poolName"], dirLoc)
+                    for dirLoc in configData["localSourceDirs"]]
+    if len(set(datasetNames)) != len(datasetNames):
+      raise ValueError(f"Config file: remoteZFSOptions.datasetPerSource: source directories share a dataset name: "
+                       f"{datasetNames}")
+  
+  
+  # CHECK: priorities are numbers, for source directories
+  if not isinstance(configData["rsyncOptions"]["priorities"], dict):
+    raise ValueError("Config file: rsyncOptions.priorities must be a mapping of source directory to priority")
+  for dirLoc, priority in configData["rsyncOptions"]["priorities"].items():
+    if dirLoc not in configData["localSourceDirs"]:
+      raise ValueError(f"Config file: rsyncOptions.priorities: not one of localSourceDirs: {dirLoc}")
+    if not isinstance(priority, int):
+      raise ValueError(f"Config file: rsyncOptions.priorities: priority must be a number: {dirLoc}")
+  
+  
+  # CHECK: transfer profiles are for source directories, and only use known settings
+  if not isinstance(configData["rsyncOptions"]["profiles"], dict):
+    raise ValueError("Config file: rsyncOptions.profiles must be a mapping of source directory to profile")
+  for dirLoc, profile in configData["rsyncOptions"]["profiles"].items():
+    if dirLoc not in configData["localSourceDirs"]:
+      raise ValueError(f"Config file: rsyncOptions.profiles: not one of localSourceDirs: {dirLoc}")
+    unknownKeys = [key for key in (profile or {}).keys() if key not in TransferProfiles.PROFILE_KEYS]
+    if len(unknownKeys) > 0:
+      raise ValueError(f"Config file: rsyncOptions.profiles: unknown settings for {dirLoc}: {unknownKeys}")
+  
+  
   return configData
 
 
-def backup(**kwargs):
+def _indexRsyncLogs(configData: dict, runName: str, rsyncResults: list, snapshotName=None):
+  """
+  # Add the rsync log files of a run to the log index
+  #  -the large files sent outside rsync are added too, so the index holds
+  #   everything the run wrote
+  #
+  :param configData:   (dict) parsed config data
+  :param runName:      (str) name of the run the logs belong to
+  :param rsyncResults: (list) per-directory results from RemoteOperations.performRsync
+  :param snapshotName: (str) snapshot taken after the run, if any
+  :return: (dict) source directory -> number of changes and bytes sent, from its rsync log
+  """
+  indexInfos = {}
+  logIndex = RsyncLogIndex(configData["localStateDir"])
+  try:
+    for rsyncResult in rsyncResults:
+      sentLargeFiles = [largeFile for largeFile in rsyncResult["largeFiles"] if not largeFile["skipped"]]
+      if len(sentLargeFiles) > 0:
+        indexInfo = logIndex.ingestTransfers(runName, "largeFiles",
+                                             [(">f.st......", largeFile["size"], largeFile["sentBytes"], largeFile["path"])
+                                              for largeFile in sentLargeFiles],
+                                             sourceDir=rsyncResult["sourceDir"], snapshotName=snapshotName)
+        logger.info(f"Indexed large files:               {indexInfo['fileCount']} changes, "
+                    f"{LocalOperations.formatBytes(indexInfo['totalBytes'])} sent")
+      
+      if rsyncResult["logFile"] is None or not os.path.exists(rsyncResult["logFile"]):
+        continue
+      indexInfo = indexInfos[rsyncResult["sourceDir"]] = logIndex.ingestLogFile(rsyncResult["logFile"], runName=runName,
+                                         sourceDir=rsyncResult["sourceDir"], snapshotName=snapshotName,
+                                         retention=configData["rsyncOptions"]["logRetention"])
+      logger.info(f"Indexed rsync log:                 {indexInfo['fileCount']} changes, "
+                  f"{LocalOperations.formatBytes(indexInfo['totalBytes'])} sent")
+  finally:
+    logIndex.close()
+  return indexInfos
+
+
+def index(**kwargs):
+  """
+  # Add existing rsync log files to the log index
+  #  -e.g., the logs older versions left in the working directory
+  #
+  :param kwargs:
+  :return:
+  """
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  logDir     = kwargs.get("logDir") or os.getcwd()
   
-  greenText   = lambda text: "\x1b[32m"       + text + "\x1b[0m"
-  redText     = lambda text: "\x1b[38;5;196m" + text + "\x1b[0m"
-  #blueText    = lambda text: "\x1b[38;5;39m"  + text + "\x1b[0m"
-  #yellowText  = lambda text: "\x1b[38;5;226m" + text + "\x1b[0m"
-  #boldRedText = lambda text: "\x1b[31;1m"     + text + "\x1b[0m"
+  logIndex = RsyncLogIndex(configData["localStateDir"])
   
+  # CHECK: not the index's own archive, whose logs are indexed already
+  notArchive = os.path.realpath(logDir) != os.path.realpath(logIndex.logArchive)
+  logger.info(f"Log directory is not the archive:  {_convertBoolToStr(notArchive)}")
+  if not notArchive:
+    logIndex.close()
+    sys.exit(1)
+  
+  try:
+    for logFilename in sorted(os.listdir(logDir)):
+      if RsyncLogIndex.runNameFromLogFilename(logFilename) is None:
+        continue
+      indexInfo = logIndex.ingestLogFile(os.path.join(logDir, logFilename),
+                                         retention=configData["rsyncOptions"]["logRetention"])
+      logger.info(f"Indexed {logFilename}: {indexInfo['fileCount']} changes")
+  finally:
+    logIndex.close()
+
 
-  # convert boolean True and False to PASS/FAIL
-  _convertBoolToStr = lambda boolValue: "[" + (greenText("PASS") if boolValue else redText("FAIL")) + "]"
+def query(**kwargs):
+  """
+  # Search the log index
+  #  --path: which runs touched this path (glob patterns allowed)
+  #  --run:  what changed in this run (run or snapshot name)
+  #  neither: list the indexed runs
+  #
+  :param kwargs:
+  :return:
+  """
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
   
-  # load and parse the config data
-  logger.info("Parsing the configuration file...")
-  configFileLoc = kwargs.get("configFileLoc")
-  configData    = parseConfigFile(configFileLoc)
+  logIndex = RsyncLogIndex(configData["localStateDir"])
+  try:
+    if kwargs.get("path"):
+      for change in logIndex.findRunsForPath(kwargs["path"]):
+        logger.info(f"{change['runName']}  {change['snapshotName'] or '-'}  {change['itemize']}  {change['path']}")
+    elif kwargs.get("run"):
+      for change in logIndex.findChangesForRun(kwargs["run"]):
+        logger.info(f"{change['itemize']}  {change['path']}")
+    else:
+      for run in logIndex.getRuns():
+        logger.info(f"{run['runName']}  {run['snapshotName'] or '-'}  {run['sourceDir']}  "
+                    f"{run['fileCount']} changes, {LocalOperations.formatBytes(run['totalBytes'] or 0)}")
+  finally:
+    logIndex.close()
+
+
+def _cacheSnapshotDiff(configData: dict, remoteOps: RemoteOperations, snapshotList: list, snapshotName: str):
+  """
+  # Store the changes between the previous snapshot and the new one in the local diff cache
+  #
+  :param configData:   (dict) parsed config data
+  :param remoteOps:    (RemoteOperations)
+  :param snapshotList: (list) snapshots of the pool, oldest first
+  :param snapshotName: (str) the new snapshot
+  :return:
+  """
   
-  remoteOps = RemoteOperations(configData)
+  # CHECK: there is a previous snapshot
+  if snapshotName not in snapshotList or snapshotList.index(snapshotName) == 0:
+    logger.info("No previous snapshot to diff against")
+    return
+  previousSnapshot = snapshotList[snapshotList.index(snapshotName) - 1]
   
-  logger.info("Performing initial checks...")
+  diffCache = SnapshotDiffCache(configData["localStateDir"])
+  try:
+    changeCount = diffCache.storeDiff(previousSnapshot, snapshotName,
+                                      remoteOps.zfsStreamDiff(previousSnapshot, snapshotName))
+    logger.info(f"Cached snapshot diff:              {changeCount} changes since {previousSnapshot}")
+  except SystemError as e:
+    logger.error(f"Could not cache snapshot diff: {e}")
+
+
+def inspect(**kwargs):
+  """
+  # What changed between two snapshots, from the local diff cache
+  #  -the pool doesn't need to be imported, or even reachable
+  #  --from:     earlier snapshot
+  #  --snapshot: later snapshot (default: the latest cached one)
+  #  neither:    list the cached diffs
+  #
+  :param kwargs:
+  :return:
+  """
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  poolName   = configData["remoteZFSOptions"]["poolName"]
+  diffCache  = SnapshotDiffCache(configData["localStateDir"])
   
-  # CHECK: ssh private key exists
-  sshKeyExists = os.path.exists(configData["sshOptions"]["privateKeyLoc"])
-  logger.info(f"SSH private key exists:            {_convertBoolToStr(sshKeyExists)}")
-  if not sshKeyExists:
+  cachedDiffs = diffCache.getCachedSnapshots()
+  if kwargs.get("fromSnapshot") is None:
+    for fromSnapshot, toSnapshot in cachedDiffs:
+      logger.info(f"{fromSnapshot} -> {toSnapshot}")
+    return
+  
+  # snapshot names can be given with or without the pool name
+  _fullName = lambda name: name if "@" in name else f"{poolName}@{name}"
+  fromSnapshot = _fullName(kwargs["fromSnapshot"])
+  toSnapshot   = kwargs.get("snapshot") or "latest"
+  if toSnapshot == "latest":
+    if len(cachedDiffs) == 0:
+      logger.error("inspect: no snapshot diffs have been cached")
+      sys.exit(1)
+    toSnapshot = cachedDiffs[-1][1]
+  toSnapshot = _fullName(toSnapshot)
+  
+  try:
+    changes = diffCache.getDiff(fromSnapshot, toSnapshot)
+  except FileNotFoundError as e:
+    logger.error(f"inspect: {e}")
     sys.exit(1)
+  
+  for changeType, path, newPath in changes:
+    logger.info(f"{changeType}  {path}" + ("" if newPath is None else f" -> {newPath}"))
+  logger.info(f"{len(changes)} changes between {fromSnapshot} and {toSnapshot}")
+
+
+def _logCapacityForecast(report: dict):
+  """
+  # Log a capacity forecast from CapacityHistory.forecast
+  #
+  :param report:
+  :return:
+  """
+  formatOptional = lambda value, formatter: "unknown" if value is None else formatter(value)
+  logger.info(f"Capacity samples:                  {report['sampleCount']}")
+  logger.info(f"Space used:                        {LocalOperations.formatBytes(report['usedBytes'])}")
+  logger.info(f"Space available:                   {LocalOperations.formatBytes(report['availableBytes'])}")
+  logger.info(f"Snapshot overhead:                 "
+              f"{formatOptional(report['usedBySnapshotsBytes'], LocalOperations.formatBytes)} "
+              f"({formatOptional(report['snapshotOverhead'], lambda value: f'{100 * value:.1f}%')})")
+  logger.info(f"Growth per day:                    "
+              f"{formatOptional(report['growthBytesPerDay'], LocalOperations.formatBytes)}")
+  logger.info(f"Days until full:                   {formatOptional(report['daysUntilFull'], lambda value: f'{value:.0f}')}")
+  logger.info(f"Snapshot limit that fits:          {formatOptional(report['suggestedSnapshotLimit'], str)}")
 
+
+def _recordCapacitySample(configData: dict, remoteOps: RemoteOperations, spaceInfo: dict):
+  """
+  # Record the remote capacity after a run
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :param spaceInfo:  (dict) from RemoteOperations.getDiskSpaceInfo
+  :return:
+  """
+  zfsSpaceInfo  = None
+  snapshotCount = None
+  if configData["remoteZFSOptions"]["enable"]:
+    zfsSpaceInfo  = remoteOps.zfsGetSpaceInfo()
+    snapshotCount = len(remoteOps.zfsGetSnapshots())
+  CapacityHistory(configData["localStateDir"]).recordSample(spaceInfo, zfsSpaceInfo=zfsSpaceInfo,
+                                                            snapshotCount=snapshotCount, runName=remoteOps.runName)
+
+
+def forecast(**kwargs):
+  """
+  # Report remote capacity growth, from the samples recorded by each backup
+  #
+  :param kwargs:
+  :return:
+  """
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  report = CapacityHistory(configData["localStateDir"]).forecast(warningDays=configData["capacityWarningDays"])
+  if report is None:
+    logger.error("forecast: no capacity samples have been recorded yet")
+    sys.exit(1)
+  _logCapacityForecast(report)
+
+
+def profile(**kwargs):
+  """
+  # Profile the local source directories: file counts, size histograms, the
+  # heaviest and most changed subtrees, and suggested excludes
+  #  -files changed since each directory's last backup count as changed
+  #  -the profile is saved, and compared with the previous one
+  #
+  :param kwargs:
+  :return:
+  """
+  configData  = parseConfigFile(kwargs.get("configFileLoc"))
+  treeProfile = TreeProfile(configData["localStateDir"])
+  profileNames = treeProfile.getProfileNames()
+  
   # CHECK: local directories exist
   for i, dirLoc in enumerate(configData["localSourceDirs"]):
     localDirExists = os.path.exists(dirLoc) and os.path.isdir(dirLoc)
@@ -151,6 +525,344 @@ def backup(**kwargs):
     if not localDirExists:
       sys.exit(1)
   
+  logger.info("Scanning local source directories...")
+  newProfile = TreeProfile.scanTree(configData["localSourceDirs"],
+                                    modifiedSince=CostModel(configData["localStateDir"]).getLastRunTimes())
+  totalFiles = sum(sourceInfo["fileCount"] for sourceInfo in newProfile["sourceDirs"].values())
+  totalDirs  = sum(sourceInfo["dirCount"] for sourceInfo in newProfile["sourceDirs"].values())
+  logger.info(f"Scan time:                         {newProfile['scanTime']:.1f}s "
+              f"({totalFiles + totalDirs:.0f} entries, {(totalFiles + totalDirs) / max(newProfile['scanTime'], 0.001):.0f}/s)")
+  
+  # per source directory
+  _bucketLabel = lambda buckets, index, formatter: \
+    f"{formatter(buckets[index])}+" if index == len(buckets) - 1 else f"{formatter(buckets[index])}-{formatter(buckets[index + 1])}"
+  for dirLoc, sourceInfo in newProfile["sourceDirs"].items():
+    logger.info(f"{dirLoc}:")
+    logger.info(f"  Files:                           {sourceInfo['fileCount']} in {sourceInfo['dirCount']} directories, "
+                f"{LocalOperations.formatBytes(sourceInfo['totalBytes'])}")
+    logger.info(f"  Changed since "
+                f"{datetime.datetime.fromtimestamp(int(sourceInfo['changedSince'])).strftime('%Y-%m-%d %H:%M')}:  "
+                f"{sourceInfo['changedFileCount']} files, {LocalOperations.formatBytes(sourceInfo['changedBytes'])}")
+    logger.info("  File sizes:")
+    for index, (count, numBytes) in enumerate(sourceInfo["sizeHistogram"]):
+      logger.info(f"    {_bucketLabel(LocalOperations.SIZE_BUCKETS, index, LocalOperations.formatBytes):<14}"
+                  f"{count:>12} files {LocalOperations.formatBytes(numBytes):>8}")
+    logger.info("  Files per directory:")
+    for index, count in enumerate(sourceInfo["dirFileHistogram"]):
+      fileBuckets = LocalOperations.DIR_FILE_BUCKETS
+      label = f"{fileBuckets[index]}+" if index == len(fileBuckets) - 1 else \
+              str(fileBuckets[index]) if fileBuckets[index + 1] - 1 == fileBuckets[index] else \
+              f"{fileBuckets[index]}-{fileBuckets[index + 1] - 1}"
+      logger.info(f"    {label:<14}{count:>12} directories")
+  
+  # heaviest and most changed subtrees
+  for title, key, formatter in [("Most bytes", "totalBytes", LocalOperations.formatBytes),
+                                ("Most files", "fileCount", str),
+                                ("Most bytes changed", "changedBytes", LocalOperations.formatBytes),
+                                ("Most files changed", "changedFileCount", str)]:
+    logger.info(f"{title}:")
+    for path, totals in TreeProfile.topSubtrees(newProfile, key):
+      logger.info(f"  {formatter(totals[key]):>10}  {path}")
+  
+  # suggested excludes
+  suggestions = TreeProfile.suggestExcludes(newProfile)
+  logger.info(f"Suggested excludes:                {len(suggestions)}")
+  for suggestion in suggestions:
+    logger.info(f"  --exclude={suggestion['pattern']}  ({suggestion['reason']}: {suggestion['fileCount']} files, "
+                f"{LocalOperations.formatBytes(suggestion['totalBytes'])})")
+  
+  # growth since the previous profile
+  if len(profileNames) > 0:
+    changes = TreeProfile.diffProfiles(treeProfile.loadProfile(profileNames[-1]), newProfile)
+    logger.info(f"Changes since:                     {profileNames[-1]}")
+    for dirLoc, change in changes["sourceDirs"].items():
+      logger.info(f"  {change['fileCount']:+d} files, {'+' if change['totalBytes'] >= 0 else '-'}"
+                  f"{LocalOperations.formatBytes(abs(change['totalBytes']))}  {dirLoc}")
+    for path, change in changes["subtrees"]:
+      logger.info(f"    {change['fileCount']:+d} files, {'+' if change['totalBytes'] >= 0 else '-'}"
+                  f"{LocalOperations.formatBytes(abs(change['totalBytes']))}  {path}")
+  
+  logger.info(f"Profile saved:                     {treeProfile.saveProfile(newProfile)}")
+
+
+def _pendingFinalizeFile(configData: dict) -> str:
+  """
+  # Location of the file marking a run whose tear-down was deferred to 'finalize'
+  #
+  :param configData: (dict) parsed config data
+  :return:
+  """
+  return os.path.join(configData["localStateDir"], "pendingFinalize.json")
+
+
+def _noteLargeFileChanges(configData: dict, scanResults: list):
+  """
+  # Log the files that crossed rsyncOptions.largeFileBytes since the last run
+  #  -a file that crosses it changes from rsync to the multi-stream transfer,
+  #   or back, so its next transfer can take noticeably longer or shorter
+  #  -each run's large files are kept in the local state directory
+  #
+  :param configData:  (dict) parsed config data
+  :param scanResults: (list) from SourceScan.getResults
+  :return:
+  """
+  stateFile = os.path.join(configData["localStateDir"], "largeFiles.json")
+  previous = {}
+  if os.path.exists(stateFile):
+    with open(stateFile, "r") as f:
+      previous = json.load(f)
+  
+  current = {}
+  for scanInfo in scanResults:
+    current[scanInfo["directory"]] = {os.path.relpath(fileLoc, scanInfo["directory"]): size
+                                      for fileLoc, size in scanInfo["largeFiles"]}
+    if scanInfo["directory"] not in previous:
+      continue
+    for path in sorted(set(current[scanInfo["directory"]]) - set(previous[scanInfo["directory"]])):
+      logger.info(f"Now a large file:                  {os.path.join(scanInfo['directory'], path)} "
+                  f"({LocalOperations.formatBytes(current[scanInfo['directory']][path])}, sent in byte ranges)")
+    for path in sorted(set(previous[scanInfo["directory"]]) - set(current[scanInfo["directory"]])):
+      if not os.path.isfile(os.path.join(scanInfo["directory"], path)):
+        continue
+      logger.info(f"No longer a large file:            {os.path.join(scanInfo['directory'], path)} (sent by rsync)")
+  
+  tempFile = stateFile + ".tmp"
+  with open(tempFile, "w") as f:
+    json.dump(current, f)
+  os.replace(tempFile, stateFile)
+
+
+def _needsTearDown(configData: dict, remoteOps: RemoteOperations) -> bool:
+  """
+  # Whether _tearDownRemoteStorage has anything to do
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :return:
+  """
+  return (configData["remoteZFSOptions"]["enable"] and
+          (configData["remoteZFSOptions"]["exportPool"] or remoteOps.zfsKeyLoaded)) or \
+         configData["remoteLUKSOptions"]["enable"]
+
+
+def _getScrubPolicy(configData: dict) -> ScrubPolicy:
+  """
+  # Scrub policy from the config
+  #
+  :param configData: (dict) parsed config data
+  :return:
+  """
+  zfsOptions = configData["remoteZFSOptions"]
+  return ScrubPolicy(configData["localStateDir"], zfsOptions["scrubMaxAgeDays"],
+                     zfsOptions["scrubMaxBytesWritten"], zfsOptions["scrubMaxBlockingMinutes"])
+
+
+def _recordCompletedScrub(configData: dict, scrubPolicy: ScrubPolicy, scrubInfo: dict):
+  """
+  # Record a completed scrub, with the pool usage when it ran
+  #  -from the capacity sample of the run that started it, rather than the
+  #   usage now, which may have grown since
+  #
+  :param configData:  (dict) parsed config data
+  :param scrubPolicy: (ScrubPolicy)
+  :param scrubInfo:   (dict) the "scrub" entry of the pool status, with times in UTC
+  :return:
+  """
+  if scrubInfo.get("completionTime") is None or scrubInfo.get("duration") is None:
+    return
+  scrubStart = scrubInfo["completionTime"] - scrubInfo["duration"]
+  scrubPolicy.recordCompletedScrub(scrubInfo,
+                                   poolUsedBytes=CapacityHistory(configData["localStateDir"]).getUsedBytesAt(scrubStart))
+
+
+def _decideScrub(configData: dict, remoteOps: RemoteOperations) -> dict:
+  """
+  # Apply the scrub policy to the pool
+  #  -scrubAfterBackup true always scrubs, auto scrubs when the policy says so
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :return: (dict) from ScrubPolicy.decide
+  """
+  zfsOptions  = configData["remoteZFSOptions"]
+  scrubPolicy = _getScrubPolicy(configData)
+  
+  scrubInfo     = remoteOps.getZFSScrubInfo()
+  zfsSpaceInfo  = remoteOps.zfsGetSpaceInfo()
+  poolUsedBytes = None if zfsSpaceInfo is None else zfsSpaceInfo["usedBytes"]
+  
+  # learn from the last completed scrub
+  _recordCompletedScrub(configData, scrubPolicy, scrubInfo)
+  
+  # bytes written since a given time, from the log index, which holds every
+  # indexed run's rsync, large file and chunk store sends
+  def _bytesWrittenSince(sinceTime):
+    logIndex = RsyncLogIndex(configData["localStateDir"])
+    try:
+      return logIndex.getBytesTransferredSince(sinceTime)
+    finally:
+      logIndex.close()
+  
+  return scrubPolicy.decide(scrubInfo, _bytesWrittenSince, poolUsedBytes=poolUsedBytes,
+                            alwaysScrub=zfsOptions["scrubAfterBackup"] is True)
+
+
+def finalize(**kwargs):
+  """
+  # Finish a backup whose scrub was left running in the background
+  #  -waits for the scrub, then exports the pool and closes the LUKS container
+  #
+  :param kwargs:
+  :return:
+  """
+  
+  # load and parse the config data
+  logger.info("Parsing the configuration file...")
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  remoteOps  = RemoteOperations(configData)
+  
+  # CHECK: a run is waiting to be finalized
+  if not os.path.exists(_pendingFinalizeFile(configData)):
+    logger.info("No backup waiting to be finalized")
+    return
+  with open(_pendingFinalizeFile(configData), "r") as f:
+    pendingRun = json.load(f)
+  logger.info(f"Finalizing backup run:             {pendingRun['runName']}")
+  
+  # the key was loaded by the run being finalized, so is unloaded here
+  remoteOps.zfsKeyLoaded = pendingRun.get("zfsKeyLoaded", False)
+  
+  # CHECK: can connect to remote machine
+  canConnect = remoteOps.canConnectToRemoteMachine()
+  logger.info(f"Connect to remote machine:         {_convertBoolToStr(canConnect)}")
+  if not canConnect:
+    sys.exit(1)
+  
+  # ZFS: wait for the scrub, and remember how long it took
+  logger.info("Waiting for ZFS pool scrub...")
+  remoteOps.waitForZFSScrub()
+  _recordCompletedScrub(configData, _getScrubPolicy(configData), remoteOps.getZFSScrubInfo())
+  logger.info(f"ZFS pool scrub:                    {_convertBoolToStr(True)}")
+  
+  # close the remote storage
+  _tearDownRemoteStorage(configData, remoteOps)
+  os.remove(_pendingFinalizeFile(configData))
+
+
+def _logScanSizes(scanResults: list):
+  """
+  # Log the size of each source directory, from the local pre-scan
+  #
+  :param scanResults: (list) from SourceScan.getResults
+  :return:
+  """
+  for i, scanInfo in enumerate(scanResults):
+    logger.info(f"Local directory [{str(i+1).zfill(3)}] size:        "
+                f"{scanInfo['fileCount']} files, {LocalOperations.formatBytes(scanInfo['totalBytes'])}")
+
+
+def _logPlan(predictions: list, parallelStreams: int):
+  """
+  # Log the predicted cost of each source directory, in execution order
+  #
+  :param predictions:     (list) from CostModel.predict, in execution order
+  :param parallelStreams: (int) directories copied at once
+  :return:
+  """
+  for prediction in predictions:
+    logger.info(f"  {datetime.timedelta(seconds=int(prediction['seconds']))}  "
+                f"{LocalOperations.formatBytes(prediction['bytes']):>8}  {prediction['files']:>10} files  "
+                f"{prediction['sourceDir']}")
+  logger.info(f"Predicted transfer time:           "
+              f"{datetime.timedelta(seconds=int(CostModel.predictWallTime(predictions, parallelStreams)))}")
+
+
+def _parseDeadline(deadlineStr: str) -> datetime.datetime:
+  """
+  # Parse a --deadline value
+  #  -HH:MM is the next time that time of day comes round, anything else an
+  #   ISO date and time, e.g., 2022-08-10T06:00
+  #
+  :param deadlineStr:
+  :return: (datetime) local time
+  """
+  try:
+    timeOfDay = datetime.datetime.strptime(deadlineStr, "%H:%M")
+  except ValueError:
+    return datetime.datetime.fromisoformat(deadlineStr)
+  
+  now = datetime.datetime.now()
+  deadline = now.replace(hour=timeOfDay.hour, minute=timeOfDay.minute, second=0, microsecond=0)
+  if deadline <= now:
+    deadline += datetime.timedelta(days=1)
+  return deadline
+
+
+def _planForDeadline(configData: dict, predictions: list, stopTime=None) -> list:
+  """
+  # Order the directories by priority and cost, leaving out those that can't
+  # finish by <stopTime>, and log the plan
+  #
+  :param configData:  (dict) parsed config data
+  :param predictions: (list) from CostModel.predict
+  :param stopTime:    (float) unix time transfers must be done by, or None
+  :return: (list) predictions to run, in order
+  """
+  secondsAvailable = None if stopTime is None else stopTime - time.time()
+  predictions, leftOut = CostModel.fitToDeadline(predictions, configData["rsyncOptions"]["parallelStreams"],
+                                                 secondsAvailable, configData["rsyncOptions"]["priorities"])
+  _logPlan(predictions, configData["rsyncOptions"]["parallelStreams"])
+  if secondsAvailable is not None:
+    logger.info(f"Time available for transfers:      {datetime.timedelta(seconds=max(0, int(secondsAvailable)))}")
+  for prediction in leftOut:
+    logger.warning(f"Left out, not enough time:         {prediction['sourceDir']} "
+                   f"({datetime.timedelta(seconds=int(prediction['seconds']))})")
+  return predictions
+
+
+def plan(**kwargs):
+  """
+  # Predict the bytes, files and time each source directory will take to back up
+  #  -from a quick local change scan and the directory's past runs
+  #  -directories are listed in the order a backup would run them
+  #  --deadline: also show which directories would be left out to finish in time
+  #
+  :param kwargs:
+  :return:
+  """
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  costModel  = CostModel(configData["localStateDir"])
+  
+  stopTime = None
+  if kwargs.get("deadline") is not None:
+    try:
+      stopTime = _parseDeadline(kwargs.get("deadline")).timestamp() - 60 * configData["deadlineReserveMinutes"]
+    except ValueError:
+      logger.error(f"plan: invalid --deadline: {kwargs.get('deadline')}")
+      sys.exit(1)
+  
+  logger.info("Scanning local directories...")
+  sourceScan = SourceScan(configData["localSourceDirs"], modifiedSince=costModel.getLastRunTimes())
+  sourceScan.start()
+  
+  predictions = [costModel.predict(scanInfo) for scanInfo in sourceScan.getResults()]
+  logger.info(f"Backup plan ({configData['rsyncOptions']['parallelStreams']} parallel streams):")
+  _planForDeadline(configData, predictions, stopTime)
+
+
+def _bringUpRemoteStorage(configData: dict, remoteOps: RemoteOperations, loadKey=True) -> dict:
+  """
+  # Check the remote machine and bring up its storage
+  #  -open (and mount) the LUKS container, import the ZFS pool and load its
+  #   native encryption key, as configured
+  #  -exits on any failure
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :param loadKey:    (bool) load the ZFS encryption key; raw sends don't need it
+  :return: (dict) remote disk space info
+  """
+  
   # CHECK: can connect to remote machine
   canConnect = remoteOps.canConnectToRemoteMachine()
   logger.info(f"Connect to remote machine:         {_convertBoolToStr(canConnect)}")
@@ -170,10 +882,17 @@ def backup(**kwargs):
     sys.exit(1)
 
   # CHECK: rsync installed on remote machine
-  remoteRsyncInstalled = remoteOps.remoteRsyncInstalled()
-  logger.info(f"Remote rsync installed:            {_convertBoolToStr(remoteRsyncInstalled)}")
-  if not remoteRsyncInstalled:
-    sys.exit(1)
+  #  -or python3, for the chunk store server
+  if configData["storageBackend"] == "chunkStore":
+    remotePythonInstalled = remoteOps.remotePythonInstalled()
+    logger.info(f"Remote python3 installed:          {_convertBoolToStr(remotePythonInstalled)}")
+    if not remotePythonInstalled:
+      sys.exit(1)
+  else:
+    remoteRsyncInstalled = remoteOps.remoteRsyncInstalled()
+    logger.info(f"Remote rsync installed:            {_convertBoolToStr(remoteRsyncInstalled)}")
+    if not remoteRsyncInstalled:
+      sys.exit(1)
   
   
   # CHECK: ZFS
@@ -242,24 +961,498 @@ def backup(**kwargs):
     if not importZpool:
       sys.exit(1)
   
+  # ZFS: load the native encryption key, unless it already is
+  #  -no terminal needed, so unattended runs can unlock the pool
+  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["encryption"] == "native" and loadKey:
+    keyStatus = remoteOps.zfsGetKeyStatus()
+    logger.info(f"Remote ZFS dataset encrypted:      {_convertBoolToStr(keyStatus is not None)}")
+    if keyStatus is None:
+      sys.exit(1)
+    if keyStatus == "unavailable":
+      if configData["remoteZFSOptions"]["keyFile"]:
+        keyFileExists = os.path.isfile(configData["remoteZFSOptions"]["keyFile"])
+        logger.info(f"ZFS key file exists:               {_convertBoolToStr(keyFileExists)}")
+        if not keyFileExists:
+          sys.exit(1)
+      keyLoaded = remoteOps.zfsLoadKey()
+      logger.info(f"Load ZFS encryption key:           {_convertBoolToStr(keyLoaded)}")
+      if not keyLoaded:
+        sys.exit(1)
+  
   # REPORT: amount of remote disk space
   spaceInfo = remoteOps.getDiskSpaceInfo()
   if spaceInfo is None:
     logger.error("Could not get disk space information")
     sys.exit(1)
+  return spaceInfo
+
+
+def _tearDownRemoteStorage(configData: dict, remoteOps: RemoteOperations):
+  """
+  # Export the ZFS pool and unmount/close the LUKS container, as configured
+  #  -exits on any failure
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :return:
+  """
+  
+  # ZFS: export pool
+  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["exportPool"]:
+    exportZpool = remoteOps.exportZFSPool()
+    logger.info(f"Export ZFS pool:                   {_convertBoolToStr(exportZpool)}")
+    if not exportZpool:
+      sys.exit(1)
+  
+  # ZFS: with the pool left imported, unload the encryption key if this run loaded it
+  elif configData["remoteZFSOptions"]["enable"] and remoteOps.zfsKeyLoaded:
+    keyUnloaded = remoteOps.zfsUnloadKey()
+    logger.info(f"Unload ZFS encryption key:         {_convertBoolToStr(keyUnloaded)}")
+    if not keyUnloaded:
+      sys.exit(1)
+
+  # LUKS: close container
+  if configData["remoteLUKSOptions"]["enable"]:
+    
+    # if we mounted the container, unmount it
+    if configData["remoteLUKSOptions"]["mountToRemoteDestinationDir"]:
+      containerUnmounted = remoteOps.unmountLUKSContainer()
+      logger.info(f"Unmount LUKS container:            {_convertBoolToStr(containerUnmounted)}")
+      if not containerUnmounted:
+        sys.exit(1)
+    
+    containerClosed = remoteOps.closeLUKSContainer()
+    logger.info(f"Close LUKS container:              {_convertBoolToStr(containerClosed)}")
+    if not containerClosed:
+      sys.exit(1)
+
+
+def _chunkStoreBackup(configData: dict, remoteOps: RemoteOperations, sourceDirs: list):
+  """
+  # Back up the source directories into the remote chunk store
+  #  -the run's manifest takes the place of a snapshot; manifests over
+  #   remoteZFSOptions.snapshotLimit (0 for no limit) are deleted and their
+  #   unreferenced chunks garbage collected
+  #
+  :param configData: (dict) parsed config data
+  :param remoteOps:  (RemoteOperations)
+  :param sourceDirs: (list) source directories, in order
+  :return: (bool) whether the run's manifest was stored
+  """
+  
+  try:
+    chunkStore = remoteOps.openChunkStore()
+  except SystemError as e:
+    logger.error(f"Could not open the chunk store: {e}")
+    return False
+  
+  try:
+    
+    # the previous manifest lets unchanged files skip being read
+    manifestNames    = chunkStore.listManifests()
+    previousManifest = chunkStore.getManifest(manifestNames[-1]) if len(manifestNames) > 0 else None
+    
+    stats = chunkStore.backupDirectories(sourceDirs, remoteOps.runName, previousManifest,
+                                         throttle=remoteOps.governor.throttle)
+    logger.info(f"Chunk store files:                 {stats['fileCount']} "
+                f"({stats['unchangedFiles']} unchanged since the last run)")
+    logger.info(f"Chunk store data:                  {LocalOperations.formatBytes(stats['chunkedBytes'])} read, "
+                f"{LocalOperations.formatBytes(stats['sentBytes'])} sent in {stats['sentChunks']} new chunks")
+    
+    # what was written, for the log index
+    logIndex = RsyncLogIndex(configData["localStateDir"])
+    try:
+      logIndex.ingestTransfers(remoteOps.runName, "chunkStore",
+                               [(">f.st......", size, None, path) for path, size in stats["changedFiles"]],
+                               totalBytes=stats["sentBytes"])
+    finally:
+      logIndex.close()
+    
+    # remove manifests over limit, then the chunks only they used
+    manifestLimit = configData["remoteZFSOptions"]["snapshotLimit"]
+    logger.info(f"Manifest status:                   {len(manifestNames) + 1}/{manifestLimit or 'unlimited'}")
+    if manifestLimit > 0 and len(chunkStore.applyRetention(manifestLimit)) > 0:
+      gcStats = chunkStore.collectGarbage()
+      logger.info(f"Chunk store garbage collected:     {gcStats['removed']} chunks, "
+                  f"{LocalOperations.formatBytes(gcStats['removedBytes'])}")
+  
+  # server errors, or the SSH channel going away
+  except (SystemError, OSError) as e:
+    logger.error(f"Chunk store backup failed: {e}")
+    return False
+  
+  finally:
+    chunkStore.close()
+    remoteOps.remoteState.invalidate("transfer")
+  
+  return True
+
+
+def restore(**kwargs):
+  """
+  # Restore paths from a ZFS snapshot (or the remote directory itself, without ZFS)
+  # into a local directory
+  #  -with the chunk store backend, paths are rebuilt from a run's manifest instead
+  #  --snapshot: snapshot (or chunk store manifest) name, or "latest"
+  #  --path:     path or glob pattern, relative to the remote destination directory
+  #  --to:       local directory to restore into
+  #
+  :param kwargs:
+  :return:
+  """
+  
+  # load and parse the config data
+  logger.info("Parsing the configuration file...")
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  remoteOps  = RemoteOperations(configData)
+  
+  pathPattern    = kwargs.get("path")
+  destinationDir = kwargs.get("to")
+  streams        = kwargs.get("streams") or 4
+  
+  # CHECK: arguments
+  if pathPattern is None or destinationDir is None:
+    logger.error("restore: --path and --to must be given")
+    sys.exit(1)
+  if (configData["remoteZFSOptions"]["enable"] or configData["storageBackend"] == "chunkStore") and \
+     kwargs.get("snapshot") is None:
+    logger.error("restore: --snapshot must be given")
+    sys.exit(1)
+  
+  logger.info("Performing initial checks...")
+  
+  # CHECK: ssh private key exists
+  sshKeyExists = os.path.exists(configData["sshOptions"]["privateKeyLoc"])
+  logger.info(f"SSH private key exists:            {_convertBoolToStr(sshKeyExists)}")
+  if not sshKeyExists:
+    sys.exit(1)
+  
+  # CHECK: local directory exists, or can be created
+  os.makedirs(destinationDir, exist_ok=True)
+  
+  # CHECK: remote machine, then bring up the remote storage
+  _bringUpRemoteStorage(configData, remoteOps)
+  
+  restoreSuccessful = True
+  try:
+    
+    # chunk store: rebuild the files from the run's manifest
+    if configData["storageBackend"] == "chunkStore":
+      chunkStore = remoteOps.openChunkStore()
+      try:
+        manifestNames = chunkStore.listManifests()
+        manifestName  = kwargs.get("snapshot")
+        if manifestName == "latest":
+          manifestName = manifestNames[-1] if len(manifestNames) > 0 else None
+        
+        manifestExists = manifestName in manifestNames
+        logger.info(f"Manifest exists:                   {_convertBoolToStr(manifestExists)}")
+        if not manifestExists:
+          raise FileNotFoundError(f"Manifest not found: {kwargs.get('snapshot')}")
+        
+        logger.info(f"Restoring from manifest:           {manifestName}")
+        restoredCount = chunkStore.restoreFiles(chunkStore.getManifest(manifestName), pathPattern, destinationDir)
+        logger.info(f"Files restored:                    {restoredCount}")
+        if restoredCount == 0:
+          raise FileNotFoundError(f"No paths match: {pathPattern}")
+      finally:
+        chunkStore.close()
+    
+    # rsync: from the snapshot's copy of the remote directory
+    else:
+      sourceRoot = configData["remoteDestinationDir"]
+      if configData["remoteZFSOptions"]["enable"]:
+        
+        snapshotName = kwargs.get("snapshot")
+        snapshotList = remoteOps.zfsGetSnapshots()
+        if snapshotName == "latest":
+          snapshotName = snapshotList[-1] if len(snapshotList) > 0 else None
+        elif "@" not in snapshotName:
+          snapshotName = f"{configData['remoteZFSOptions']['poolName']}@{snapshotName}"
+        
+        snapshotExists = snapshotName in snapshotList
+        logger.info(f"Snapshot exists:                   {_convertBoolToStr(snapshotExists)}")
+        if not snapshotExists:
+          raise FileNotFoundError(f"Snapshot not found: {kwargs.get('snapshot')}")
+        logger.info(f"Restoring from snapshot:           {snapshotName}")
+        
+        # with a dataset per source directory, the first part of the path names
+        # the dataset, and is kept as a directory within --to
+        datasetName = None
+        if configData["remoteZFSOptions"]["datasetPerSource"]:
+          datasetDir, _, pathPattern = pathPattern.partition(os.path.sep)
+          datasetName = f"{configData['remoteZFSOptions']['poolName']}/{datasetDir}"
+          if datasetName + "@" + snapshotName.split("@")[-1] not in remoteOps.zfsGetSnapshots(datasetName):
+            raise FileNotFoundError(f"Snapshot not found for dataset: {datasetName}")
+          destinationDir = os.path.join(destinationDir, datasetDir)
+          pathPattern    = pathPattern or "."
+        
+        sourceRoot = remoteOps.zfsGetSnapshotDir(snapshotName, datasetName)
+        if sourceRoot is None:
+          raise FileNotFoundError(f"Could not locate snapshot directory for: {snapshotName}")
+      
+      # single path: go straight to it, no listing needed
+      if not any(c in pathPattern for c in "*?["):
+        relativePaths = [pathPattern.rstrip(os.path.sep)]
+      else:
+        relativePaths = remoteOps.listRemoteMatches(sourceRoot, pathPattern)
+      
+      # one directory: split it into its entries, so every stream has work
+      if len(relativePaths) == 1 and streams > 1:
+        relativePaths = remoteOps.listRemoteDirectory(sourceRoot, relativePaths[0]) or relativePaths
+      
+      logger.info(f"Paths to restore:                  {len(relativePaths)}")
+      if len(relativePaths) == 0:
+        raise FileNotFoundError(f"No paths match: {pathPattern}")
+      
+      # perform rsync
+      logger.info("Starting restore...")
+      logger.info("==================================================")
+      restoreSuccessful = remoteOps.performRestore(sourceRoot, relativePaths, destinationDir,
+                                                   streams=min(streams, len(relativePaths)))
+      logger.info("==================================================")
+      logger.info(f"Restore:                           {_convertBoolToStr(restoreSuccessful)}")
+    
+  # always close the remote storage back up
+  except FileNotFoundError as e:
+    logger.error(str(e))
+    restoreSuccessful = False
+  except SystemError as e:
+    logger.error(f"Chunk store restore failed: {e}")
+    restoreSuccessful = False
+  except KeyboardInterrupt:
+    logger.info(f"\n\nOPERATION ABORTED BY USER")
+    restoreSuccessful = False
+  
+  # close the remote storage
+  _tearDownRemoteStorage(configData, remoteOps)
+  if not restoreSuccessful:
+    sys.exit(1)
+
+
+def send(**kwargs):
+  """
+  # Save a raw ZFS send stream of a snapshot to a local file
+  #  -with native encryption the stream stays encrypted, so the key isn't
+  #   loaded, and the file can be kept or received ('zfs receive') anywhere
+  #  --snapshot: snapshot name, or "latest"
+  #  --from:     earlier snapshot, for an incremental stream
+  #  --to:       local file to write
+  #
+  :param kwargs:
+  :return:
+  """
+  
+  # load and parse the config data
+  logger.info("Parsing the configuration file...")
+  configData = parseConfigFile(kwargs.get("configFileLoc"))
+  remoteOps  = RemoteOperations(configData)
+  
+  # CHECK: arguments
+  if not configData["remoteZFSOptions"]["enable"]:
+    logger.error("send: needs remoteZFSOptions.enable")
+    sys.exit(1)
+  if kwargs.get("snapshot") is None or kwargs.get("to") is None:
+    logger.error("send: --snapshot and --to must be given")
+    sys.exit(1)
+  
+  logger.info("Performing initial checks...")
+  
+  # CHECK: ssh private key exists
+  sshKeyExists = os.path.exists(configData["sshOptions"]["privateKeyLoc"])
+  logger.info(f"SSH private key exists:            {_convertBoolToStr(sshKeyExists)}")
+  if not sshKeyExists:
+    sys.exit(1)
+  
+  # CHECK: remote machine, then bring up the remote storage
+  _bringUpRemoteStorage(configData, remoteOps, loadKey=False)
+  
+  sendSuccessful = False
+  try:
+    
+    # snapshot names can be given with or without the pool name
+    _fullName = lambda name: name if "@" in name else f"{configData['remoteZFSOptions']['poolName']}@{name}"
+    snapshotList = remoteOps.zfsGetSnapshots()
+    snapshotName = kwargs.get("snapshot")
+    if snapshotName == "latest":
+      snapshotName = snapshotList[-1] if len(snapshotList) > 0 else None
+    else:
+      snapshotName = _fullName(snapshotName)
+    fromSnapshot = None if kwargs.get("fromSnapshot") is None else _fullName(kwargs.get("fromSnapshot"))
+    
+    snapshotExists = snapshotName in snapshotList and (fromSnapshot is None or fromSnapshot in snapshotList)
+    logger.info(f"Snapshot exists:                   {_convertBoolToStr(snapshotExists)}")
+    if not snapshotExists:
+      raise FileNotFoundError(f"Snapshot not found: {kwargs.get('snapshot')}" +
+                              ("" if fromSnapshot is None else f" or {fromSnapshot}"))
+    
+    logger.info(f"Sending snapshot:                  {snapshotName}" +
+                ("" if fromSnapshot is None else f" (incremental from {fromSnapshot})"))
+    sendSuccessful = remoteOps.zfsSendRaw(snapshotName, kwargs.get("to"), fromSnapshot)
+    logger.info(f"Raw send stream:                   {_convertBoolToStr(sendSuccessful)}")
+    if sendSuccessful:
+      logger.info(f"Stream size:                       {LocalOperations.formatBytes(os.path.getsize(kwargs.get('to')))}")
+  
+  # always close the remote storage back up
+  except FileNotFoundError as e:
+    logger.error(str(e))
+  except KeyboardInterrupt:
+    logger.info(f"\n\nOPERATION ABORTED BY USER")
+  
+  # close the remote storage
+  _tearDownRemoteStorage(configData, remoteOps)
+  if not sendSuccessful:
+    sys.exit(1)
+
+
+def backup(**kwargs):
+  
+  # load and parse the config data
+  logger.info("Parsing the configuration file...")
+  configFileLoc = kwargs.get("configFileLoc")
+  configData    = parseConfigFile(configFileLoc)
+  
+  remoteOps = RemoteOperations(configData)
+  
+  # lower this process's priority first, so everything it starts inherits it
+  remoteOps.governor.applyLocalPriority()
+  
+  # transfers must be done by the deadline, less the time reserved for the
+  # snapshot and closing the remote storage
+  stopTime = None
+  if kwargs.get("deadline") is not None:
+    try:
+      deadline = _parseDeadline(kwargs.get("deadline"))
+    except ValueError:
+      logger.error(f"backup: invalid --deadline: {kwargs.get('deadline')}")
+      sys.exit(1)
+    stopTime = deadline.timestamp() - 60 * configData["deadlineReserveMinutes"]
+    logger.info(f"Deadline:                          {deadline.replace(microsecond=0)} "
+                f"(transfers stop by {datetime.datetime.fromtimestamp(int(stopTime))})")
+  
+  logger.info("Performing initial checks...")
+  
+  # CHECK: ssh private key exists
+  sshKeyExists = os.path.exists(configData["sshOptions"]["privateKeyLoc"])
+  logger.info(f"SSH private key exists:            {_convertBoolToStr(sshKeyExists)}")
+  if not sshKeyExists:
+    sys.exit(1)
+
+  # CHECK: local directories exist
+  for i, dirLoc in enumerate(configData["localSourceDirs"]):
+    localDirExists = os.path.exists(dirLoc) and os.path.isdir(dirLoc)
+    logger.info(f"Local directory [{str(i+1).zfill(3)}] exists:      {_convertBoolToStr(localDirExists)}")
+    if not localDirExists:
+      sys.exit(1)
+  
+  # CHECK: previous run has been finalized
+  runFinalized = not os.path.exists(_pendingFinalizeFile(configData))
+  logger.info(f"Previous run finalized:            {_convertBoolToStr(runFinalized)}")
+  if not runFinalized:
+    logger.error("A previous run left a scrub running; run the 'finalize' operation first")
+    sys.exit(1)
+  
+  # start the local pre-scan; it needs nothing from the remote machine, so
+  # let it run alongside the remote checks, storage bring-up and, where
+  # nothing has to be chosen from it first, the transfer
+  #  -it also lists the files for the multi-stream transfer
+  costModel  = CostModel(configData["localStateDir"])
+  sourceScan = SourceScan(configData["localSourceDirs"], modifiedSince=costModel.getLastRunTimes(),
+                          largeFileListBytes=configData["rsyncOptions"]["largeFileBytes"])
+  sourceScan.start()
+  bringUpStartTime = time.time()
+  
+  # CHECK: remote machine, then bring up the remote storage
+  spaceInfo = _bringUpRemoteStorage(configData, remoteOps)
   logger.info(f"Disk space before:                 {spaceInfo['used']}/{spaceInfo['total']}")
+  bringUpTime = time.time() - bringUpStartTime
+  
+  # CHECK: remote capacity runway, from previous runs
+  capacityReport = CapacityHistory(configData["localStateDir"]).forecast(warningDays=configData["capacityWarningDays"])
+  if capacityReport is not None and capacityReport["daysUntilFull"] is not None:
+    enoughRunway = capacityReport["daysUntilFull"] >= configData["capacityWarningDays"]
+    logger.info(f"Remote capacity runway:            {_convertBoolToStr(enoughRunway)}")
+    if not enoughRunway:
+      logger.warning(f"Remote storage projected to be full in {capacityReport['daysUntilFull']:.0f} days; "
+                     f"snapshot limit that fits: {capacityReport['suggestedSnapshotLimit']}")
+  
+  # wait for the local pre-scan only if something must be chosen from it
+  # before the transfer: what fits the deadline, automatic transfer profiles,
+  # or the properties of each directory's dataset
+  #  -otherwise the transfer starts now, and the large file lists and cost
+  #   model pick up the scan results when they are ready
+  scanFirst = stopTime is not None or configData["rsyncOptions"]["autoProfile"] or \
+              any("auto" in profile.values() for profile in configData["rsyncOptions"]["profiles"].values()) or \
+              (configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["datasetPerSource"])
+  if scanFirst:
+    _logScanSizes(sourceScan.getResults())
+  
+  # choose each directory's transfer profile
+  transferProfiles = TransferProfiles(configData["localStateDir"])
+  transferArguments = {}
+  for i, dirLoc in enumerate(configData["localSourceDirs"]):
+    profile = transferProfiles.chooseProfile(sourceScan.getResult(dirLoc) if scanFirst else None,
+                                             configData["rsyncOptions"]["profiles"].get(dirLoc),
+                                             autoProfile=configData["rsyncOptions"]["autoProfile"])
+    transferArguments[dirLoc] = TransferProfiles.profileToArguments(profile)
+    if transferArguments[dirLoc]:
+      logger.info(f"Local directory [{str(i+1).zfill(3)}] profile:     {transferArguments[dirLoc]}")
+  
+  # predict each directory's cost, and run the highest priority, then longest, first
+  #  -with a deadline, only what can finish in time
+  #  -without the scan, from the directories' past runs alone
+  logger.info("Backup plan:")
+  if scanFirst:
+    predictions = [costModel.predict(scanInfo) for scanInfo in sourceScan.getResults()]
+  else:
+    predictions = [costModel.predictFromHistory(dirLoc) for dirLoc in configData["localSourceDirs"]]
+  predictions = _planForDeadline(configData, predictions, stopTime)
+  
+  # ZFS: one dataset per source directory, with properties to suit its files
+  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["datasetPerSource"]:
+    for i, scanInfo in enumerate(sourceScan.getResults()):
+      datasetName  = DatasetLayout.datasetName(configData["remoteZFSOptions"]["poolName"], scanInfo["directory"])
+      properties   = DatasetLayout.chooseProperties(scanInfo)
+      mountpoint   = remoteOps.getTransferTarget(scanInfo["directory"])[1].rstrip(os.path.sep)
+      datasetReady = remoteOps.zfsEnsureDataset(datasetName, mountpoint, properties)
+      logger.info(f"Local directory [{str(i+1).zfill(3)}] dataset:     {_convertBoolToStr(datasetReady)} {datasetName} "
+                  f"({', '.join(f'{name}={value}' for name, value in properties.items())})")
+      if not datasetReady:
+        sys.exit(1)
   
   
   # catch keyboard interrupt for
   #  -rsync
   #  -zfs operations
+  snapshotName  = None
+  deferFinalize = False
+  indexInfos    = None
   try:
     
-    # perform rsync
-    logger.info("Starting rsync...")
-    logger.info("==================================================")
-    remoteOps.performRsync()
-    logger.info("==================================================")
+    # perform rsync, or store into the chunk store
+    #  -paused and resumed by the governor, under load
+    remoteOps.governor.start()
+    if configData["storageBackend"] == "chunkStore":
+      logger.info("Starting chunk store backup...")
+      logger.info("==================================================")
+      chunkStoreSuccessful = _chunkStoreBackup(configData, remoteOps, [prediction["sourceDir"] for prediction in predictions])
+      logger.info("==================================================")
+      logger.info(f"Chunk store backup:                {_convertBoolToStr(chunkStoreSuccessful)}")
+      if not chunkStoreSuccessful:
+        remoteOps.governor.stop()
+        _tearDownRemoteStorage(configData, remoteOps)
+        sys.exit(1)
+    else:
+      logger.info("Starting rsync...")
+      logger.info("==================================================")
+      remoteOps.performRsync(sourceDirs=[prediction["sourceDir"] for prediction in predictions],
+                             extraArguments=transferArguments, stopTime=stopTime,
+                             largeFiles=lambda dirLoc: sourceScan.getResult(dirLoc)["largeFiles"])
+      for rsyncResult in remoteOps.rsyncResults:
+        if rsyncResult["stopped"]:
+          logger.warning(f"Stopped at the deadline:           {rsyncResult['sourceDir']}")
+      logger.info("==================================================")
+    remoteOps.governor.stop()
     
     
     # snapshot operations
@@ -267,64 +1460,152 @@ def backup(**kwargs):
       
       # snapshot
       logger.info("Creating ZFS snapshot")
-      remoteOps.zfsCreateSnapshot()
+      snapshotName = remoteOps.zfsCreateSnapshot()
       
-      # remove snapshots over limit
       snapshotList = remoteOps.zfsGetSnapshots()
+      
+      # cache what changed since the previous snapshot
+      if configData["remoteZFSOptions"]["diffSnapshots"]:
+        _cacheSnapshotDiff(configData, remoteOps, snapshotList, snapshotName)
+      
+      # remove snapshots over limit
       logger.info(f"Snapshot status:                   {len(snapshotList)}/{configData['remoteZFSOptions']['snapshotLimit']}")
       for snapshotIndex in range(len(snapshotList) - configData["remoteZFSOptions"]["snapshotLimit"]):
         logger.info(f"Destroying old ZFS snapshot:       {snapshotList[snapshotIndex]}")
         remoteOps.zfsDestroySnapshot(snapshotList[snapshotIndex])
+      
+      # each source directory's dataset keeps its own snapshotLimit snapshots
+      if configData["remoteZFSOptions"]["datasetPerSource"]:
+        for dirLoc in configData["localSourceDirs"]:
+          datasetSnapshots = remoteOps.zfsGetSnapshots(
+            DatasetLayout.datasetName(configData["remoteZFSOptions"]["poolName"], dirLoc))
+          for snapshotIndex in range(len(datasetSnapshots) - configData["remoteZFSOptions"]["snapshotLimit"]):
+            logger.info(f"Destroying old ZFS snapshot:       {datasetSnapshots[snapshotIndex]}")
+            remoteOps.zfsDestroySnapshot(datasetSnapshots[snapshotIndex])
+      
+      # keep the diff cache in step with the remaining snapshots
+      if configData["remoteZFSOptions"]["diffSnapshots"]:
+        SnapshotDiffCache(configData["localStateDir"]).pruneDiffs(
+          snapshotList[max(0, len(snapshotList) - configData["remoteZFSOptions"]["snapshotLimit"]):])
 
+    # index what the run wrote
+    #  -before the scrub decision, so this run's writes count towards it
+    indexInfos = _indexRsyncLogs(configData, remoteOps.runName, remoteOps.rsyncResults, snapshotName)
+    
     # REPORT: amount of remote disk space
     spaceInfo = remoteOps.getDiskSpaceInfo()
     if spaceInfo is None:
       logger.error("Could not get disk space information")
       sys.exit(1)
     logger.info(f"Disk space after:                  {spaceInfo['used']}/{spaceInfo['total']}")
+    _recordCapacitySample(configData, remoteOps, spaceInfo)
     
-    # ZFS: scrub pool
-    if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["scrubAfterBackup"]:
-      logger.info("Scrubbing ZFS pool...")
-      scrubSuccessful = remoteOps.scrubZFSPool()
-      logger.info(f"ZFS pool scrub:                    {_convertBoolToStr(scrubSuccessful)}")
-      if not scrubSuccessful:
-        sys.exit(1)
+    # ZFS: scrub pool, if the policy says so
+    #  -long scrubs can run in the background, leaving the tear-down to 'finalize'
+    if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["scrubAfterBackup"] is not False:
+      scrubDecision = _decideScrub(configData, remoteOps)
+      
+      # with a deadline, only scrub if it is known to finish in time
+      #  -a background scrub would keep the pool imported past the deadline
+      if scrubDecision["scrub"] and stopTime is not None and \
+         (scrubDecision["estimatedDuration"] is None or
+          time.time() + scrubDecision["estimatedDuration"].total_seconds() > stopTime):
+        scrubDecision["scrub"]   = False
+        scrubDecision["reason"] += "; skipped, would not finish by the deadline"
+      scrubDecision["blocking"] = scrubDecision["blocking"] or stopTime is not None
+      logger.info(f"Scrub ZFS pool:                    {'yes' if scrubDecision['scrub'] else 'no'} "
+                  f"({scrubDecision['reason']})")
+      if scrubDecision["scrub"]:
+        if scrubDecision["estimatedDuration"] is not None:
+          logger.info(f"Estimated scrub duration:          {scrubDecision['estimatedDuration']}")
+        logger.info("Scrubbing ZFS pool..." if scrubDecision["blocking"] else "Starting ZFS pool scrub in the background...")
+        scrubSuccessful = remoteOps.scrubZFSPool(blocking=scrubDecision["blocking"])
+        logger.info(f"ZFS pool scrub:                    {_convertBoolToStr(scrubSuccessful)}")
+        if not scrubSuccessful:
+          sys.exit(1)
+        deferFinalize = not scrubDecision["blocking"]
   
   
   # user aborted rsync or zfs operations
   except KeyboardInterrupt:
+    remoteOps.governor.stop()
     logger.info(f"\n\nOPERATION ABORTED BY USER")
     logger.info(f"Waiting 10 seconds")
     time.sleep(10)
   
   
-  # ZFS: export pool
-  if configData["remoteZFSOptions"]["enable"] and configData["remoteZFSOptions"]["exportPool"]:
-    exportZpool = remoteOps.exportZFSPool()
-    logger.info(f"Export ZFS pool:                   {_convertBoolToStr(exportZpool)}")
-    if not exportZpool:
-      sys.exit(1)
-
-  # LUKS: close container
-  if configData["remoteLUKSOptions"]["enable"]:
-    
-    # if we mounted the container, unmount it
-    if configData["remoteLUKSOptions"]["mountToRemoteDestinationDir"]:
-      containerUnmounted = remoteOps.unmountLUKSContainer()
-      logger.info(f"Unmount LUKS container:            {_convertBoolToStr(containerUnmounted)}")
-      if not containerUnmounted:
-        sys.exit(1)
-    
-    containerClosed = remoteOps.closeLUKSContainer()
-    logger.info(f"Close LUKS container:              {_convertBoolToStr(containerClosed)}")
-    if not containerClosed:
-      sys.exit(1)
-
-
+  # close the remote storage
+  #  -unless a scrub is still running, in which case 'finalize' does it later
+  #  -with nothing to close, the scrub is just left to finish
+  if deferFinalize and _needsTearDown(configData, remoteOps):
+    with open(_pendingFinalizeFile(configData), "w") as f:
+      json.dump({"runName": remoteOps.runName, "zfsKeyLoaded": remoteOps.zfsKeyLoaded}, f)
+    logger.info("ZFS pool scrub is running in the background; run the 'finalize' operation to export and close")
+  elif deferFinalize:
+    logger.info("ZFS pool scrub is running in the background")
+  else:
+    _tearDownRemoteStorage(configData, remoteOps)
+  
+  
+  # index the rsync logs of an aborted run
+  if indexInfos is None:
+    indexInfos = _indexRsyncLogs(configData, remoteOps.runName, remoteOps.rsyncResults, snapshotName)
+  
+  # the transfer is done; anything still waited on from the scan no longer holds it up
+  scanWaitTime = sourceScan.waitTime
+  scanResults  = sourceScan.getResults()
+  if not scanFirst:
+    _logScanSizes(scanResults)
+  if configData["storageBackend"] != "chunkStore" and configData["rsyncOptions"]["largeFileBytes"] > 0:
+    _noteLargeFileChanges(configData, scanResults)
   
+  # record the actual cost of each directory against its prediction
+  #  -predicted from the scan, whether or not the transfer waited for it
+  scanInfos       = {scanInfo["directory"]: scanInfo for scanInfo in scanResults}
+  predictionInfos = {scanInfo["directory"]: costModel.predict(scanInfo) for scanInfo in scanResults}
+  #  -directories stopped at the deadline would skew the model
+  #  -without the run's own rsync log (a --log-file in rsyncOptions.arguments)
+  #   there is nothing to measure the transfer by
+  for rsyncResult in remoteOps.rsyncResults:
+    if rsyncResult["logFile"] is None and not rsyncResult["stopped"]:
+      logger.info(f"Cost model: not recorded, rsync log file set in rsyncOptions.arguments ({rsyncResult['sourceDir']})")
+    if rsyncResult["sourceDir"] not in indexInfos or rsyncResult["stopped"]:
+      continue
+    run = costModel.recordRun(remoteOps.runName, scanInfos[rsyncResult["sourceDir"]],
+                              predictionInfos[rsyncResult["sourceDir"]], rsyncResult, indexInfos[rsyncResult["sourceDir"]])
+    logger.info(f"Prediction error:                  {run['secondsError']:+.0f}s, "
+                f"{run['bytesError']:+d} bytes ({rsyncResult['sourceDir']})")
   
   
+  # REPORT: run summary
+  #  -the pre-scan is overhead on top of rsync's own walk of the source
+  #   directories; it runs alongside the bring-up and transfer, and only the
+  #   time spent waiting on it holds the transfer up
+  scanTime = sourceScan.getDuration()
+  logger.info("Run summary:")
+  logger.info(f"  Remote bring-up time:            {datetime.timedelta(seconds=int(bringUpTime))}")
+  logger.info(f"  Local pre-scan time:             {datetime.timedelta(seconds=int(scanTime))} "
+              f"({datetime.timedelta(seconds=int(min(scanTime, scanWaitTime)))} of it waited for)")
+  if remoteOps.governor.pauseCount > 0:
+    logger.info(f"  Streams paused under load:       {remoteOps.governor.pauseCount}")
+  
+  # REPORT: large files whose remote copy wasn't brought up to date
+  #  -the remote file keeps its previous version; what was sent waits in a
+  #   partial copy next to it, for the next run to finish
+  unverifiedFiles = [fileLoc for rsyncResult in remoteOps.rsyncResults for fileLoc in rsyncResult["unverifiedFiles"]]
+  if len(unverifiedFiles) > 0:
+    logger.warning(f"  Large files not verified:        {len(unverifiedFiles)} (previous version kept)")
+    for fileLoc in unverifiedFiles:
+      logger.warning(f"    {fileLoc}")
+  
+  # REPORT: remote facts served from the run's cache, rather than fetched over SSH again
+  stateStats = remoteOps.remoteState.getStats()
+  logger.info(f"  Remote state cache:              {stateStats['hits']} hits, {stateStats['fetches']} fetches")
+  for kind, kindStats in stateStats["kinds"].items():
+    if kindStats["hits"] + kindStats["fetches"] > 0:
+      logger.debug(f"    {kind + ':':<31}{kindStats['hits']} hits, {kindStats['fetches']} fetches")
+
+
 
 if __name__ == "__main__":
   #############################################################################
@@ -342,6 +1623,22 @@ if __name__ == "__main__":
   
   # optional arguments
   parser.add_argument("--verbose", action="store_true", help="turn on verbose mode")
+  parser.add_argument("--path", type=str, dest="path", default=None,
+                      help="query/restore: path or glob pattern")
+  parser.add_argument("--run", type=str, dest="run", default=None,
+                      help="query: run or snapshot name to look up")
+  parser.add_argument("--snapshot", type=str, dest="snapshot", default=None,
+                      help="restore/inspect/send: snapshot name, or latest")
+  parser.add_argument("--from", type=str, dest="fromSnapshot", default=None,
+                      help="inspect: earlier snapshot to compare from; send: base of an incremental stream")
+  parser.add_argument("--to", type=str, dest="to", default=None,
+                      help="restore: local directory to restore into; send: local file to write")
+  parser.add_argument("--streams", type=int, dest="streams", default=4,
+                      help="restore: number of parallel rsync streams")
+  parser.add_argument("--log-dir", type=str, dest="logDir", default=None,
+                      help="index: directory holding existing rsync log files")
+  parser.add_argument("--deadline", type=str, dest="deadline", default=None,
+                      help="backup/plan: finish by this time, HH:MM or an ISO date and time")
   parser.set_defaults(verbose=False)
   
   #############################################################################
@@ -367,6 +1664,33 @@ if __name__ == "__main__":
   if args.operation == "backup":
     backup(**vars(args))
   
+  elif args.operation == "restore":
+    restore(**vars(args))
+  
+  elif args.operation == "inspect":
+    inspect(**vars(args))
+  
+  elif args.operation == "forecast":
+    forecast(**vars(args))
+  
+  elif args.operation == "finalize":
+    finalize(**vars(args))
+  
+  elif args.operation == "plan":
+    plan(**vars(args))
+  
+  elif args.operation == "index":
+    index(**vars(args))
+  
+  elif args.operation == "query":
+    query(**vars(args))
+  
+  elif args.operation == "send":
+    send(**vars(args))
+  
+  elif args.operation == "profile":
+    profile(**vars(args))
+  
   else:
     logger.error(f"Unknown operation: {args.operation}")
   
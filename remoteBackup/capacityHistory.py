@@ -0,0 +1,145 @@
+
+import os
+import json
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CapacityHistory:
+  """
+  # Byte-exact remote capacity samples, one per run, and growth forecasts based on them
+  #  -stored as JSON lines in the local state directory
+  """
+
+  # name of the history file within the local state directory
+  HISTORY_FILENAME = "capacityHistory.jsonl"
+
+  # only samples this recent are used for the growth trend
+  FORECAST_WINDOW = datetime.timedelta(days=90)
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory
+    """
+    os.makedirs(stateDir, exist_ok=True)
+    self.historyFile = os.path.join(stateDir, CapacityHistory.HISTORY_FILENAME)
+
+
+  def recordSample(self, diskSpaceInfo: dict, zfsSpaceInfo=None, snapshotCount=None, runName=None):
+    """
+    # Add a capacity sample to the history
+    #
+    :param diskSpaceInfo: (dict) from RemoteOperations.getDiskSpaceInfo
+    :param zfsSpaceInfo:  (dict) from RemoteOperations.zfsGetSpaceInfo, if using ZFS
+    :param snapshotCount: (int) number of snapshots kept, if using ZFS
+    :param runName:       (str) run the sample was taken in
+    :return:
+    """
+
+    sample = {
+      "time":           datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+      "runName":        runName,
+      "totalBytes":     diskSpaceInfo["totalBytes"],
+      "usedBytes":      diskSpaceInfo["usedBytes"],
+      "availableBytes": diskSpaceInfo["availableBytes"]
+    }
+
+    # ZFS accounting is more accurate than df's, which only sees the root dataset
+    if zfsSpaceInfo is not None:
+      sample["usedBytes"]            = zfsSpaceInfo["usedBytes"]
+      sample["availableBytes"]       = zfsSpaceInfo["availableBytes"]
+      sample["usedBySnapshotsBytes"] = zfsSpaceInfo["usedBySnapshotsBytes"]
+      sample["snapshotCount"]        = snapshotCount
+
+    with open(self.historyFile, "a") as f:
+      f.write(json.dumps(sample) + "\n")
+
+
+  def getSamples(self) -> list:
+    """
+    # All recorded samples, oldest first
+    :return:
+    """
+    if not os.path.exists(self.historyFile):
+      return []
+    samples = []
+    with open(self.historyFile, "r") as f:
+      for line in f:
+        try:
+          samples.append(json.loads(line))
+        except ValueError:
+          logger.debug(f"getSamples: skipping invalid line: {line}")
+    return samples
+
+
+  def getUsedBytesAt(self, atTime: datetime.datetime):
+    """
+    # Used bytes as of the given time, from the last sample taken at or before it
+    #
+    :param atTime: (datetime) naive, in UTC
+    :return: (int) or None without an earlier sample
+    """
+    earlier = [sample for sample in self.getSamples() if datetime.datetime.fromisoformat(sample["time"]) <= atTime]
+    return earlier[-1]["usedBytes"] if len(earlier) > 0 else None
+
+
+  def forecast(self, warningDays=0) -> dict:
+    """
+    # Forecast remote capacity from the recorded samples
+    #  -growth is a least-squares fit of used bytes over time
+    #  -the suggested snapshot limit is how many snapshots, at their current average
+    #   size, fit in the space left after reserving <warningDays> of growth
+    #
+    :param warningDays: (int) days of growth to keep in reserve
+    :return: (dict) or None if there aren't enough samples
+    """
+
+    samples = self.getSamples()
+    if len(samples) == 0:
+      return None
+
+    latest     = samples[-1]
+    latestTime = datetime.datetime.fromisoformat(latest["time"])
+    recent     = [sample for sample in samples
+                  if latestTime - datetime.datetime.fromisoformat(sample["time"]) <= CapacityHistory.FORECAST_WINDOW]
+
+    report = {
+      "sampleCount":          len(recent),
+      "usedBytes":            latest["usedBytes"],
+      "availableBytes":       latest["availableBytes"],
+      "usedBySnapshotsBytes": latest.get("usedBySnapshotsBytes", None),
+      "snapshotOverhead":     None,
+      "growthBytesPerDay":    None,
+      "daysUntilFull":        None,
+      "suggestedSnapshotLimit": None
+    }
+
+    # snapshot overhead, as a fraction of used space
+    if report["usedBySnapshotsBytes"] is not None and latest["usedBytes"] > 0:
+      report["snapshotOverhead"] = report["usedBySnapshotsBytes"] / latest["usedBytes"]
+
+    # growth per day
+    if len(recent) >= 2:
+      days   = [(datetime.datetime.fromisoformat(sample["time"]) - latestTime).total_seconds() / 86400 for sample in recent]
+      used   = [sample["usedBytes"] for sample in recent]
+      meanX  = sum(days) / len(days)
+      meanY  = sum(used) / len(used)
+      varX   = sum((x - meanX) ** 2 for x in days)
+      if varX > 0:
+        report["growthBytesPerDay"] = sum((x - meanX) * (y - meanY) for x, y in zip(days, used)) / varX
+
+    # days until full
+    if report["growthBytesPerDay"] is not None and report["growthBytesPerDay"] > 0:
+      report["daysUntilFull"] = latest["availableBytes"] / report["growthBytesPerDay"]
+
+    # snapshot limit that fits in the remaining space
+    if latest.get("snapshotCount") and report["usedBySnapshotsBytes"]:
+      bytesPerSnapshot = report["usedBySnapshotsBytes"] / latest["snapshotCount"]
+      reserveBytes     = max(0, (report["growthBytesPerDay"] or 0) * warningDays)
+      report["suggestedSnapshotLimit"] = max(0, int(
+        (report["usedBySnapshotsBytes"] + latest["availableBytes"] - reserveBytes) / bytesPerSnapshot))
+
+    return report
@@ -0,0 +1,512 @@
+
+import os
+import gzip
+import json
+import stat
+import random
+import fnmatch
+import hashlib
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+from localOperations import LocalOperations
+
+# optional: finds cut points several times faster
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+class ChunkStore:
+  """
+  # Deduplicating backend for remotes without ZFS
+  #  -files are split into content-defined chunks, stored once on the remote
+  #   machine under their sha256
+  #  -each run writes a manifest listing its files and their chunks; manifests
+  #   play the part of snapshots, and unreferenced chunks are garbage collected
+  #  -talks to chunkStoreServer.py, running on the remote machine, over a single
+  #   SSH channel; existence checks are batched to keep round trips down, and
+  #   chunks are sent without waiting, their acknowledgements read before the
+  #   next request
+  """
+
+  # chunk sizes
+  #  -FastCDC style gear hash, with normalized chunking around the average
+  MIN_CHUNK_BYTES = 256 * 1024
+  AVG_CHUNK_BYTES = 1024 * 1024
+  MAX_CHUNK_BYTES = 4 * 1024 * 1024
+
+  # cut point masks: harder to hit before the average size, easier after
+  MASK_BEFORE_AVG = (1 << 22) - 1
+  MASK_AFTER_AVG  = (1 << 18) - 1
+
+  # fixed table of random 64 bit values, one per byte value
+  GEAR_TABLE = (lambda rng: [rng.getrandbits(64) for _ in range(256)])(random.Random(0x6765617268617368))
+
+  # whether a cut point is hit only depends on the fingerprint's bits under
+  # the widest mask, and those only on the same low bits of the table values,
+  # so the hash is kept to them: small ints are much faster in pure Python
+  FINGERPRINT_MASK = MASK_BEFORE_AVG | MASK_AFTER_AVG
+  GEAR_TABLE_LOW   = (lambda table, mask: [value & mask for value in table])(GEAR_TABLE, FINGERPRINT_MASK)
+
+  # bytes hashed per step of the vectorised search
+  CUT_WINDOW_BYTES = 256 * 1024
+
+  # chunks gathered before asking the remote which ones it already has
+  BATCH_CHUNKS = 256
+  BATCH_BYTES  = 64 * 1024 * 1024
+
+  # name of the server script within the store directory
+  SERVER_FILENAME = ".chunkStoreServer.py"
+
+
+  @staticmethod
+  def _findCutPoint(data: bytes, start: int, end: int) -> int:
+    """
+    # Length of the next chunk of data[start:end]
+    #
+    :param data:
+    :param start:
+    :param end:
+    :return:
+    """
+    length = end - start
+    if length <= ChunkStore.MIN_CHUNK_BYTES:
+      return length
+    if numpy is not None:
+      return ChunkStore._findCutPointVectorised(data, start, end)
+
+    gearTable  = ChunkStore.GEAR_TABLE_LOW
+    hashMask   = ChunkStore.FINGERPRINT_MASK
+    normalSize = min(ChunkStore.AVG_CHUNK_BYTES, length)
+    maxSize    = min(ChunkStore.MAX_CHUNK_BYTES, length)
+    view       = memoryview(data)
+    fingerprint = 0
+
+    # bytes before the minimum size are skipped, not hashed
+    for mask, fromSize, toSize in [(ChunkStore.MASK_BEFORE_AVG, ChunkStore.MIN_CHUNK_BYTES, normalSize),
+                                   (ChunkStore.MASK_AFTER_AVG,  normalSize,                 maxSize)]:
+      for i, byte in enumerate(view[start + fromSize:start + toSize], start=fromSize + 1):
+        fingerprint = ((fingerprint << 1) + gearTable[byte]) & hashMask
+        if not fingerprint & mask:
+          return i
+    return maxSize
+
+
+  @staticmethod
+  def _findCutPointVectorised(data: bytes, start: int, end: int) -> int:
+    """
+    # _findCutPoint, with numpy
+    #  -each fingerprint bit under the mask only depends on as many of the
+    #   latest bytes as the mask is wide, so the fingerprint at every position
+    #   is a sum of that many shifted gear values, worked out a window at a time
+    #
+    :param data:
+    :param start:
+    :param end:
+    :return:
+    """
+    length     = end - start
+    normalSize = min(ChunkStore.AVG_CHUNK_BYTES, length)
+    maxSize    = min(ChunkStore.MAX_CHUNK_BYTES, length)
+    hashBits   = ChunkStore.FINGERPRINT_MASK.bit_length()
+    gearTable  = numpy.array(ChunkStore.GEAR_TABLE_LOW, dtype=numpy.uint32)
+
+    for windowFrom in range(ChunkStore.MIN_CHUNK_BYTES, maxSize, ChunkStore.CUT_WINDOW_BYTES):
+      windowTo = min(windowFrom + ChunkStore.CUT_WINDOW_BYTES, maxSize)
+
+      # include the bytes before the window that still count, but as in
+      # _findCutPoint, none from before the minimum size
+      hashFrom = max(ChunkStore.MIN_CHUNK_BYTES, windowFrom - hashBits + 1)
+      gear = gearTable[numpy.frombuffer(data, dtype=numpy.uint8, count=windowTo - hashFrom, offset=start + hashFrom)]
+      fingerprints = gear.copy()
+      for shift in range(1, hashBits):
+        fingerprints[shift:] += gear[:-shift] << shift
+      fingerprints = fingerprints[windowFrom - hashFrom:]
+
+      # harder mask before the average size, easier after
+      split = max(0, min(normalSize - windowFrom, windowTo - windowFrom))
+      hits = numpy.flatnonzero((fingerprints[:split] & ChunkStore.MASK_BEFORE_AVG) == 0)
+      if len(hits) > 0:
+        return windowFrom + int(hits[0]) + 1
+      hits = numpy.flatnonzero((fingerprints[split:] & ChunkStore.MASK_AFTER_AVG) == 0)
+      if len(hits) > 0:
+        return windowFrom + split + int(hits[0]) + 1
+    return maxSize
+
+
+  @staticmethod
+  def chunkFile(fileLoc: str):
+    """
+    # Split a file into content-defined chunks
+    #  -reads the file in blocks, so large files aren't held in memory
+    #  -the unchunked rest of a block is moved to the front of the buffer
+    #   once per read, rather than copied out with every chunk
+    #
+    :param fileLoc:
+    :return: (generator) of chunk data
+    """
+    with open(fileLoc, "rb") as f:
+      data   = bytearray()
+      offset = 0
+      endOfFile = False
+      while True:
+        if not endOfFile and len(data) - offset < ChunkStore.MAX_CHUNK_BYTES:
+          del data[:offset]
+          offset = 0
+          block = f.read(4 * ChunkStore.MAX_CHUNK_BYTES)
+          endOfFile = len(block) == 0
+          data += block
+          continue
+        if offset == len(data):
+          return
+        cutPoint = ChunkStore._findCutPoint(data, offset, len(data))
+        yield bytes(data[offset:offset + cutPoint])
+        offset += cutPoint
+
+
+  @staticmethod
+  def iterateSourceFiles(sourceDir: str):
+    """
+    # Files, symlinks and directories under a source directory, with their manifest paths
+    #  -paths are as rsync would copy them, see LocalOperations.transferPath
+    #  -directories come before their contents
+    #
+    :param sourceDir:
+    :return: (generator) of (local path, manifest path, os.stat_result)
+    """
+    dirsToScan = [sourceDir.rstrip(os.path.sep) or os.path.sep]
+    while len(dirsToScan) > 0:
+      dirLoc = dirsToScan.pop()
+      try:
+        entries = list(os.scandir(dirLoc))
+      except OSError as e:
+        logger.warning(f"iterateSourceFiles: skipping {dirLoc}: {e}")
+        continue
+      for entry in entries:
+        try:
+          if entry.is_dir(follow_symlinks=False):
+            dirsToScan.append(entry.path)
+            yield entry.path, LocalOperations.transferPath(sourceDir, entry.path), entry.stat(follow_symlinks=False)
+          elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+            yield entry.path, LocalOperations.transferPath(sourceDir, entry.path), entry.stat(follow_symlinks=False)
+        except OSError as e:
+          logger.warning(f"iterateSourceFiles: skipping {entry.path}: {e}")
+
+
+  def __init__(self, process):
+    """
+    #
+    :param process: (subprocess.Popen) SSH process running chunkStoreServer.py, with piped stdin/stdout
+    """
+    self.process = process
+    self.stdin   = process.stdin
+    self.stdout  = process.stdout
+
+    # digests known to be on the remote machine this session
+    self.knownDigests = set()
+
+    # PUTs sent whose acknowledgements haven't been read yet
+    self.pendingPuts = 0
+
+
+  def _readResponse(self) -> bytes:
+    self.stdin.flush()
+    header = self.stdout.readline().decode("utf-8")
+    if header.startswith("OK "):
+      return self.stdout.read(int(header.split()[1]))
+    if header.startswith("ERR "):
+      raise SystemError(f"chunk store: {header[4:].strip()}")
+    raise SystemError(f"chunk store: unexpected response: {header!r}")
+
+
+  def _readPutAcknowledgements(self):
+    """
+    # Read the responses to the PUTs sent so far
+    #  -a chunk that failed to store raises SystemError here
+    :return:
+    """
+    while self.pendingPuts > 0:
+      self.pendingPuts -= 1
+      self._readResponse()
+
+
+  def _request(self, header: str, payload=b"") -> bytes:
+    self._readPutAcknowledgements()
+    self.stdin.write(header.encode("utf-8") + b"\n" + payload)
+    return self._readResponse()
+
+
+  def close(self):
+    """
+    # End the session and wait for the remote server to exit
+    :return:
+    """
+    try:
+      self.stdin.write(b"QUIT\n")
+      self.stdin.close()
+    except OSError:
+      pass
+    self.process.wait()
+
+
+  def missingDigests(self, digests: list) -> list:
+    """
+    # Which of the given digests the remote machine doesn't have
+    #  -one round trip for the whole batch
+    #
+    :param digests: (list) raw 32 byte sha256 digests
+    :return:
+    """
+    toAsk = [digest for digest in dict.fromkeys(digests) if digest not in self.knownDigests]
+    if len(toAsk) == 0:
+      return []
+    answers = self._request(f"HAS {len(toAsk)}", b"".join(toAsk))
+    missing = []
+    for digest, answer in zip(toAsk, answers):
+      if answer == ord("1"):
+        self.knownDigests.add(digest)
+      else:
+        missing.append(digest)
+    return missing
+
+
+  def putChunk(self, digest: bytes, data: bytes):
+    """
+    # Send a chunk to the remote machine
+    #  -its acknowledgement is read before the next request; the batches
+    #   keep the number outstanding well within the pipe's buffer
+    #
+    :param digest: (bytes) raw sha256 digest of the data
+    :param data:
+    :return:
+    """
+    self.stdin.write(f"PUT {digest.hex()} {len(data)}\n".encode("utf-8") + data)
+    self.pendingPuts += 1
+    self.knownDigests.add(digest)
+
+
+  def getChunk(self, hexDigest: str) -> bytes:
+    return self._request(f"GET {hexDigest}")
+
+
+  def getChunks(self, hexDigests: list):
+    """
+    # Fetch chunks, a batch of requests at a time
+    #  -a batch of GETs is sent before reading any of the responses, so the
+    #   round trips overlap; the requests are small enough to all fit in the
+    #   pipe while the server is still writing chunks
+    #
+    :param hexDigests: (list) hex sha256 digests
+    :return: (generator) of chunk data, in order
+    """
+    self._readPutAcknowledgements()
+    for batchFrom in range(0, len(hexDigests), ChunkStore.BATCH_CHUNKS):
+      batch = hexDigests[batchFrom:batchFrom + ChunkStore.BATCH_CHUNKS]
+      self.stdin.write("".join(f"GET {hexDigest}\n" for hexDigest in batch).encode("utf-8"))
+      for _ in batch:
+        yield self._readResponse()
+
+
+  def listManifests(self) -> list:
+    """
+    # Names of the stored manifests, oldest first
+    :return:
+    """
+    return json.loads(self._request("LIST").decode("utf-8"))
+
+
+  def getManifest(self, name: str) -> dict:
+    return json.loads(gzip.decompress(self._request(f"GETMANIFEST {name}")).decode("utf-8"))
+
+
+  def putManifest(self, name: str, manifest: dict):
+    data = gzip.compress(json.dumps(manifest).encode("utf-8"))
+    self._request(f"PUTMANIFEST {name} {len(data)}", data)
+
+
+  def deleteManifest(self, name: str):
+    self._request(f"DELETE {name}")
+
+
+  def collectGarbage(self) -> dict:
+    """
+    # Remove chunks no longer referenced by any manifest
+    :return: (dict) kept, removed and removedBytes
+    """
+    self.knownDigests = set()
+    return json.loads(self._request("GC").decode("utf-8"))
+
+
+  def _flushBatch(self, batch: list, stats: dict):
+    """
+    # Send the chunks of a batch that the remote machine doesn't have
+    #
+    :param batch: (list) of (digest, data)
+    :param stats:
+    :return:
+    """
+    missing = set(self.missingDigests([digest for digest, _ in batch]))
+    for digest, data in batch:
+      if digest in missing:
+        self.putChunk(digest, data)
+        missing.discard(digest)
+        stats["sentChunks"] += 1
+        stats["sentBytes"]  += len(data)
+    batch.clear()
+
+
+  def backupDirectories(self, sourceDirs: list, runName: str, previousManifest=None, throttle=None) -> dict:
+    """
+    # Store the source directories and write the run's manifest
+    #  -files with the same size and modification time as in the previous
+    #   manifest re-use its chunk list without being read
+    #
+    :param sourceDirs:       (list) local source directories
+    :param runName:          (str) name of the manifest to write
+    :param previousManifest: (dict) manifest of the previous run, if any
+    :param throttle:         (function) called before each chunk, to wait while told to, or None
+    :return: (dict) statistics of the run, and the changed files as (manifest path, size)
+    """
+
+    previousFiles = {}
+    if previousManifest is not None:
+      previousFiles = {fileInfo["path"]: fileInfo for fileInfo in previousManifest["files"]}
+
+    manifest = {
+      "runName":    runName,
+      "time":       datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+      "sourceDirs": sourceDirs,
+      "files":      [],
+      "directories": []
+    }
+    stats = {"fileCount": 0, "totalBytes": 0, "unchangedFiles": 0, "chunkedBytes": 0, "sentChunks": 0, "sentBytes": 0,
+             "changedFiles": []}
+    batch      = []
+    batchBytes = 0
+
+    for sourceDir in sourceDirs:
+      logger.info(f"chunk store: local directory: {sourceDir}")
+      for fileLoc, manifestPath, fileStat in ChunkStore.iterateSourceFiles(sourceDir):
+        
+        # directories are recorded so empty ones, and their modes, are restored
+        if stat.S_ISDIR(fileStat.st_mode):
+          manifest["directories"].append({
+            "path":  manifestPath,
+            "mtime": fileStat.st_mtime_ns,
+            "mode":  stat.S_IMODE(fileStat.st_mode)
+          })
+          continue
+        
+        fileInfo = {
+          "path":  manifestPath,
+          "size":  fileStat.st_size,
+          "mtime": fileStat.st_mtime_ns,
+          "mode":  stat.S_IMODE(fileStat.st_mode),
+          "chunks": []
+        }
+        stats["fileCount"]  += 1
+        stats["totalBytes"] += fileStat.st_size
+
+        if stat.S_ISLNK(fileStat.st_mode):
+          fileInfo["link"] = os.readlink(fileLoc)
+
+        else:
+          previousInfo = previousFiles.get(manifestPath)
+          if previousInfo is not None and previousInfo["size"] == fileInfo["size"] and \
+             previousInfo["mtime"] == fileInfo["mtime"] and "link" not in previousInfo:
+            fileInfo["chunks"] = previousInfo["chunks"]
+            stats["unchangedFiles"] += 1
+
+          else:
+            try:
+              for data in ChunkStore.chunkFile(fileLoc):
+                if throttle is not None:
+                  throttle()
+                digest = hashlib.sha256(data).digest()
+                fileInfo["chunks"].append(digest.hex())
+                stats["chunkedBytes"] += len(data)
+                batch.append((digest, data))
+                batchBytes += len(data)
+                if len(batch) >= ChunkStore.BATCH_CHUNKS or batchBytes >= ChunkStore.BATCH_BYTES:
+                  self._flushBatch(batch, stats)
+                  batchBytes = 0
+            except OSError as e:
+              logger.warning(f"chunk store: skipping {fileLoc}: {e}")
+              continue
+            stats["changedFiles"].append((manifestPath, fileInfo["size"]))
+
+        manifest["files"].append(fileInfo)
+
+    self._flushBatch(batch, stats)
+
+    # only write the manifest once every chunk it refers to is stored
+    self._request("SYNC")
+    self.putManifest(runName, manifest)
+    return stats
+
+
+  def applyRetention(self, manifestLimit: int) -> list:
+    """
+    # Delete the oldest manifests over the limit, then collect the garbage
+    #
+    :param manifestLimit: (int) number of manifests to keep
+    :return: (list) deleted manifest names
+    """
+    manifestNames = self.listManifests()
+    toDelete = manifestNames[:max(0, len(manifestNames) - manifestLimit)]
+    for manifestName in toDelete:
+      logger.info(f"Deleting old chunk store manifest: {manifestName}")
+      self.deleteManifest(manifestName)
+    return toDelete
+
+
+  def restoreFiles(self, manifest: dict, pathPattern: str, destinationDir: str) -> int:
+    """
+    # Rebuild files from a manifest into a local directory
+    #
+    :param manifest:       (dict) manifest to restore from
+    :param pathPattern:    (str) path or glob pattern; a directory restores everything under it
+    :param destinationDir: (str) local directory to restore into
+    :return: (int) number of files restored
+    """
+    pathPattern = pathPattern.rstrip(os.path.sep)
+    matches = lambda path: fnmatch.fnmatchcase(path, pathPattern) or path.startswith(pathPattern + os.path.sep)
+    
+    # directories first, so empty ones are restored too
+    #  -manifests from before directories were recorded have none
+    directories = [dirInfo for dirInfo in manifest.get("directories", []) if matches(dirInfo["path"])]
+    for dirInfo in directories:
+      os.makedirs(os.path.join(destinationDir, dirInfo["path"]), exist_ok=True)
+    
+    # the chunks of every file to restore, fetched in one pipelined stream
+    fileInfos = [fileInfo for fileInfo in manifest["files"] if matches(fileInfo["path"])]
+    chunks    = self.getChunks([hexDigest for fileInfo in fileInfos for hexDigest in fileInfo["chunks"]])
+    
+    restored = 0
+    for fileInfo in fileInfos:
+      fileLoc = os.path.join(destinationDir, fileInfo["path"])
+      os.makedirs(os.path.dirname(fileLoc), exist_ok=True)
+
+      if "link" in fileInfo:
+        if os.path.lexists(fileLoc):
+          os.remove(fileLoc)
+        os.symlink(fileInfo["link"], fileLoc)
+      else:
+        with open(fileLoc, "wb") as f:
+          for _ in fileInfo["chunks"]:
+            f.write(next(chunks))
+        os.chmod(fileLoc, fileInfo["mode"])
+        os.utime(fileLoc, ns=(fileInfo["mtime"], fileInfo["mtime"]))
+
+      restored += 1
+      logger.debug(f"restoreFiles: {fileInfo['path']}")
+    
+    # directory modes and times last, deepest first, as writing into them changes their times
+    for dirInfo in sorted(directories, key=lambda dirInfo: dirInfo["path"].count(os.path.sep), reverse=True):
+      dirLoc = os.path.join(destinationDir, dirInfo["path"])
+      os.chmod(dirLoc, dirInfo["mode"])
+      os.utime(dirLoc, ns=(dirInfo["mtime"], dirInfo["mtime"]))
+    return restored
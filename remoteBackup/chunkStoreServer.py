@@ -0,0 +1,150 @@
+
+"""
+# Remote side of the chunk store backend
+#  -copied to the remote machine and run there with python3, talking to
+#   ChunkStoreClient over the SSH channel's stdin/stdout
+#  -standard library only, as the remote machine may have nothing else
+#
+# Requests are a header line, optionally followed by a payload:
+#  HAS <count>              + <count> 32 byte digests -> one b"0"/b"1" per digest
+#  PUT <hex digest> <size>  + chunk data              -> empty, once stored
+#  GET <hex digest>                                   -> chunk data
+#  PUTMANIFEST <name> <size> + manifest data          -> empty
+#  GETMANIFEST <name>                                 -> manifest data
+#  LIST                                               -> JSON list of manifest names
+#  DELETE <name>                                      -> empty
+#  GC                                                 -> JSON statistics
+#  SYNC                                               -> empty, once all earlier PUTs are stored
+#  QUIT
+# Responses are "OK <size>\n" followed by <size> bytes, or "ERR <message>\n"
+"""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+
+
+class ChunkStoreServer:
+
+  def __init__(self, storeDir: str):
+    self.chunkDir    = os.path.join(storeDir, "chunks")
+    self.manifestDir = os.path.join(storeDir, "manifests")
+    os.makedirs(self.chunkDir, exist_ok=True)
+    os.makedirs(self.manifestDir, exist_ok=True)
+    self.stdin  = sys.stdin.buffer
+    self.stdout = sys.stdout.buffer
+
+
+  def _chunkLoc(self, hexDigest: str) -> str:
+    # spread chunks over 256 sub-directories
+    return os.path.join(self.chunkDir, hexDigest[:2], hexDigest)
+
+
+  def _manifestLoc(self, name: str) -> str:
+    if os.path.sep in name or name.startswith("."):
+      raise ValueError(f"invalid manifest name: {name}")
+    return os.path.join(self.manifestDir, name + ".json.gz")
+
+
+  def _respond(self, payload=b""):
+    self.stdout.write(f"OK {len(payload)}\n".encode("ascii") + payload)
+    self.stdout.flush()
+
+
+  def _writeFile(self, fileLoc: str, data: bytes):
+    # write then rename, so a partial file is never left under the real name
+    os.makedirs(os.path.dirname(fileLoc), exist_ok=True)
+    tempLoc = fileLoc + ".tmp"
+    with open(tempLoc, "wb") as f:
+      f.write(data)
+    os.replace(tempLoc, fileLoc)
+
+
+  def _collectGarbage(self) -> dict:
+    """
+    # Mark every chunk referenced by a manifest, then sweep the rest
+    """
+    referenced = set()
+    for manifestName in os.listdir(self.manifestDir):
+      if not manifestName.endswith(".json.gz"):
+        continue
+      with gzip.open(os.path.join(self.manifestDir, manifestName), "rt", encoding="utf-8") as f:
+        for fileInfo in json.load(f)["files"]:
+          referenced.update(fileInfo["chunks"])
+
+    stats = {"kept": 0, "removed": 0, "removedBytes": 0}
+    for subDir in os.listdir(self.chunkDir):
+      for chunkName in os.listdir(os.path.join(self.chunkDir, subDir)):
+        if chunkName in referenced:
+          stats["kept"] += 1
+          continue
+        chunkLoc = os.path.join(self.chunkDir, subDir, chunkName)
+        stats["removed"]      += 1
+        stats["removedBytes"] += os.path.getsize(chunkLoc)
+        os.remove(chunkLoc)
+    return stats
+
+
+  def serve(self):
+    while True:
+      header = self.stdin.readline()
+      if not header:
+        return
+      fields = header.decode("utf-8").split()
+      command = fields[0] if fields else ""
+
+      try:
+        if command == "HAS":
+          digests = self.stdin.read(32 * int(fields[1]))
+          self._respond(bytes(b"1"[0] if os.path.exists(self._chunkLoc(digests[i:i+32].hex())) else b"0"[0]
+                              for i in range(0, len(digests), 32)))
+
+        elif command == "PUT":
+          data = self.stdin.read(int(fields[2]))
+          if hashlib.sha256(data).hexdigest() != fields[1]:
+            raise ValueError(f"chunk does not match its digest: {fields[1]}")
+          if not os.path.exists(self._chunkLoc(fields[1])):
+            self._writeFile(self._chunkLoc(fields[1]), data)
+          self._respond()
+
+        elif command == "GET":
+          with open(self._chunkLoc(fields[1]), "rb") as f:
+            self._respond(f.read())
+
+        elif command == "PUTMANIFEST":
+          self._writeFile(self._manifestLoc(fields[1]), self.stdin.read(int(fields[2])))
+          self._respond()
+
+        elif command == "GETMANIFEST":
+          with open(self._manifestLoc(fields[1]), "rb") as f:
+            self._respond(f.read())
+
+        elif command == "LIST":
+          names = sorted(name[:-len(".json.gz")] for name in os.listdir(self.manifestDir) if name.endswith(".json.gz"))
+          self._respond(json.dumps(names).encode("utf-8"))
+
+        elif command == "DELETE":
+          os.remove(self._manifestLoc(fields[1]))
+          self._respond()
+
+        elif command == "GC":
+          self._respond(json.dumps(self._collectGarbage()).encode("utf-8"))
+
+        elif command == "SYNC":
+          self._respond()
+
+        elif command == "QUIT":
+          return
+
+        else:
+          raise ValueError(f"unknown command: {command}")
+
+      except (OSError, ValueError, IndexError) as e:
+        self.stdout.write(f"ERR {str(e).replace(chr(10), ' ')}\n".encode("utf-8"))
+        self.stdout.flush()
+
+
+if __name__ == "__main__":
+  ChunkStoreServer(sys.argv[1]).serve()
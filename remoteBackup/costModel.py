@@ -0,0 +1,239 @@
+
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CostModel:
+  """
+  # Predict the cost of backing up each source directory from its past runs
+  #  -time is modelled as a per-file cost (rsync walking and comparing the tree)
+  #   plus the changed bytes over the directory's transfer throughput
+  #  -each run's prediction and actual cost are recorded, so the model keeps learning
+  """
+
+  # name of the history file within the local state directory
+  HISTORY_FILENAME = "costModel.json"
+
+  # number of past runs per directory used for predictions
+  HISTORY_LENGTH = 20
+
+  # used until a directory has some history
+  DEFAULT_THROUGHPUT       = 10 * 1024 * 1024
+  DEFAULT_SECONDS_PER_FILE = 0.0001
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory
+    """
+    os.makedirs(stateDir, exist_ok=True)
+    self.historyFile = os.path.join(stateDir, CostModel.HISTORY_FILENAME)
+
+    # source directory -> list of runs, oldest first
+    self.history = {}
+    if os.path.exists(self.historyFile):
+      with open(self.historyFile, "r") as f:
+        self.history = json.load(f)
+
+
+  def _save(self):
+    tempFile = self.historyFile + ".tmp"
+    with open(tempFile, "w") as f:
+      json.dump(self.history, f, indent=2)
+    os.replace(tempFile, self.historyFile)
+
+
+  def getLastRunTimes(self) -> dict:
+    """
+    # When each source directory was last transferred
+    #  -used as the cut-off for the local change scan
+    :return: (dict) source directory -> unix timestamp
+    """
+    return {sourceDir: runs[-1]["startTime"] for sourceDir, runs in self.history.items() if len(runs) > 0}
+
+
+  def _fitDirectory(self, sourceDir: str) -> dict:
+    """
+    # Fit the cost parameters of a directory from its history
+    #  -least squares on: seconds = secondsPerFile * files + bytes / throughput
+    #  -falls back to the defaults, or a plain throughput, with too little history
+    #
+    :param sourceDir:
+    :return: (dict) secondsPerFile, throughput and transferRatio
+    """
+
+    runs = self.history.get(sourceDir, [])[-CostModel.HISTORY_LENGTH:]
+    params = {
+      "secondsPerFile": CostModel.DEFAULT_SECONDS_PER_FILE,
+      "throughput":     CostModel.DEFAULT_THROUGHPUT,
+      "transferRatio":  1.0
+    }
+    if len(runs) == 0:
+      return params
+
+    # how much of the changed data rsync actually sends
+    changedBytes = sum(run["scanChangedBytes"] for run in runs)
+    if changedBytes > 0:
+      params["transferRatio"] = sum(run["transferredBytes"] for run in runs) / changedBytes
+
+    # solve the 2x2 normal equations
+    files   = [run["fileCount"] for run in runs]
+    bytes_  = [run["transferredBytes"] for run in runs]
+    seconds = [run["seconds"] for run in runs]
+    sFF = sum(f * f for f in files)
+    sFB = sum(f * b for f, b in zip(files, bytes_))
+    sBB = sum(b * b for b in bytes_)
+    sFT = sum(f * t for f, t in zip(files, seconds))
+    sBT = sum(b * t for b, t in zip(bytes_, seconds))
+    determinant = sFF * sBB - sFB * sFB
+
+    if len(runs) >= 2 and determinant > 0:
+      secondsPerFile  = (sFT * sBB - sBT * sFB) / determinant
+      secondsPerByte  = (sBT * sFF - sFT * sFB) / determinant
+      if secondsPerFile >= 0 and secondsPerByte > 0:
+        params["secondsPerFile"] = secondsPerFile
+        params["throughput"]     = 1 / secondsPerByte
+        return params
+
+    # not enough to separate the two costs; put it all down to throughput
+    if sum(bytes_) > 0 and sum(seconds) > 0:
+      params["secondsPerFile"] = 0.0
+      params["throughput"]     = sum(bytes_) / sum(seconds)
+    return params
+
+
+  def predict(self, scanInfo: dict) -> dict:
+    """
+    # Predict the cost of transferring a source directory
+    #
+    :param scanInfo: (dict) from LocalOperations.scanSourceDirectory, using the last run time as the cut-off
+    :return: (dict) bytes, files and seconds
+    """
+    params = self._fitDirectory(scanInfo["directory"])
+    predictedBytes = int(scanInfo["changedBytes"] * params["transferRatio"])
+    return {
+      "sourceDir": scanInfo["directory"],
+      "bytes":     predictedBytes,
+      "files":     scanInfo["changedFileCount"],
+      "seconds":   params["secondsPerFile"] * scanInfo["fileCount"] + predictedBytes / params["throughput"]
+    }
+
+
+  def predictFromHistory(self, sourceDir: str) -> dict:
+    """
+    # Predict the cost of transferring a source directory from its past runs alone
+    #  -the average of its recent runs; used to order the transfers before the
+    #   local scan is in
+    #
+    :param sourceDir:
+    :return: (dict) bytes, files and seconds; all 0 without any history
+    """
+    runs = self.history.get(sourceDir, [])[-CostModel.HISTORY_LENGTH:]
+    _average = lambda key: sum(run[key] for run in runs) / len(runs) if len(runs) > 0 else 0
+    return {
+      "sourceDir": sourceDir,
+      "bytes":     int(_average("transferredBytes")),
+      "files":     int(_average("transferredFiles")),
+      "seconds":   _average("seconds")
+    }
+
+
+  @staticmethod
+  def orderByCost(predictions: list) -> list:
+    """
+    # Longest predicted directories first
+    #  -with several transfers at once, starting the longest first keeps the
+    #   total time close to that of the single longest transfer
+    #
+    :param predictions: (list) from predict
+    :return:
+    """
+    return sorted(predictions, key=lambda prediction: (prediction["seconds"], prediction["bytes"]), reverse=True)
+
+
+  @staticmethod
+  def predictWallTime(predictions: list, parallelStreams: int) -> float:
+    """
+    # Predicted total time, running the directories longest first over <parallelStreams>
+    #
+    :param predictions: (list) from predict
+    :param parallelStreams:
+    :return: (float) seconds
+    """
+    streamTimes = [0.0] * max(1, parallelStreams)
+    for prediction in CostModel.orderByCost(predictions):
+      streamTimes[streamTimes.index(min(streamTimes))] += prediction["seconds"]
+    return max(streamTimes)
+
+
+  @staticmethod
+  def fitToDeadline(predictions: list, parallelStreams: int, secondsAvailable=None, priorities=None) -> tuple:
+    """
+    # Choose the directories that can finish in the time available
+    #  -directories are taken highest priority first, then longest first, each
+    #   on the stream that frees up first; any that would overrun are left out
+    #   and the rest still get their chance to fit
+    #
+    :param predictions:      (list) from predict
+    :param parallelStreams:  (int) directories copied at once
+    :param secondsAvailable: (float) time available, or None for no limit
+    :param priorities:       (dict) source directory -> priority, higher first; 0 if not given
+    :return: (tuple) predictions to run, in order, and those left out
+    """
+    priorities = priorities or {}
+    ordered = sorted(CostModel.orderByCost(predictions),
+                     key=lambda prediction: priorities.get(prediction["sourceDir"], 0), reverse=True)
+
+    toRun   = []
+    leftOut = []
+    streamTimes = [0.0] * max(1, parallelStreams)
+    for prediction in ordered:
+      streamIndex = streamTimes.index(min(streamTimes))
+      if secondsAvailable is not None and streamTimes[streamIndex] + prediction["seconds"] > secondsAvailable:
+        leftOut.append(prediction)
+        continue
+      streamTimes[streamIndex] += prediction["seconds"]
+      toRun.append(prediction)
+    return toRun, leftOut
+
+
+  def recordRun(self, runName: str, scanInfo: dict, prediction: dict, rsyncResult: dict, indexInfo: dict) -> dict:
+    """
+    # Record the actual cost of a directory's transfer, next to its prediction
+    #
+    :param runName:     (str) run the transfer was part of
+    :param scanInfo:    (dict) from LocalOperations.scanSourceDirectory
+    :param prediction:  (dict) from predict
+    :param rsyncResult: (dict) from RemoteOperations.performRsync
+    :param indexInfo:   (dict) from RsyncLogIndex.ingestLogFile
+    :return: (dict) the recorded run, including the prediction errors
+    """
+
+    # the large files went over their own streams, within the same time,
+    # but aren't in the rsync log
+    sentLargeFiles   = [largeFile for largeFile in rsyncResult.get("largeFiles", []) if not largeFile["skipped"]]
+    transferredBytes = indexInfo["totalBytes"] + sum(largeFile["sentBytes"] for largeFile in sentLargeFiles)
+
+    seconds = rsyncResult["endTime"] - rsyncResult["startTime"]
+    run = {
+      "runName":          runName,
+      "startTime":        rsyncResult["startTime"],
+      "seconds":          seconds,
+      "fileCount":        scanInfo["fileCount"],
+      "scanChangedBytes": scanInfo["changedBytes"],
+      "transferredBytes": transferredBytes,
+      "transferredFiles": indexInfo["fileCount"] + len(sentLargeFiles),
+      "predictedSeconds": prediction["seconds"],
+      "predictedBytes":   prediction["bytes"],
+      "secondsError":     prediction["seconds"] - seconds,
+      "bytesError":       prediction["bytes"] - transferredBytes
+    }
+
+    runs = self.history.setdefault(rsyncResult["sourceDir"], [])
+    runs.append(run)
+    del runs[:-CostModel.HISTORY_LENGTH]
+    self._save()
+    return run
@@ -0,0 +1,107 @@
+
+import os
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+from transferProfiles import TransferProfiles
+
+
+class DatasetLayout:
+  """
+  # One ZFS child dataset per source directory
+  #  -each dataset gets properties suited to its files, chosen from a sample
+  #   of their sizes and how well they compress
+  #  -datasets can then be snapshotted together (zfs snapshot -r) but pruned
+  #   and rolled back on their own
+  """
+
+  # suffixes of files rewritten in place in small blocks, e.g., VM images and databases
+  RANDOM_WRITE_SUFFIXES = ["img", "raw", "qcow2", "vmdk", "vdi", "vhd", "vhdx",
+                           "db", "sqlite", "sqlite3", "mdf", "ldf", "ibd", "frm"]
+
+  # share of the bytes in random-write files for a small recordsize
+  RANDOM_WRITE_SHARE = 0.5
+
+  # byte-weighted median file size for a large recordsize
+  LARGE_RECORD_MEDIAN_BYTES = 4 * 1024 * 1024
+
+  # compressed/original size ratio -> zstd level
+  #  -ratios at or above a threshold get its level, checked in order
+  ZSTD_LEVELS = [(0.9, "zstd-1"), (0.5, "zstd"), (0.0, "zstd-6")]
+
+
+  @staticmethod
+  def datasetName(poolName: str, sourceDir: str) -> str:
+    """
+    # Name of the child dataset for a source directory
+    #  -the directory's name, with characters ZFS doesn't allow replaced
+    #
+    :param poolName:
+    :param sourceDir:
+    :return:
+    """
+    baseName = os.path.basename(sourceDir.rstrip(os.path.sep)) or "root"
+    return f"{poolName}/{re.sub(r'[^A-Za-z0-9_.:-]', '_', baseName)}"
+
+
+  @staticmethod
+  def _weightedMedianSize(sampleFiles: list):
+    """
+    # File size below which half of the sampled bytes lie
+    #
+    :param sampleFiles: (list) file paths
+    :return: (int) or None if nothing could be read
+    """
+    sizes = []
+    for fileLoc in sampleFiles:
+      try:
+        sizes.append(os.stat(fileLoc).st_size)
+      except OSError:
+        continue
+    totalBytes = sum(sizes)
+    if totalBytes == 0:
+      return None
+    runningBytes = 0
+    for size in sorted(sizes):
+      runningBytes += size
+      if runningBytes * 2 >= totalBytes:
+        return size
+
+
+  @staticmethod
+  def chooseProperties(scanInfo: dict) -> dict:
+    """
+    # ZFS properties for a source directory's dataset
+    #  -recordsize: small for files rewritten in place, large for big sequential
+    #   files, the default otherwise
+    #  -compression: a zstd level by how well the sampled files compress
+    #  -atime off, as backups are never read in the normal run of things
+    #
+    :param scanInfo: (dict) from LocalOperations.scanSourceDirectory
+    :return: (dict) property -> value
+    """
+
+    properties = {"recordsize": "128K", "atime": "off"}
+
+    # where the bytes are
+    totalBytes = sum(scanInfo["suffixBytes"].values())
+    randomWriteBytes = sum(scanInfo["suffixBytes"].get(suffix, 0) for suffix in DatasetLayout.RANDOM_WRITE_SUFFIXES)
+    medianSize = DatasetLayout._weightedMedianSize(scanInfo["sampleFiles"])
+    if totalBytes > 0 and randomWriteBytes / totalBytes > DatasetLayout.RANDOM_WRITE_SHARE:
+      properties["recordsize"] = "64K"
+    elif medianSize is not None and medianSize >= DatasetLayout.LARGE_RECORD_MEDIAN_BYTES:
+      properties["recordsize"] = "1M"
+
+    # how well it compresses
+    #  -even incompressible data gets the cheapest level, which still catches runs of zeros
+    suffixRatios = TransferProfiles.sampleCompressibility(scanInfo["sampleFiles"])
+    ratio = 1.0
+    if totalBytes > 0:
+      ratio = sum(numBytes / totalBytes * suffixRatios.get(suffix, 1.0)
+                  for suffix, numBytes in scanInfo["suffixBytes"].items())
+    properties["compression"] = next(level for threshold, level in DatasetLayout.ZSTD_LEVELS if ratio >= threshold)
+
+    logger.debug(f"chooseProperties: {scanInfo['directory']}: median size {medianSize}, "
+                 f"compressed ratio {ratio:.2f}, properties {properties}")
+    return properties
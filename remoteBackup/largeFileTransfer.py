@@ -0,0 +1,309 @@
+
+import os
+import grp
+import pwd
+import stat
+import time
+import shlex
+import hashlib
+import subprocess
+import concurrent.futures
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LargeFileTransfer:
+  """
+  # Copy a very large file over several SSH channels at once
+  #  -a single rsync/SSH stream is limited to one core's worth of cipher
+  #   throughput; separate SSH connections each get their own
+  #  -the file is split into fixed byte ranges, hashed on both machines, and
+  #   only the ranges that differ are sent, into a partial copy beside the
+  #   remote file
+  #  -the partial copy is checked with a whole-file sha256, given the file's
+  #   attributes, and only then renamed over the remote file, so a snapshot
+  #   never holds a half-written file under its real name
+  #  -a partial copy left by a stopped or failed run is picked up by the next
+  """
+
+  # size of the blocks read, written and piped through dd
+  BLOCK_BYTES = 4 * 1024 * 1024
+
+  # suffix of the partial copy, kept next to the remote file as a hidden file
+  PARTIAL_SUFFIX = ".largeFilePartial"
+
+
+  @staticmethod
+  def partialLoc(remoteLoc: str) -> str:
+    """
+    # Where the partial copy of a remote file is written
+    :param remoteLoc:
+    :return:
+    """
+    return os.path.join(os.path.dirname(remoteLoc), "." + os.path.basename(remoteLoc) + LargeFileTransfer.PARTIAL_SUFFIX)
+
+
+  @staticmethod
+  def hashLocalRange(fileLoc: str, offset: int, length: int, throttle=None) -> str:
+    """
+    # sha256 of a byte range of a local file
+    #  -hashlib releases the GIL on large updates, so ranges hash in parallel threads
+    #
+    :param fileLoc:
+    :param offset:
+    :param length:
+    :param throttle: (function) called before each block is read, to wait while told to
+    :return: (str) hex digest
+    """
+    digest = hashlib.sha256()
+    with open(fileLoc, "rb") as f:
+      f.seek(offset)
+      while length > 0:
+        if throttle is not None:
+          throttle()
+        block = f.read(min(LargeFileTransfer.BLOCK_BYTES, length))
+        if len(block) == 0:
+          break
+        digest.update(block)
+        length -= len(block)
+    return digest.hexdigest()
+
+
+  def __init__(self, sshCommand: list, streams=4, rangeBytes=64 * 1024 * 1024, stopTime=None, throttle=None):
+    """
+    #
+    :param sshCommand: (list) ssh command and arguments, up to and including user@host
+    :param streams:    (int) number of parallel SSH channels
+    :param rangeBytes: (int) size of the byte ranges compared and sent
+    :param stopTime:   (float) unix time after which no more ranges are started, or None
+    :param throttle:   (function) called before each block is read, to wait while told to, or None
+    """
+    self.sshCommand = sshCommand
+    self.streams    = max(1, streams)
+    self.rangeBytes = rangeBytes
+    self.stopTime   = stopTime
+    self.throttle   = throttle
+
+
+  def _runRemote(self, command: str) -> subprocess.CompletedProcess:
+    return subprocess.run(self.sshCommand + [command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+  def _remoteStat(self, remoteLoc: str):
+    """
+    # Size and modification time of the remote file, creating its directory if needed
+    #
+    :param remoteLoc:
+    :return: (tuple) size and unix modification time, or None if the file doesn't exist
+    """
+    ret = self._runRemote(f"mkdir -p {shlex.quote(os.path.dirname(remoteLoc))} && "
+                          f"stat -c '%s %Y' {shlex.quote(remoteLoc)}")
+    fields = ret.stdout.decode("utf-8").split()
+    if ret.returncode != 0 or len(fields) != 2:
+      return None
+    return int(fields[0]), int(fields[1])
+
+
+  def _preparePartial(self, remoteLoc: str, partialLoc: str):
+    """
+    # Start the partial copy from the remote file, unless a previous run left one
+    #  -cp --reflink=auto clones rather than copies where the file system can,
+    #   e.g., btrfs, or ZFS with block cloning
+    #
+    :param remoteLoc:
+    :param partialLoc:
+    :return: (int) size of the partial copy, or None if there is none yet
+    """
+    ret = self._runRemote(f"if [ ! -e {shlex.quote(partialLoc)} ] && [ -e {shlex.quote(remoteLoc)} ]; then "
+                          f"cp --reflink=auto {shlex.quote(remoteLoc)} {shlex.quote(partialLoc)} || exit 1; fi; "
+                          f"stat -c '%s' {shlex.quote(partialLoc)} 2>/dev/null || true")
+    if ret.returncode != 0:
+      raise SystemError(f"could not copy remote file {remoteLoc}: {ret.stderr.decode('utf-8')}")
+    fields = ret.stdout.decode("utf-8").split()
+    return int(fields[0]) if len(fields) == 1 else None
+
+
+  def _remoteRangeHashes(self, remoteLoc: str, firstRange: int, lastRange: int) -> list:
+    """
+    # sha256 of consecutive byte ranges of the remote file, in one SSH session
+    #
+    :param remoteLoc:
+    :param firstRange: (int) index of the first range
+    :param lastRange:  (int) index of the last range, inclusive
+    :return: (list) hex digests
+    """
+    command = (f"for i in $(seq {firstRange} {lastRange}); do "
+               f"dd if={shlex.quote(remoteLoc)} bs={LargeFileTransfer.BLOCK_BYTES} iflag=skip_bytes,count_bytes "
+               f"skip=$((i*{self.rangeBytes})) count={self.rangeBytes} status=none | sha256sum; done")
+    ret = self._runRemote(command)
+    if ret.returncode != 0:
+      raise SystemError(f"could not hash remote file {remoteLoc}: {ret.stderr.decode('utf-8')}")
+    return [line.split()[0] for line in ret.stdout.decode("utf-8").split("\n") if line.strip() != ""]
+
+
+  def _sendRange(self, fileLoc: str, remoteLoc: str, offset: int, length: int) -> int:
+    """
+    # Write a byte range of the local file into a remote file, in place
+    #
+    :param fileLoc:
+    :param remoteLoc:
+    :param offset:
+    :param length:
+    :return: (int) bytes sent, or None if out of time
+    """
+    if self.stopTime is not None and time.time() >= self.stopTime:
+      return None
+    
+    process = subprocess.Popen(
+      self.sshCommand + [f"dd of={shlex.quote(remoteLoc)} bs={LargeFileTransfer.BLOCK_BYTES} iflag=fullblock "
+                         f"oflag=seek_bytes seek={offset} conv=notrunc status=none"],
+      stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    sentBytes = 0
+    with open(fileLoc, "rb") as f:
+      f.seek(offset)
+      while sentBytes < length:
+        if self.throttle is not None:
+          self.throttle()
+        block = f.read(min(LargeFileTransfer.BLOCK_BYTES, length - sentBytes))
+        if len(block) == 0:
+          break
+        process.stdin.write(block)
+        sentBytes += len(block)
+    process.stdin.close()
+
+    stdErr = process.stderr.read().decode("utf-8")
+    if process.wait() != 0:
+      raise SystemError(f"could not write to remote file {remoteLoc}: {stdErr}")
+    return sentBytes
+
+
+  def _remoteFileHash(self, remoteLoc: str) -> str:
+    ret = self._runRemote(f"sha256sum {shlex.quote(remoteLoc)}")
+    if ret.returncode != 0:
+      raise SystemError(f"could not hash remote file {remoteLoc}: {ret.stderr.decode('utf-8')}")
+    return ret.stdout.decode("utf-8").split()[0]
+
+
+  def _setRemoteAttributes(self, fileStat: os.stat_result, remoteLoc: str):
+    """
+    # Give the remote file the local file's owner, mode and modification time, as rsync -a would
+    #  -owner and group go by name; as with rsync, changing them needs the
+    #   remote user to be root, so a failure there is ignored
+    #
+    :param fileStat:  (os.stat_result) of the local file
+    :param remoteLoc: (str) remote file, unescaped
+    :return:
+    """
+    try:
+      owner = f"{pwd.getpwuid(fileStat.st_uid).pw_name}:{grp.getgrgid(fileStat.st_gid).gr_name}"
+    except KeyError:
+      owner = f"{fileStat.st_uid}:{fileStat.st_gid}"
+    ret = self._runRemote(f"{{ chown {shlex.quote(owner)} {shlex.quote(remoteLoc)} 2>/dev/null || true; }} && "
+                          f"chmod {stat.S_IMODE(fileStat.st_mode):o} {shlex.quote(remoteLoc)} && "
+                          f"touch -m -d @{int(fileStat.st_mtime)} {shlex.quote(remoteLoc)}")
+    if ret.returncode != 0:
+      logger.warning(f"Large file: could not set the attributes of {remoteLoc}: {ret.stderr.decode('utf-8')}")
+
+
+  def transferFile(self, fileLoc: str, remoteLoc: str) -> dict:
+    """
+    # Bring the remote copy of a file up to date
+    #  -skipped when the remote size and modification time already match
+    #
+    :param fileLoc:   (str) local file
+    :param remoteLoc: (str) remote file, unescaped
+    :return: (dict) file, size, rangeCount, changedRanges, sentBytes, skipped, stopped, verified and seconds
+    """
+
+    startTime = time.time()
+    fileStat  = os.stat(fileLoc)
+    fileSize  = fileStat.st_size
+    result = {
+      "file":          fileLoc,
+      "size":          fileSize,
+      "rangeCount":    (fileSize + self.rangeBytes - 1) // self.rangeBytes,
+      "changedRanges": 0,
+      "sentBytes":     0,
+      "skipped":       False,
+      "stopped":       False,
+      "verified":      False,
+      "seconds":       0.0
+    }
+
+    # CHECK: already up to date, as rsync's quick check
+    remoteStat = self._remoteStat(remoteLoc)
+    if remoteStat == (fileSize, int(fileStat.st_mtime)):
+      result["skipped"]  = True
+      result["verified"] = True
+      result["seconds"]  = time.time() - startTime
+      return result
+
+    # everything below works on the partial copy
+    partialLoc  = LargeFileTransfer.partialLoc(remoteLoc)
+    partialSize = self._preparePartial(remoteLoc, partialLoc)
+
+    ranges = [(index * self.rangeBytes, min(self.rangeBytes, fileSize - index * self.rangeBytes))
+              for index in range(result["rangeCount"])]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2 * self.streams) as executor:
+
+      # hash both copies at the same time
+      #  -the remote ranges are split into one contiguous group per stream, and
+      #   submitted first so they aren't queued behind the local ranges
+      #  -ranges past the end of the remote file can only differ
+      remoteFutures = {}
+      remoteHashes  = [None] * len(ranges)
+      if partialSize is not None and partialSize > 0:
+        remoteRangeCount = min(len(ranges), (partialSize + self.rangeBytes - 1) // self.rangeBytes)
+        groupSize = max(1, (remoteRangeCount + self.streams - 1) // self.streams)
+        remoteFutures = {executor.submit(self._remoteRangeHashes, partialLoc, first,
+                                         min(first + groupSize, remoteRangeCount) - 1): first
+                         for first in range(0, remoteRangeCount, groupSize)}
+      localFutures = [executor.submit(LargeFileTransfer.hashLocalRange, fileLoc, offset, length, self.throttle)
+                      for offset, length in ranges]
+      for future, first in remoteFutures.items():
+        for offset, remoteHash in enumerate(future.result()):
+          remoteHashes[first + offset] = remoteHash
+      localHashes = [future.result() for future in localFutures]
+
+    # send the ranges that differ
+    #  -one SSH channel per stream, however many threads the hashing used
+    changed = [ranges[index] for index in range(len(ranges)) if localHashes[index] != remoteHashes[index]]
+    result["changedRanges"] = len(changed)
+    logger.info(f"Large file: {fileLoc}: {len(changed)}/{len(ranges)} ranges changed")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.streams) as executor:
+      sendFutures = [executor.submit(self._sendRange, fileLoc, partialLoc, offset, length) for offset, length in changed]
+      sentBytes = [future.result() for future in sendFutures]
+    result["sentBytes"] = sum(numBytes for numBytes in sentBytes if numBytes is not None)
+
+    # out of time: the ranges already sent will match next time, so it picks up from here
+    if None in sentBytes:
+      logger.warning(f"Large file: {fileLoc}: stopped, out of time")
+      result["stopped"] = True
+      result["seconds"] = time.time() - startTime
+      return result
+
+    # cut off anything left from a longer remote copy, then check the whole file
+    ret = self._runRemote(f"truncate -s {fileSize} {shlex.quote(partialLoc)}")
+    if ret.returncode != 0:
+      raise SystemError(f"could not truncate remote file {partialLoc}: {ret.stderr.decode('utf-8')}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      remoteFuture = executor.submit(self._remoteFileHash, partialLoc)
+      localHash    = LargeFileTransfer.hashLocalRange(fileLoc, 0, fileSize, self.throttle)
+      result["verified"] = localHash == remoteFuture.result()
+
+    # only a verified copy gets the file's attributes, including the
+    # modification time that lets the next run skip it, and its real name
+    #  -an unverified one is left as it is, for the next run to correct
+    if result["verified"]:
+      self._setRemoteAttributes(fileStat, partialLoc)
+      ret = self._runRemote(f"mv -f {shlex.quote(partialLoc)} {shlex.quote(remoteLoc)}")
+      if ret.returncode != 0:
+        raise SystemError(f"could not rename remote file {partialLoc}: {ret.stderr.decode('utf-8')}")
+    else:
+      logger.error(f"Large file: {fileLoc}: remote checksum does not match")
+
+    result["seconds"] = time.time() - startTime
+    return result
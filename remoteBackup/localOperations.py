@@ -0,0 +1,360 @@
+
+import os
+import zlib
+import time
+import heapq
+import queue
+import bisect
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LocalOperations:
+
+  # files at least this big count as large, e.g., disk images and databases
+  LARGE_FILE_BYTES = 64 * 1024 * 1024
+
+  # number of files kept as a sample of each directory's content
+  SAMPLE_FILE_COUNT = 256
+
+  # scanner threads per source directory
+  SCAN_THREADS = min(32, 4 * (os.cpu_count() or 1))
+
+  # lower bounds of the file size histogram buckets
+  SIZE_BUCKETS = [0, 1024, 16 * 1024, 256 * 1024, 4 * 1024 ** 2, 64 * 1024 ** 2, 1024 ** 3]
+
+  # lower bounds of the histogram of the number of files directly in a directory
+  DIR_FILE_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+
+  @staticmethod
+  def formatBytes(numBytes: int) -> str:
+    """
+    # Human readable byte count, e.g., 1.5G
+    #
+    :param numBytes:
+    :return:
+    """
+    value = float(numBytes)
+    for unit in ["B", "K", "M", "G", "T"]:
+      if abs(value) < 1024 or unit == "T":
+        break
+      value /= 1024
+    return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+
+
+  @staticmethod
+  def transferPath(sourceDir: str, fileLoc: str) -> str:
+    """
+    # Path of a file on the remote machine, relative to the remote destination directory
+    #  -follows rsync: without a trailing slash the source directory itself is
+    #   copied, with one only its contents
+    #
+    :param sourceDir: (str) local source directory
+    :param fileLoc:   (str) local file within <sourceDir>
+    :return:
+    """
+    prefix = "" if sourceDir.endswith(os.path.sep) else os.path.basename(sourceDir)
+    return os.path.join(prefix, os.path.relpath(fileLoc, sourceDir))
+
+
+  @staticmethod
+  def findLargeFiles(dirLoc: str, minBytes: int) -> list:
+    """
+    # Files of at least <minBytes> within a local directory
+    #  -unreadable entries are skipped
+    #
+    :param dirLoc:   (str) local directory to search
+    :param minBytes: (int) smallest file size to include
+    :return: (list) of (path, os.stat_result), largest first
+    """
+    largeFiles = []
+    dirsToScan = [dirLoc]
+    while dirsToScan:
+      try:
+        with os.scandir(dirsToScan.pop()) as dirEntries:
+          for entry in dirEntries:
+            try:
+              if entry.is_dir(follow_symlinks=False):
+                dirsToScan.append(entry.path)
+              elif entry.is_file(follow_symlinks=False):
+                entryStat = entry.stat(follow_symlinks=False)
+                if entryStat.st_size >= minBytes:
+                  largeFiles.append((entry.path, entryStat))
+            except OSError:
+              continue
+      except OSError as e:
+        logger.debug(f"findLargeFiles: skipping unreadable directory: {e}")
+    return sorted(largeFiles, key=lambda largeFile: largeFile[1].st_size, reverse=True)
+
+
+  @staticmethod
+  def _newTotals() -> dict:
+    return {"fileCount": 0, "totalBytes": 0, "changedFileCount": 0, "changedBytes": 0}
+
+
+  @staticmethod
+  def _addTotals(totals: dict, other: dict):
+    for key in ["fileCount", "totalBytes", "changedFileCount", "changedBytes"]:
+      totals[key] += other[key]
+
+
+  @staticmethod
+  def _newScanInfo(dirLoc: str, modifiedSince) -> dict:
+    return dict(LocalOperations._newTotals(), **{
+      "directory":        dirLoc,
+      "modifiedSince":    modifiedSince,
+      "largeFileBytes":   0,
+      "largeFiles":       [],
+      "suffixBytes":      {},
+      "sampleFiles":      [],
+      "dirCount":         0,
+      "sizeHistogram":    [[0, 0] for _ in LocalOperations.SIZE_BUCKETS],
+      "dirFileHistogram": [0 for _ in LocalOperations.DIR_FILE_BUCKETS],
+      "subtrees":         {},
+      "candidates":       {},
+      "scanTime":         0.0
+    })
+
+
+  @staticmethod
+  def _scanDirectory(item: tuple, dirQueue: queue.Queue, found: dict, options: dict):
+    """
+    # Scan one directory, queueing its sub-directories
+    #
+    :param item:     (tuple) directory, depth, subtree, exclude candidate (or None)
+    :param dirQueue: (queue.Queue) directories still to scan
+    :param found:    (dict) this thread's results, added to; sampleFiles is kept as a heap
+    :param options:  (dict) the scanSourceDirectory arguments
+    :return:
+    """
+    dirLoc, depth, subtree, candidate = item
+    totals        = LocalOperations._newTotals()
+    modifiedSince = options["modifiedSince"]
+    sizeHistogram = found["sizeHistogram"]
+    sampleFiles   = found["sampleFiles"]
+
+    try:
+      with os.scandir(dirLoc) as dirEntries:
+        for entry in dirEntries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subDepth = depth + 1
+              subCandidate = candidate
+              if candidate is None and entry.name in options["candidateNames"]:
+                subCandidate = entry.path
+              dirQueue.put((entry.path, subDepth,
+                            entry.path if subDepth <= options["subtreeDepth"] else subtree, subCandidate))
+            elif entry.is_file(follow_symlinks=False):
+              entryStat = entry.stat(follow_symlinks=False)
+              totals["fileCount"]  += 1
+              totals["totalBytes"] += entryStat.st_size
+              if modifiedSince is None or entryStat.st_mtime > modifiedSince:
+                totals["changedFileCount"] += 1
+                totals["changedBytes"]     += entryStat.st_size
+              if entryStat.st_size >= LocalOperations.LARGE_FILE_BYTES:
+                found["largeFileBytes"] += entryStat.st_size
+              if options["largeFileListBytes"] > 0 and entryStat.st_size >= options["largeFileListBytes"]:
+                found["largeFiles"].append((entry.path, entryStat.st_size))
+              bucket = sizeHistogram[bisect.bisect_right(LocalOperations.SIZE_BUCKETS, entryStat.st_size) - 1]
+              bucket[0] += 1
+              bucket[1] += entryStat.st_size
+
+              # content mix, by file suffix
+              suffix = os.path.splitext(entry.name)[1][1:].lower()
+              found["suffixBytes"][suffix] = found["suffixBytes"].get(suffix, 0) + entryStat.st_size
+
+              # sample: the files whose paths hash lowest, kept as a max-heap
+              sampleKey = zlib.crc32(os.fsencode(entry.path))
+              if len(sampleFiles) < LocalOperations.SAMPLE_FILE_COUNT:
+                heapq.heappush(sampleFiles, (-sampleKey, entry.path))
+              elif sampleKey < -sampleFiles[0][0]:
+                heapq.heapreplace(sampleFiles, (-sampleKey, entry.path))
+          except OSError:
+            continue
+    except OSError as e:
+      logger.debug(f"scanSourceDirectory: skipping unreadable directory: {e}")
+
+    found["dirCount"] += 1
+    found["dirFileHistogram"][bisect.bisect_right(LocalOperations.DIR_FILE_BUCKETS, totals["fileCount"]) - 1] += 1
+    LocalOperations._addTotals(found["subtrees"].setdefault(subtree, LocalOperations._newTotals()), totals)
+    if candidate is not None:
+      LocalOperations._addTotals(found["candidates"].setdefault(candidate, LocalOperations._newTotals()), totals)
+
+
+  @staticmethod
+  def scanSourceDirectory(dirLoc: str, modifiedSince=None, largeFileListBytes=0, threads=None,
+                          subtreeDepth=0, candidateNames=()) -> dict:
+    """
+    # Walk a local source directory and total up its files
+    #  -directories are scanned by several threads at once; os.scandir and
+    #   lstat release the GIL, so the scan overlaps its filesystem calls
+    #  -files modified after <modifiedSince> are counted as changed
+    #  -also records the bytes per file suffix, the bytes in large files,
+    #   histograms of file sizes and files per directory, and a sample of the
+    #   files, picked by path hash so successive scans pick similar files
+    #  -files of at least <largeFileListBytes> are listed, so the transfer
+    #   doesn't have to walk the directory again to find them
+    #  -totals are kept per subtree, <subtreeDepth> levels below the directory,
+    #   and per directory named in <candidateNames>, for tree profiles
+    #  -unreadable entries are skipped, rsync will report them itself
+    #
+    :param dirLoc:             (str) local directory to scan
+    :param modifiedSince:      (float) unix timestamp, or None to count every file as changed
+    :param largeFileListBytes: (int) smallest file size to list, or 0 to list none
+    :param threads:            (int) scanner threads, default SCAN_THREADS
+    :param subtreeDepth:       (int) depth of the subtrees totalled, 0 for the directory only
+    :param candidateNames:     (list) directory names totalled wherever they occur
+    :return:
+    """
+
+    startTime = time.time()
+    options = {"modifiedSince": modifiedSince, "largeFileListBytes": largeFileListBytes,
+               "subtreeDepth": subtreeDepth, "candidateNames": set(candidateNames)}
+
+    # each thread keeps its own results, merged once the scan is done
+    dirQueue = queue.Queue()
+    foundPerThread = []
+
+    def _worker(found):
+      while True:
+        item = dirQueue.get()
+        try:
+          if item is None:
+            return
+          LocalOperations._scanDirectory(item, dirQueue, found, options)
+        finally:
+          dirQueue.task_done()
+
+    dirQueue.put((dirLoc, 0, dirLoc, None))
+    workers = []
+    for _ in range(threads or LocalOperations.SCAN_THREADS):
+      foundPerThread.append(LocalOperations._newScanInfo(dirLoc, modifiedSince))
+      workers.append(threading.Thread(target=_worker, args=(foundPerThread[-1],), daemon=True))
+      workers[-1].start()
+    dirQueue.join()
+    for _ in workers:
+      dirQueue.put(None)
+    for worker in workers:
+      worker.join()
+
+    # merge
+    scanInfo = LocalOperations._newScanInfo(dirLoc, modifiedSince)
+    sampleFiles = []
+    for found in foundPerThread:
+      scanInfo["largeFileBytes"] += found["largeFileBytes"]
+      scanInfo["largeFiles"]     += found["largeFiles"]
+      for suffix, numBytes in found["suffixBytes"].items():
+        scanInfo["suffixBytes"][suffix] = scanInfo["suffixBytes"].get(suffix, 0) + numBytes
+      sampleFiles += found["sampleFiles"]
+      scanInfo["dirCount"] += found["dirCount"]
+      for index, (count, numBytes) in enumerate(found["sizeHistogram"]):
+        scanInfo["sizeHistogram"][index][0] += count
+        scanInfo["sizeHistogram"][index][1] += numBytes
+      for index, count in enumerate(found["dirFileHistogram"]):
+        scanInfo["dirFileHistogram"][index] += count
+      for subtree, totals in found["subtrees"].items():
+        LocalOperations._addTotals(scanInfo, totals)
+        LocalOperations._addTotals(scanInfo["subtrees"].setdefault(subtree, LocalOperations._newTotals()), totals)
+      for candidate, totals in found["candidates"].items():
+        LocalOperations._addTotals(scanInfo["candidates"].setdefault(candidate, LocalOperations._newTotals()), totals)
+
+    scanInfo["sampleFiles"] = [fileLoc for _, fileLoc in heapq.nlargest(LocalOperations.SAMPLE_FILE_COUNT, sampleFiles)]
+    scanInfo["largeFiles"].sort(key=lambda largeFile: largeFile[1], reverse=True)
+    scanInfo["scanTime"] = time.time() - startTime
+    return scanInfo
+
+
+class SourceScan(threading.Thread):
+  """
+  # Scan the local source directories in the background
+  #  -lets the local pre-scan overlap with the remote storage bring-up, and the transfer
+  #  -each directory's result can be waited on alone, as soon as it is scanned
+  """
+
+  def __init__(self, sourceDirs: list, modifiedSince=None, largeFileListBytes=0):
+    """
+    #
+    :param sourceDirs:         (list) local directories to scan
+    :param modifiedSince:      (float) unix timestamp passed on to scanSourceDirectory, or a dict of them per directory
+    :param largeFileListBytes: (int) passed on to scanSourceDirectory
+    """
+
+    # daemon, so a failed bring-up can exit without waiting on the scan
+    super().__init__(name="SourceScan", daemon=True)
+
+    self.sourceDirs    = sourceDirs
+    self.modifiedSince = modifiedSince
+    self.largeFileListBytes = largeFileListBytes
+
+    self.results   = []
+    self.error     = None
+    self.startTime = None
+    self.endTime   = None
+
+    # directory -> set once it's scanned, or the scan has stopped
+    self.scanned = {dirLoc: threading.Event() for dirLoc in sourceDirs}
+
+    # total time callers spent waiting on results
+    self.waitTime = 0.0
+    self.waitLock = threading.Lock()
+
+
+  def run(self):
+    self.startTime = time.time()
+    try:
+      for dirLoc in self.sourceDirs:
+        modifiedSince = self.modifiedSince.get(dirLoc, None) if isinstance(self.modifiedSince, dict) else self.modifiedSince
+        self.results.append(LocalOperations.scanSourceDirectory(dirLoc, modifiedSince=modifiedSince,
+                                                                largeFileListBytes=self.largeFileListBytes))
+        self.scanned[dirLoc].set()
+    except Exception as e:
+      self.error = e
+    finally:
+      self.endTime = time.time()
+      for event in self.scanned.values():
+        event.set()
+
+
+  def _addWaitTime(self, startTime: float):
+    with self.waitLock:
+      self.waitTime += time.time() - startTime
+
+
+  def getResults(self) -> list:
+    """
+    # Wait for the scan to finish and return the per-directory results
+    :return:
+    """
+    startTime = time.time()
+    self.join()
+    self._addWaitTime(startTime)
+    if self.error is not None:
+      raise self.error
+    return self.results
+
+
+  def getResult(self, dirLoc: str) -> dict:
+    """
+    # Wait for a single directory to be scanned and return its result
+    #
+    :param dirLoc: (str) one of the scanned directories
+    :return:
+    """
+    startTime = time.time()
+    self.scanned[dirLoc].wait()
+    self._addWaitTime(startTime)
+    for scanInfo in self.results:
+      if scanInfo["directory"] == dirLoc:
+        return scanInfo
+    raise self.error
+
+
+  def getDuration(self) -> float:
+    """
+    # How long the scan took, in seconds
+    :return:
+    """
+    if self.startTime is None or self.endTime is None:
+      return 0.0
+    return self.endTime - self.startTime
@@ -1,29 +1,43 @@
 
 import os
+import re
+import shlex
 import pexpect
 import getpass
+import signal
 import time
 import datetime
 import platform
 import subprocess
+import concurrent.futures
 import logging
 logger = logging.getLogger(__name__)
 
+from rsyncLogIndex import RsyncLogIndex
+from localOperations import LocalOperations
+from chunkStore import ChunkStore
+from largeFileTransfer import LargeFileTransfer
+from datasetLayout import DatasetLayout
+from resourceGovernor import ResourceGovernor
+from remoteState import RemoteState
+
 
 class RemoteOperations:
   
   CHARS_TO_ESCAPE = [" ", "(", ")"]
   
   @staticmethod
-  def runCommand(cmdList: list, basicCMD=True, useShell=None, outputToStdout=False) -> dict:
+  def runCommand(cmdList: list, basicCMD=True, useShell=None, outputToStdout=False, timeout=None, onStart=None) -> dict:
     """
-    # Run the command and return a dictionary of stdout and stderr
+    # Run the command and return a dictionary of stdout, stderr and the return code
     # Note: for more involved commands, use the "Popen" version
     #
     :param cmdList:        (list) containing command and its arguments
     :param basicCMD:       (bool) to use basic subprocess version, or less secure Popen
     :param useShell:       (bool) use less secure shell, usually needed for interactive
     :param outputToStdout: (bool) by default we capture and return stdout
+    :param timeout:        (float) Popen version only: seconds before the command is sent SIGTERM
+    :param onStart:        (function) Popen version only: called with the started process
     :return:
     """
     
@@ -41,22 +55,48 @@ class RemoteOperations:
       # run command
       ret = subprocess.run(cmdList, stdout=stdOut, stderr=subprocess.PIPE, shell=shell)
       
-      # return stdout and stderr
+      # return stdout, stderr and the return code
       return {
-        "stdout": "" if stdOut is None else ret.stdout.decode("utf-8"),
-        "stderr": ret.stderr.decode("utf-8")
+        "stdout":     "" if stdOut is None else ret.stdout.decode("utf-8"),
+        "stderr":     ret.stderr.decode("utf-8"),
+        "returncode": ret.returncode
       }
     
     else:
       
       # run command
-      ret = subprocess.Popen(" ".join(cmdList), shell=True,
-                             stdout=stdOut, stderr=subprocess.PIPE).communicate()
+      #  -with a timeout or onStart, in its own process group, so the shell and
+      #   everything it started (e.g., rsync and ssh) can be signalled together
+      newSession = timeout is not None or onStart is not None
+      process = subprocess.Popen(" ".join(cmdList), shell=True, start_new_session=newSession,
+                                 stdout=stdOut, stderr=subprocess.PIPE)
+      if onStart is not None:
+        onStart(process)
+      timedOut = False
+      try:
+        ret = process.communicate(timeout=None if timeout is None else max(0, timeout))
+      except (subprocess.TimeoutExpired, KeyboardInterrupt) as e:
+        if newSession:
+          # continue the group as well, in case it was paused (SIGSTOP)
+          try:
+            os.killpg(process.pid, signal.SIGTERM)
+            os.killpg(process.pid, signal.SIGCONT)
+          except ProcessLookupError:
+            pass
+        else:
+          # in our process group, so it got the terminal's SIGINT too
+          process.terminate()
+        ret = process.communicate()
+        if isinstance(e, KeyboardInterrupt):
+          raise
+        timedOut = True
       
-      # return stdout and stderr
+      # return stdout, stderr and the return code
       return {
-        "stdout": "" if stdOut is None else ret[0].decode("utf-8"),
-        "stderr": ret[1].decode("utf-8")
+        "stdout":     "" if stdOut is None else ret[0].decode("utf-8"),
+        "stderr":     ret[1].decode("utf-8"),
+        "returncode": process.returncode,
+        "timedOut":   timedOut
       }
   
   
@@ -76,6 +116,14 @@ class RemoteOperations:
     ]
 
 
+  def _assembleSSHCommandList(self) -> list:
+    """
+    # ssh command list up to and including user@host, for commands run without a local shell
+    :return:
+    """
+    return ["ssh", "-p", str(self.sshPort), "-i", self.sshPrivateKey, f"{self.remoteUsername}@{self.remoteIP}"]
+
+
   def _remoteFileExists(self, fileLocation) -> bool:
     """
     # If a remote file exists
@@ -115,7 +163,8 @@ class RemoteOperations:
     while True:
     
       # get information about the current scrub
-      poolStatus = self._getZFSPoolStatus()
+      #  -always fetched, as it changes while we wait
+      poolStatus = self._getZFSPoolStatus(fresh=True)
     
       # return if no scrub is taking place
       if not poolStatus["scrub"]["inProgress"]:
@@ -157,9 +206,20 @@ class RemoteOperations:
       time.sleep(sleepTime.total_seconds())
   
   
-  def _getZFSPoolStatus(self) -> dict:
+  def _getZFSPoolStatus(self, fresh=False) -> dict:
     """
     # Return a dictionary describing the status of the ZFS pool
+    #
+    :param fresh: (bool) fetch it even if already known this run
+    :return:
+    """
+    return self.remoteState.get("poolStatus", self.zfsPoolName, self._fetchZFSPoolStatus, fresh=fresh)
+  
+  
+  def _fetchZFSPoolStatus(self) -> dict:
+    """
+    # Fetch the status of the ZFS pool from 'zpool status -p'
+    #  -exact numbers, rather than human readable ones
     :return:
     """
   
@@ -170,16 +230,17 @@ class RemoteOperations:
       #  "total":  None,
       #  "used":   None,
       # },
-      # "errors": {
-      #  "read":  None,
-      #  "write": None,
-      #  "cksum": None,
-      # },
+      "errors": {
+        "read":  None,
+        "write": None,
+        "cksum": None,
+      },
       "scrub": {
         "inProgress": False,
         "timeRemaining": datetime.timedelta(),
-        # "errors":         None,
-        # "completionTime": None
+        "errors":         None,
+        "completionTime": None,
+        "duration":       None
       }
     }
   
@@ -231,7 +292,8 @@ class RemoteOperations:
     encStorage   118G  26.4G      115G  /mnt/encStorage
     """
   
-    remoteCmd = self._assembleRemoteCommandList(f"zpool status {self.zfsPoolName}")
+    # times in UTC, as run names are, whatever the remote machine's time zone
+    remoteCmd = self._assembleRemoteCommandList(f"TZ=UTC zpool status -p {self.zfsPoolName}")
     cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
   
     # CHECK: got valid status
@@ -244,9 +306,12 @@ class RemoteOperations:
     # poolStatus["size"]["total"] = None
     # poolStatus["size"]["used"]  = None
 
-    # poolStatus["errors"]["read"]  = None
-    # poolStatus["errors"]["write"] = None
-    # poolStatus["errors"]["cksum"] = None
+    # error counts of the pool as a whole, from its row of the config table
+    errorMatch = re.search(rf"^\s*{re.escape(self.zfsPoolName)}\s+\S+\s+(\d+)\s+(\d+)\s+(\d+)",
+                           cmdOutput["stdout"], re.MULTILINE)
+    if errorMatch is not None:
+      poolStatus["errors"]["read"], poolStatus["errors"]["write"], poolStatus["errors"]["cksum"] = \
+        map(int, errorMatch.groups())
   
     poolStatus["scrub"]["inProgress"] = "scrub in progress" in cmdOutput["stdout"]
     if poolStatus["scrub"]["inProgress"]:
@@ -257,9 +322,23 @@ class RemoteOperations:
         poolStatus["scrub"]["timeRemaining"] = \
           datetime.timedelta(hours=timeParts[0], minutes=timeParts[1], seconds=timeParts[2])
 
-    # else:
-    #  poolStatus["scrub"]["errors"]         = None
-    #  poolStatus["scrub"]["completionTime"] = None
+    # details of the last completed scrub, if any
+    #  -"scrub repaired 0B in 00:12:07 with 0 errors on Wed Aug 10 00:12:56 2022"
+    #  -the completion time is UTC, see above
+    #  -long scrubs are reported as "in 1 days 02:03:04"
+    else:
+      scrubMatch = re.search(r"scrub repaired \S+ in (?:(\d+) days? )?(\d+):(\d+):(\d+) with (\d+) errors on (.+)",
+                             cmdOutput["stdout"])
+      if scrubMatch is not None:
+        days, hours, minutes, seconds, errors, completionStr = scrubMatch.groups()
+        poolStatus["scrub"]["errors"]   = int(errors)
+        poolStatus["scrub"]["duration"] = datetime.timedelta(days=int(days or 0), hours=int(hours),
+                                                             minutes=int(minutes), seconds=int(seconds))
+        try:
+          poolStatus["scrub"]["completionTime"] = \
+            datetime.datetime.strptime(" ".join(completionStr.split()), "%a %b %d %H:%M:%S %Y")
+        except ValueError:
+          logger.debug(f"_getZFSPoolStatus: could not parse scrub completion time: {completionStr}")
   
     return poolStatus
   
@@ -289,6 +368,26 @@ class RemoteOperations:
     # rsync
     self.rsyncArguments = self.configData["rsyncOptions"]["arguments"]
     self.rsyncLogOutput = self.configData["rsyncOptions"]["logOutput"]
+    self.rsyncLogDir    = os.path.join(self.configData["localStateDir"], "rsyncLogs")
+    self.rsyncParallelStreams = self.configData["rsyncOptions"]["parallelStreams"]
+  
+    # files of at least largeFileBytes (0 for none) are sent in byte ranges over several streams
+    self.largeFileBytes      = self.configData["rsyncOptions"]["largeFileBytes"]
+    self.largeFileStreams    = self.configData["rsyncOptions"]["largeFileStreams"]
+    self.largeFileRangeBytes = self.configData["rsyncOptions"]["largeFileRangeBytes"]
+  
+    # facts about the remote machine, kept for the run
+    self.remoteState = RemoteState()
+  
+    # priority of the transfers, and pausing them under load
+    #  -started and stopped by the caller, around the transfers
+    self.governor = ResourceGovernor(self.configData["governorOptions"])
+  
+    # name of this run, shared by its log files
+    self.runName = datetime.datetime.utcnow().strftime(RsyncLogIndex.RUN_NAME_FORMAT)
+  
+    # per-directory results of the last performRsync
+    self.rsyncResults = []
   
     # LUKS
     self.luksMountName                   = self.configData["remoteLUKSOptions"]["mountName"]
@@ -297,6 +396,16 @@ class RemoteOperations:
   
     # ZFS
     self.zfsPoolName = self.configData["remoteZFSOptions"]["poolName"]
+    self.zfsDatasetPerSource = self.configData["remoteZFSOptions"]["datasetPerSource"]
+  
+    # ZFS native encryption
+    #  -the key of encryptionRoot (default: the pool) unlocks every dataset below it
+    self.zfsEncryption     = self.configData["remoteZFSOptions"]["encryption"]
+    self.zfsEncryptionRoot = self.configData["remoteZFSOptions"]["encryptionRoot"] or self.zfsPoolName
+    self.zfsKeyFile        = self.configData["remoteZFSOptions"]["keyFile"]
+    
+    # whether this run loaded the key, so it can unload it again
+    self.zfsKeyLoaded = False
   
   
   def isDirectoryEmpty(self, directoryLoc: str) -> bool:
@@ -336,7 +445,8 @@ class RemoteOperations:
     # Is LUKS container open
     :return:
     """
-    return self._remoteFileExists(f"/dev/disk/by-id/dm-name-{self.luksMountName}")
+    return self.remoteState.get("luksOpen", self.luksMountName,
+                                lambda: self._remoteFileExists(f"/dev/disk/by-id/dm-name-{self.luksMountName}"))
 
 
   def isZFSPoolOnline(self) -> bool:
@@ -401,22 +511,41 @@ class RemoteOperations:
     return len(cmdOutput['stdout']) > len("rsync:\n")
   
   
+  def remotePythonInstalled(self) -> bool:
+    """
+    # python3 is installed on the remote machine, for the chunk store server
+    :return:
+    """
+    remoteCmd = self._assembleRemoteCommandList("whereis python3")
+    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    return len(cmdOutput['stdout']) > len("python3:\n")
+  
+  
   def getDiskSpaceInfo(self, directoryToCheck=None):
     """
-    # Return the result of 'df -h' on the remote directory
+    # Return the result of 'df -B1' on the remote directory
+    #  -exact byte counts, plus human readable total and used
     :return:
     """
   
     """
-    Filesystem      Size  Used Avail Use% Mounted on
-    encStorage      145G  128K  145G   1% /mnt/encStorage
+    Filesystem        1B-blocks      Used    Available Use% Mounted on
+    encStorage     155692564480    131072 155692433408   1% /mnt/encStorage
     """
   
     if directoryToCheck is None:
       directoryToCheck = self.remoteDestinationDir
+    return self.remoteState.get("diskSpace", directoryToCheck, lambda: self._fetchDiskSpaceInfo(directoryToCheck))
+  
   
-    # carry out 'df -h' command
-    remoteCmd = self._assembleRemoteCommandList(f"df -h {directoryToCheck}")
+  def _fetchDiskSpaceInfo(self, directoryToCheck: str):
+    """
+    # Fetch 'df -B1' of a remote directory
+    :return:
+    """
+  
+    # carry out 'df -B1' command
+    remoteCmd = self._assembleRemoteCommandList(f"df -B1 {directoryToCheck}")
     cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
   
     # split result into lines
@@ -430,57 +559,260 @@ class RemoteOperations:
     else:
       diskInfo = [entry for entry in stdOutLines[1].split(" ") if entry != ""]
       return {
-        "filesystem": diskInfo[0],
-        "total": diskInfo[1],
-        "used": diskInfo[2]
+        "filesystem":     diskInfo[0],
+        "total":          LocalOperations.formatBytes(int(diskInfo[1])),
+        "used":           LocalOperations.formatBytes(int(diskInfo[2])),
+        "totalBytes":     int(diskInfo[1]),
+        "usedBytes":      int(diskInfo[2]),
+        "availableBytes": int(diskInfo[3])
       }
+  
+  
+  def zfsGetSpaceInfo(self):
+    """
+    # Exact space accounting of the ZFS pool, in bytes
+    #  -used and available are the root dataset's, which include its children;
+    #   usedbysnapshots is summed over every dataset, as each only counts its own
+    :return: (dict) used, available and usedbysnapshots, or None if not available
+    """
+    return self.remoteState.get("spaceInfo", self.zfsPoolName, self._fetchZFSSpaceInfo)
+  
+  
+  def _fetchZFSSpaceInfo(self):
+    """
+    # Fetch the space accounting of the ZFS pool's datasets
+    :return:
+    """
+  
+    """
+    encStorage       used             126701535232
+    encStorage       available        28379897856
+    encStorage       usedbysnapshots  3229614080
+    encStorage/docs  used             1048576
+    encStorage/docs  available        28379897856
+    encStorage/docs  usedbysnapshots  65536
+    """
+  
+    remoteCmd = self._assembleRemoteCommandList(
+      f"zfs get -Hp -r -t filesystem,volume -o name,property,value used,available,usedbysnapshots {self.zfsPoolName}")
+    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+  
+    spaceInfo = {}
+    for line in cmdOutput["stdout"].split("\n"):
+      fields = line.split()
+      if len(fields) != 3 or not fields[2].isdigit():
+        continue
+      if fields[1] == "usedbysnapshots":
+        spaceInfo["usedbysnapshots"] = spaceInfo.get("usedbysnapshots", 0) + int(fields[2])
+      elif fields[0] == self.zfsPoolName:
+        spaceInfo[fields[1]] = int(fields[2])
+  
+    # CHECK: got all the properties
+    if not all(key in spaceInfo for key in ["used", "available", "usedbysnapshots"]):
+      return None
+    
+    return {
+      "usedBytes":            spaceInfo["used"],
+      "availableBytes":       spaceInfo["available"],
+      "usedBySnapshotsBytes": spaceInfo["usedbysnapshots"]
+    }
     
     
-  def performRsync(self) -> bool:
+  def getTransferTarget(self, localSourceDir: str) -> tuple:
     """
-    # rsync local directory to remote directory using SSH
+    # What to copy from a source directory, and where to on the remote machine
+    #  -with a dataset per source directory, the directory's contents go into
+    #   its dataset's mountpoint
     #
-    :return:
+    :param localSourceDir: (str) local source directory
+    :return: (tuple) local source, as given to rsync, and remote directory, both unescaped
+    """
+    if not self.zfsDatasetPerSource:
+      return localSourceDir, self.configData["remoteDestinationDir"]
+    datasetDir = DatasetLayout.datasetName(self.zfsPoolName, localSourceDir).split("/", 1)[1]
+    return localSourceDir.rstrip(os.path.sep) + os.path.sep, \
+           os.path.join(self.configData["remoteDestinationDir"], datasetDir) + os.path.sep
+  
+  
+  def _rsyncDirectory(self, localSourceDir: str, extraArguments="", stopTime=None, largeFiles=None) -> dict:
+    """
+    # rsync a single local directory to the remote directory using SSH
+    #  -at <stopTime>, rsync is stopped with SIGTERM, keeping partially sent files
+    #
+    :param localSourceDir: (str) local directory to copy
+    :param extraArguments: (str) rsync arguments for this directory only
+    :param stopTime:       (float) unix time to stop by, or None to run to completion
+    :param largeFiles:     (function) source directory -> its (path, size) of at least largeFileBytes, e.g., from
+                           the pre-scan; only called once rsync is done, so it may wait on the scan; None to look for them
+    :return: (dict) the directory's log file, start and end times, large file results, the large files
+                    left unverified, and if it was stopped
     """
   
     # SSH string within rsync command
     sshStr = f"ssh -p {self.sshPort} -i {self.sshPrivateKey}"
+    
+    rsyncResult = {
+      "sourceDir": localSourceDir,
+      "logFile":   None,
+      "startTime": time.time(),
+      "endTime":   None,
+      "largeFiles": [],
+      "unverifiedFiles": [],
+      "stopped":   False
+    }
+    
+    # CHECK: still time to start
+    if stopTime is not None and time.time() >= stopTime:
+      logger.warning(f"rsync local directory: {localSourceDir}: not started, out of time")
+      rsyncResult["stopped"] = True
+      rsyncResult["endTime"] = rsyncResult["startTime"]
+      return rsyncResult
+    
+    # where the directory goes on the remote machine
+    transferSource, remoteDir = self.getTransferTarget(localSourceDir)
+    
+    # set up the log file
+    #  -written in a format the log index understands
+    if "--log-file=" in self.rsyncArguments:
+      logger.info("'log-file option specified in rsync arguments; skipping internal log file")
+      arguments = self.rsyncArguments
   
-    # run the rsync command for each source directory
-    for localSourceDir in self.localSourceDirectories:
+    else:
+      os.makedirs(self.rsyncLogDir, exist_ok=True)
+      logFilename = RsyncLogIndex.LOG_FILE_PREFIX + self.runName + "--" + localSourceDir.replace(os.path.sep, ".")
+      rsyncResult["logFile"] = os.path.join(self.rsyncLogDir, logFilename)
+      arguments = self.rsyncArguments + f" --log-file='{rsyncResult['logFile']}'" + \
+                  f" --log-file-format='{RsyncLogIndex.LOG_FILE_FORMAT}'"
     
-      # set up the log file
-      if "--log-file=" in self.rsyncArguments:
-        logger.info("'log-file option specified in rsync arguments; skipping internal log file")
-        arguments = self.rsyncArguments
+    if extraArguments:
+      arguments += " " + extraArguments
     
-      else:
-        currentDT = datetime.datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S")
-        logFilename = "rsync-log--" + currentDT + "--" + localSourceDir.replace(os.path.sep, ".")
-        arguments = self.rsyncArguments + f" --log-file='{logFilename}'"
+    # run the remote rsync at the configured priority
+    remoteRsyncPath = self.governor.remoteRsyncPath()
+    if remoteRsyncPath and "--rsync-path" not in arguments:
+      arguments += f' --rsync-path="{remoteRsyncPath}"'
+    
+    # keep whatever was sent of a file if rsync is stopped
+    if stopTime is not None and not re.search(r"--partial|--inplace|(^| )-[a-zA-Z]*P", arguments):
+      arguments += " --partial"
+    
+    # leave very large files to the multi-stream transfer
+    #  -by size, so rsync can start before they are listed
+    #  -files skipped for their size are also safe from --delete
+    if self.largeFileBytes > 0:
+      arguments += f" --max-size={self.largeFileBytes - 1}"
 
-      # escape any invalid characters in the directory name
-      #invalidChars = [" ", "(", ")"]
-      for invalidChar in RemoteOperations.CHARS_TO_ESCAPE:
-        localSourceDir = localSourceDir.replace(invalidChar, "\\"+invalidChar)
-      
-      logger.info(f"rsync local directory: {localSourceDir}")
-      rsyncCmd = ["rsync", arguments, "-e",
-                  f'"{sshStr}"',
-                  f"{localSourceDir}",
-                  f"{self.remoteUsername}@{self.remoteIP}:{self.remoteDestinationDir}"
-                  ]
-      cmdOutput = RemoteOperations.runCommand(rsyncCmd, basicCMD=False, outputToStdout=not self.rsyncLogOutput)
-    
-      # print the error output
-      logger.info(cmdOutput['stderr'])
-    
-      # print the rsync output to the log
-      if self.rsyncLogOutput:
-        logger.info(cmdOutput['stdout'])
-        # if not ("total size is" in cmdOutput['stdout'] and "speedup is" in cmdOutput['stdout']):
-        #  return False
+    # escape any invalid characters in the directory names
+    #invalidChars = [" ", "(", ")"]
+    escapedSource, escapedRemoteDir = transferSource, remoteDir
+    for invalidChar in RemoteOperations.CHARS_TO_ESCAPE:
+      escapedSource    = escapedSource.replace(invalidChar, "\\"+invalidChar)
+      escapedRemoteDir = escapedRemoteDir.replace(invalidChar, "\\"+invalidChar)
+    
+    logger.info(f"rsync local directory: {escapedSource}")
+    rsyncCmd = self.governor.wrapCommand(["rsync", arguments, "-e",
+                                          f'"{sshStr}"',
+                                          f"{escapedSource}",
+                                          f"{self.remoteUsername}@{self.remoteIP}:{escapedRemoteDir}"
+                                          ])
+    cmdOutput = RemoteOperations.runCommand(rsyncCmd, basicCMD=False, outputToStdout=not self.rsyncLogOutput,
+                                            timeout=None if stopTime is None else stopTime - time.time(),
+                                            onStart=self.governor.register)
+  
+    # print the error output
+    logger.info(cmdOutput['stderr'])
+    if cmdOutput["timedOut"]:
+      logger.warning(f"rsync local directory: {localSourceDir}: stopped, out of time")
+      rsyncResult["stopped"] = True
+  
+    # print the rsync output to the log
+    if self.rsyncLogOutput:
+      logger.info(cmdOutput['stdout'])
+      # if not ("total size is" in cmdOutput['stdout'] and "speedup is" in cmdOutput['stdout']):
+      #  return False
+    
+    # send the large files, one at a time, each over several streams
+    #  -a file grown past largeFileBytes since it was listed is left to the next run
+    if self.largeFileBytes <= 0:
+      largeFiles = []
+    elif largeFiles is None:
+      largeFiles = LocalOperations.findLargeFiles(localSourceDir, self.largeFileBytes)
+    else:
+      largeFiles = largeFiles(localSourceDir)
+    if len(largeFiles) > 0:
+      transfer = LargeFileTransfer(self._assembleSSHCommandList(), streams=self.largeFileStreams,
+                                   rangeBytes=self.largeFileRangeBytes, stopTime=stopTime,
+                                   throttle=self.governor.throttle)
+      for fileLoc, _ in largeFiles:
+        if stopTime is not None and time.time() >= stopTime:
+          rsyncResult["stopped"] = True
+          break
+        remoteLoc = os.path.join(remoteDir, LocalOperations.transferPath(transferSource, fileLoc))
+        try:
+          largeFileResult = transfer.transferFile(fileLoc, remoteLoc)
+        except (OSError, SystemError) as e:
+          logger.error(f"Large file: {fileLoc}: {e}")
+          rsyncResult["unverifiedFiles"].append(fileLoc)
+          continue
+        largeFileResult["path"] = LocalOperations.transferPath(transferSource, fileLoc)
+        rsyncResult["largeFiles"].append(largeFileResult)
+        if not largeFileResult["verified"]:
+          rsyncResult["unverifiedFiles"].append(fileLoc)
+        rsyncResult["stopped"] = rsyncResult["stopped"] or largeFileResult["stopped"]
+        logger.info(f"Large file: {fileLoc}: " + ("unchanged" if largeFileResult["skipped"] else
+                    f"{LocalOperations.formatBytes(largeFileResult['sentBytes'])} sent in "
+                    f"{largeFileResult['seconds']:.0f}s, verified: {largeFileResult['verified']}"))
+    
+    rsyncResult["endTime"] = time.time()
+    return rsyncResult
+
+
+  def performRsync(self, sourceDirs=None, extraArguments=None, stopTime=None, largeFiles=None) -> bool:
+    """
+    # rsync local directories to remote directory using SSH
+    #  -with rsyncOptions.parallelStreams > 1, several directories are copied at
+    #   once, started in the given order
+    #  -directories not started by <stopTime> are skipped, and those still
+    #   running are stopped
+    #
+    :param sourceDirs:     (list) directories to copy, in order; defaults to all source directories
+    :param extraArguments: (dict) source directory -> rsync arguments for that directory only
+    :param stopTime:       (float) unix time to stop by, or None to run to completion
+    :param largeFiles:     (function) source directory -> its large files, e.g., from the pre-scan;
+                           see _rsyncDirectory
+    :return:
+    """
   
+    if sourceDirs is None:
+      sourceDirs = self.localSourceDirectories
+    if extraArguments is None:
+      extraArguments = {}
+  
+    self.rsyncResults = []
+  
+    # run the rsync command for each source directory
+    if self.rsyncParallelStreams <= 1:
+      for localSourceDir in sourceDirs:
+        self.rsyncResults.append(self._rsyncDirectory(localSourceDir, extraArguments.get(localSourceDir, ""), stopTime,
+                                                      largeFiles))
+    
+    else:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.rsyncParallelStreams) as executor:
+        try:
+          for rsyncResult in executor.map(self._rsyncDirectory, sourceDirs,
+                                          [extraArguments.get(localSourceDir, "") for localSourceDir in sourceDirs],
+                                          [stopTime] * len(sourceDirs),
+                                          [largeFiles] * len(sourceDirs)):
+            self.rsyncResults.append(rsyncResult)
+        
+        # Ctrl-C only reaches this thread: don't start any more directories,
+        # and stop the running rsyncs so the executor can shut down
+        except KeyboardInterrupt:
+          executor.shutdown(wait=False, cancel_futures=True)
+          self.governor.terminateAll()
+          raise
+  
+    self.remoteState.invalidate("transfer")
     return True
 
 
@@ -500,6 +832,7 @@ class RemoteOperations:
     # wait for the command to finish, then close
     child.expect([pexpect.EOF])
     child.close()
+    self.remoteState.invalidate("openLUKS")
     
     # check that the container is now open
     return self.isLUKSContainerOpen()
@@ -512,6 +845,7 @@ class RemoteOperations:
     """
     remoteCmd = self._assembleRemoteCommandList(f"sudo cryptsetup luksClose /dev/mapper/{self.luksMountName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("closeLUKS")
     return not self.isLUKSContainerOpen()
   
   
@@ -524,6 +858,7 @@ class RemoteOperations:
     # send the "mount LUKS container" command via SSH
     remoteCmd = self._assembleRemoteCommandList(f"sudo mount /dev/mapper/{self.luksMountName} {self.remoteDestinationDir}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("mount")
     
     # did we mount the container to this location
     return self.isMountedDirectory(self.remoteDestinationDir)
@@ -538,6 +873,7 @@ class RemoteOperations:
     # send the "unmount LUKS container" command via SSH
     remoteCmd = self._assembleRemoteCommandList(f"sudo umount /dev/mapper/{self.luksMountName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("unmount")
   
     # did we unmount the container at this location
     return not self.isMountedDirectory(self.remoteDestinationDir)
@@ -558,6 +894,7 @@ class RemoteOperations:
     """
     remoteCmd = self._assembleRemoteCommandList(f"sudo zpool import {self.zfsPoolName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("import")
     return self.isZFSPoolOnline()
 
 
@@ -567,7 +904,8 @@ class RemoteOperations:
     :return:
     """
 
-    poolStatus = self._getZFSPoolStatus()
+    # fresh: a scrub may have been started from elsewhere since it was read
+    poolStatus = self._getZFSPoolStatus(fresh=True)
     
     # CHECK: pool is online
     if not poolStatus["isOnline"]:
@@ -581,9 +919,108 @@ class RemoteOperations:
     
     remoteCmd = self._assembleRemoteCommandList(f"sudo zpool export {self.zfsPoolName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("export")
     return not self.isZFSPoolOnline()
   
 
+  def zfsGetKeyStatus(self):
+    """
+    # Whether the encryption root's key is loaded
+    :return: (str) available or unavailable, or None if it isn't encrypted (or doesn't exist)
+    """
+    def _fetchKeyStatus():
+      remoteCmd = self._assembleRemoteCommandList(f"zfs get -H -o value keystatus {self.zfsEncryptionRoot}")
+      keyStatus = RemoteOperations.runCommand(remoteCmd, basicCMD=False)["stdout"].strip()
+      return keyStatus if keyStatus in ["available", "unavailable"] else None
+    return self.remoteState.get("keyStatus", self.zfsEncryptionRoot, _fetchKeyStatus)
+  
+  
+  def zfsLoadKey(self) -> bool:
+    """
+    # Load the encryption root's key, then mount the datasets it unlocks
+    #  -with a key file, the local file is piped to 'zfs load-key -L prompt',
+    #   which reads the key from stdin when it has no terminal; the key is
+    #   never written to the remote machine
+    #  -otherwise the datasets' own keylocation is used, e.g., file:///...
+    #   on the remote machine
+    :return:
+    """
+    
+    if self.zfsKeyFile:
+      loadCommand = f"sudo zfs load-key -L prompt {shlex.quote(self.zfsEncryptionRoot)}"
+      with open(self.zfsKeyFile, "rb") as keyFile:
+        ret = subprocess.run(self._assembleSSHCommandList() + [loadCommand], stdin=keyFile,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+      loadCommand = f"sudo zfs load-key -r {shlex.quote(self.zfsEncryptionRoot)}"
+      ret = subprocess.run(self._assembleSSHCommandList() + [loadCommand], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+      logger.error(f"zfsLoadKey: {ret.stderr.decode('utf-8').strip()}")
+    
+    # datasets whose key wasn't loaded at import weren't mounted
+    remoteCmd = self._assembleRemoteCommandList("sudo zfs mount -a")
+    RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("loadKey")
+    
+    self.zfsKeyLoaded = self.zfsGetKeyStatus() == "available"
+    return self.zfsKeyLoaded
+  
+  
+  def zfsUnloadKey(self) -> bool:
+    """
+    # Unmount the datasets under the encryption root and unload its key
+    #  -exporting the pool does this itself
+    :return:
+    """
+    
+    # unmount the children before their parents
+    remoteCmd  = self._assembleRemoteCommandList(f"zfs list -rH -o name {self.zfsEncryptionRoot}")
+    cmdOutput  = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    datasets   = sorted((line.strip() for line in cmdOutput["stdout"].split("\n") if line.strip() != ""), reverse=True)
+    commandStr = "; ".join([f"sudo zfs unmount {dataset}" for dataset in datasets] +
+                           [f"sudo zfs unload-key -r {self.zfsEncryptionRoot}"])
+    remoteCmd  = self._assembleRemoteCommandList(commandStr)
+    RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("unloadKey")
+    
+    self.zfsKeyLoaded = self.zfsGetKeyStatus() == "available"
+    return not self.zfsKeyLoaded
+  
+  
+  def zfsSendRaw(self, snapshotName: str, outputLoc: str, fromSnapshot=None) -> bool:
+    """
+    # Save a raw send stream of a snapshot to a local file
+    #  -raw (zfs send -w) streams of encrypted datasets stay encrypted, so
+    #   neither the key nor a loaded key is needed, and the stream can be
+    #   stored or received anywhere without exposing the data
+    #  -with a dataset per source directory, the child datasets are included (-R)
+    #
+    :param snapshotName: (str) <pool>@<name>
+    :param outputLoc:    (str) local file to write
+    :param fromSnapshot: (str) earlier snapshot, <pool>@<name>, for an incremental stream
+    :return:
+    """
+    
+    # CHECK: only send snapshots
+    if "@" not in snapshotName or (fromSnapshot is not None and "@" not in fromSnapshot):
+      raise SystemError(f"tried to send something that wasn't a snapshot: {snapshotName}, {fromSnapshot}")
+    
+    commandStr = "sudo zfs send -w" + (" -R" if self.zfsDatasetPerSource else "") + \
+                 ("" if fromSnapshot is None else f" -i {shlex.quote(fromSnapshot)}") + f" {shlex.quote(snapshotName)}"
+    
+    # write then rename, so a partial stream is never left under the real name
+    tempLoc = outputLoc + ".tmp"
+    with open(tempLoc, "wb") as f:
+      ret = subprocess.run(self._assembleSSHCommandList() + [commandStr], stdout=f, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+      logger.error(f"zfsSendRaw: zfs send failed: {ret.stderr.decode('utf-8').strip()}")
+      os.remove(tempLoc)
+      return False
+    os.replace(tempLoc, outputLoc)
+    return True
+  
+
   def scrubZFSPool(self, blocking=True) -> bool:
     """
     # Start a scrub of the ZFS pool
@@ -592,8 +1029,8 @@ class RemoteOperations:
     :return:
     """
     
-    # get full pool status
-    poolStatus = self._getZFSPoolStatus()
+    # get full pool status; fresh, as a scrub may have been started from elsewhere
+    poolStatus = self._getZFSPoolStatus(fresh=True)
     
     # CHECK: pool is online
     if not poolStatus["isOnline"]:
@@ -608,6 +1045,7 @@ class RemoteOperations:
     # perform the scrub
     remoteCmd = self._assembleRemoteCommandList(f"sudo zpool scrub {self.zfsPoolName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("scrub")
     
     # wait, if we want to wait
     if blocking:
@@ -616,9 +1054,47 @@ class RemoteOperations:
     return True
     
 
-  def zfsGetSnapshots(self) -> list:
+  def getZFSScrubInfo(self) -> dict:
+    """
+    # Scrub status of the ZFS pool: whether one is in progress, and the last completed one
+    :return:
+    """
+    return self._getZFSPoolStatus()["scrub"]
+  
+  
+  def waitForZFSScrub(self):
+    """
+    # Wait for any scrub in progress on the ZFS pool to complete
+    :return:
+    """
+    self._waitForZFSScrubToComplete()
+    
+
+  def _zfsSnapshotListing(self) -> str:
+    """
+    # Output of 'zfs list -t snapshot'
+    #  -one listing covers every dataset
+    :return:
+    """
+    remoteCmd = self._assembleRemoteCommandList("zfs list -t snapshot")
+    return self.remoteState.get(
+      "snapshots", self.zfsPoolName, lambda: RemoteOperations.runCommand(remoteCmd, basicCMD=False)["stdout"])
+
+
+  def zfsGetChildDatasets(self) -> list:
+    """
+    # Datasets below the pool's root dataset that have snapshots, e.g., one per source directory
+    :return: (list) of <pool>/<name>, sorted
+    """
+    snapshotNames = [line.split(" ")[0] for line in self._zfsSnapshotListing().split("\n")[1:]]
+    return sorted({name.split("@")[0] for name in snapshotNames if name.startswith(f"{self.zfsPoolName}/")})
+
+
+  def zfsGetSnapshots(self, datasetName=None) -> list:
     """
     # Get a list of all the snapshots for our pool
+    #
+    :param datasetName: (str) child dataset to list instead, <pool>/<name>
     :return:
     """
   
@@ -632,35 +1108,80 @@ class RemoteOperations:
     no datasets available
     """
   
-    # list the zfs snapshots
-    remoteCmd = self._assembleRemoteCommandList("zfs list -t snapshot")
-    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    snapshotListing = self._zfsSnapshotListing()
+    datasetName = datasetName or self.zfsPoolName
   
     # if no snapshots for our pool, or no snapshots at all
-    if self.zfsPoolName not in cmdOutput['stdout'] or \
-        "no datasets available" in cmdOutput['stdout']:
+    if datasetName not in snapshotListing or \
+        "no datasets available" in snapshotListing:
       return []
   
     # isolate just the snapshots for our pool, and separate the output lines
-    snapshotLines = [line for line in cmdOutput['stdout'].split("\n")[1:] if f"{self.zfsPoolName}@" in line]
+    snapshotLines = [line for line in snapshotListing.split("\n")[1:] if line.startswith(f"{datasetName}@")]
   
     # return just the name of the snapshots
     return [name.split(" ")[0] for name in snapshotLines]
   
   
-  def zfsCreateSnapshot(self) -> bool:
+  def zfsCreateSnapshot(self) -> str:
     """
     # Create a snapshot of the remote ZFS pool
-    :return:
+    #  -with a dataset per source directory, every dataset is snapshotted
+    #   atomically under the same name (zfs snapshot -r)
+    :return: (str) full name of the new snapshot
     """
     
     # snapshot name will just be <pool name>@datetime
     snapshotName = datetime.datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S")
-    commandStr = f"sudo zfs snapshot {self.zfsPoolName}@{snapshotName}"
+    recursiveFlag = "-r " if self.zfsDatasetPerSource else ""
+    commandStr = f"sudo zfs snapshot {recursiveFlag}{self.zfsPoolName}@{snapshotName}"
 
     remoteCmd = self._assembleRemoteCommandList(commandStr)
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
-    return True
+    self.remoteState.invalidate("snapshot")
+    return f"{self.zfsPoolName}@{snapshotName}"
+
+
+  def zfsStreamDiff(self, fromSnapshot: str, toSnapshot: str):
+    """
+    # Stream the output of 'zfs diff -H' between two snapshots, line by line
+    #  -lines are yielded as they arrive, so large diffs aren't held in memory
+    #  -with a dataset per source directory, each child dataset is diffed in
+    #   turn after the root; their paths are under their own mountpoints
+    #
+    :param fromSnapshot: (str) earlier snapshot, <pool>@<name>
+    :param toSnapshot:   (str) later snapshot, <pool>@<name>
+    :return: (generator) of output lines
+    """
+  
+    # CHECK: only diff snapshots
+    if "@" not in fromSnapshot or "@" not in toSnapshot:
+      raise SystemError(f"tried to diff something that wasn't a snapshot: {fromSnapshot}, {toSnapshot}")
+    
+    diffPairs = [(fromSnapshot, toSnapshot)]
+    if self.zfsDatasetPerSource:
+      fromName, toName = fromSnapshot.split("@")[1], toSnapshot.split("@")[1]
+      for datasetName in self.zfsGetChildDatasets():
+        datasetSnapshots = self.zfsGetSnapshots(datasetName)
+        if f"{datasetName}@{toName}" not in datasetSnapshots:
+          continue
+        
+        # a dataset created since has nothing to diff against
+        if f"{datasetName}@{fromName}" not in datasetSnapshots:
+          logger.warning(f"zfsStreamDiff: {datasetName} has no snapshot {fromName}, its changes aren't included")
+          continue
+        diffPairs.append((f"{datasetName}@{fromName}", f"{datasetName}@{toName}"))
+    
+    for diffFrom, diffTo in diffPairs:
+      remoteCmd = self._assembleRemoteCommandList(f"sudo zfs diff -H {diffFrom} {diffTo}")
+      process = subprocess.Popen(" ".join(remoteCmd), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      for line in process.stdout:
+        yield line.decode("utf-8", errors="replace")
+      
+      stdErr = process.stderr.read().decode("utf-8")
+      if process.wait() != 0:
+        logger.error(f"zfsStreamDiff: zfs diff failed: {stdErr}")
+        raise SystemError(f"zfs diff failed: {stdErr}")
 
 
   def zfsDestroySnapshot(self, snapshotName: str) -> bool:
@@ -678,7 +1199,244 @@ class RemoteOperations:
 
     remoteCmd = self._assembleRemoteCommandList(f"sudo zfs destroy {snapshotName}")
     RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    self.remoteState.invalidate("destroy")
     return True
   
 
-    
\ No newline at end of file
+    
+
+  def zfsGetMountpoint(self, datasetName=None):
+    """
+    # Get the mountpoint of the ZFS pool
+    #
+    :param datasetName: (str) child dataset to get the mountpoint of instead
+    :return: (str) mountpoint, or None if not available
+    """
+    remoteCmd = self._assembleRemoteCommandList(f"zfs get -H -o value mountpoint {datasetName or self.zfsPoolName}")
+    mountpoint = self.remoteState.get("mountpoint", datasetName or self.zfsPoolName,
+                                      lambda: RemoteOperations.runCommand(remoteCmd, basicCMD=False)["stdout"].strip())
+    if not mountpoint.startswith(os.path.sep):
+      return None
+    return mountpoint
+
+
+  def zfsGetSnapshotDir(self, snapshotName: str, datasetName=None):
+    """
+    # Remote location of the remote destination directory, as it was in the given snapshot
+    #  -snapshots are read through the hidden <mountpoint>/.zfs/snapshot/<name> directory
+    #
+    :param snapshotName: (str) <pool>@<name> or just <name>
+    :param datasetName:  (str) child dataset to locate the snapshot of instead, <pool>/<name>
+    :return:
+    """
+    
+    mountpoint = self.zfsGetMountpoint(datasetName)
+    if mountpoint is None:
+      logger.error("zfsGetSnapshotDir: could not get the pool mountpoint")
+      return None
+    
+    # a child dataset's snapshot holds exactly its source directory
+    if datasetName is not None:
+      return os.path.join(mountpoint, ".zfs", "snapshot", snapshotName.split("@")[-1]) + os.path.sep
+    
+    # CHECK: remote destination directory lives in the pool
+    destinationDir = self.configData["remoteDestinationDir"]
+    relativeDir = os.path.relpath(destinationDir, mountpoint)
+    if relativeDir.startswith(".."):
+      logger.error(f"zfsGetSnapshotDir: {destinationDir} is not within the pool mountpoint {mountpoint}")
+      return None
+    
+    snapshotDir = os.path.join(mountpoint, ".zfs", "snapshot", snapshotName.split("@")[-1], relativeDir)
+    return os.path.normpath(snapshotDir) + os.path.sep
+
+
+  def zfsEnsureDataset(self, datasetName: str, mountpoint: str, properties: dict) -> bool:
+    """
+    # Create a child dataset, or bring an existing one's properties up to date
+    #  -property changes only apply to data written from then on
+    #
+    :param datasetName: (str) <pool>/<name>
+    :param mountpoint:  (str) remote directory to mount the dataset on
+    :param properties:  (dict) property -> value, e.g., from DatasetLayout.chooseProperties
+    :return:
+    """
+    
+    remoteCmd = self._assembleRemoteCommandList(
+      f"zfs get -H -o property,value {','.join(properties.keys())} {datasetName}")
+    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    
+    # create it
+    if cmdOutput["returncode"] != 0:
+      
+      # CHECK: nothing already at the mountpoint
+      #  -e.g., files copied there before datasetPerSource was turned on,
+      #   which the new dataset would be mounted over
+      remoteCmd = self._assembleRemoteCommandList(
+        f"ls -A -- {RemoteOperations._escapeRemotePath(mountpoint)} 2>/dev/null | head -n 1")
+      if RemoteOperations.runCommand(remoteCmd, basicCMD=False)["stdout"].strip() != "":
+        logger.error(f"zfsEnsureDataset: {mountpoint} already has files in it, and would be hidden by the new "
+                     f"dataset {datasetName}. To move them into the dataset, on the remote machine:")
+        logger.error(f"  sudo mv {mountpoint} {mountpoint}.preDataset")
+        logger.error(f"  sudo zfs create -o mountpoint={mountpoint} {datasetName}")
+        logger.error(f"  sudo rsync -a {mountpoint}.preDataset/ {mountpoint}/ && sudo rm -r {mountpoint}.preDataset")
+        logger.error(f"then run the backup again, which sets the dataset's properties; or stop after the 'mv', "
+                     f"and let the backup create the dataset and send everything again")
+        return False
+      
+      escapedMountpoint = mountpoint
+      for invalidChar in RemoteOperations.CHARS_TO_ESCAPE:
+        escapedMountpoint = escapedMountpoint.replace(invalidChar, "\\" + invalidChar)
+      optionStr = " ".join(f"-o {name}={value}" for name, value in properties.items())
+      remoteCmd = self._assembleRemoteCommandList(
+        f"sudo zfs create -o mountpoint={escapedMountpoint} {optionStr} {datasetName}")
+      cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+      self.remoteState.invalidate("dataset")
+      if cmdOutput["returncode"] != 0:
+        logger.error(f"zfsEnsureDataset: could not create {datasetName}: {cmdOutput['stderr']}")
+        return False
+      return True
+    
+    # update any properties that have changed
+    currentProperties = dict(line.split("\t")[:2] for line in cmdOutput["stdout"].split("\n") if "\t" in line)
+    changed = [f"{name}={value}" for name, value in properties.items() if currentProperties.get(name) != value]
+    if len(changed) > 0:
+      remoteCmd = self._assembleRemoteCommandList(f"sudo zfs set {' '.join(changed)} {datasetName}")
+      cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+      if cmdOutput["returncode"] != 0:
+        logger.error(f"zfsEnsureDataset: could not set properties of {datasetName}: {cmdOutput['stderr']}")
+        return False
+    return True
+
+
+  @staticmethod
+  def _escapeRemotePath(path: str, keepGlob=False) -> str:
+    """
+    # Escape a path for the remote shell, within a command from _assembleRemoteCommandList
+    #  -every character but letters, digits and "/._-" is escaped with a backslash
+    #  -with <keepGlob>, "*?[]" are left for the remote shell to expand, as is
+    #   "!" or "^" right after "[", where it negates the set
+    #  -single quotes are then closed and reopened for the local shell, which
+    #   passes the whole remote command in single quotes
+    #
+    :param path:
+    :param keepGlob: (bool) leave glob characters unescaped
+    :return:
+    """
+    escapedPath = ""
+    for i, char in enumerate(path):
+      if char.isalnum() or char in "/._-" or \
+         (keepGlob and (char in "*?[]" or (char in "!^" and i > 0 and path[i - 1] == "["))):
+        escapedPath += char
+      else:
+        escapedPath += "\\" + char
+    return escapedPath.replace("'", "'\\''")
+
+
+  def listRemoteMatches(self, rootDir: str, pathPattern: str) -> list:
+    """
+    # List the paths under <rootDir> matching a glob pattern
+    #  -the remote shell expands the pattern, so only the directories named
+    #   in the pattern are read, not the whole tree
+    #
+    :param rootDir:     (str) remote directory the pattern is relative to
+    :param pathPattern: (str) glob pattern, e.g., "docs/*.txt"
+    :return: (list) matching paths, relative to <rootDir>
+    """
+    
+    remoteCmd = self._assembleRemoteCommandList(f"cd {RemoteOperations._escapeRemotePath(rootDir)} && "
+                                                f"ls -1d -- {RemoteOperations._escapeRemotePath(pathPattern, keepGlob=True)}")
+    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    return [line for line in cmdOutput["stdout"].split("\n") if line != ""]
+
+
+  def listRemoteDirectory(self, rootDir: str, relativeDir: str) -> list:
+    """
+    # List the entries of a remote directory, including hidden ones
+    #
+    :param rootDir:     (str) remote directory <relativeDir> is relative to
+    :param relativeDir: (str) directory to list
+    :return: (list) entry paths, relative to <rootDir>; empty if not a directory
+    """
+    
+    escapedDir = RemoteOperations._escapeRemotePath(os.path.join(rootDir, relativeDir))
+    remoteCmd = self._assembleRemoteCommandList(f"test -d {escapedDir} && ls -1A -- {escapedDir}")
+    cmdOutput = RemoteOperations.runCommand(remoteCmd, basicCMD=False)
+    return [os.path.join(relativeDir, line) for line in cmdOutput["stdout"].split("\n") if line != ""]
+
+
+  def performRestore(self, sourceRoot: str, relativePaths: list, destinationDir: str, streams=4) -> bool:
+    """
+    # rsync paths from the remote machine back to a local directory, using several
+    # rsync/SSH streams in parallel
+    #  -paths keep their position relative to <sourceRoot>
+    #
+    :param sourceRoot:     (str) remote directory the paths are relative to
+    :param relativePaths:  (list) paths to restore
+    :param destinationDir: (str) local directory to restore into
+    :param streams:        (int) number of parallel rsync streams
+    :return:
+    """
+    
+    sshStr = f"ssh -p {self.sshPort} -i {self.sshPrivateKey}"
+    
+    # rsync's "/./" marks where the relative path starts
+    #  -protect-args (-s) stops the remote shell splitting names with spaces
+    #  -a single stream shows rsync's own progress; with several, each reports
+    #   its byte counts (--stats) as it finishes, and the totals are logged
+    def _restorePath(relativePath: str) -> dict:
+      rsyncCmd = ["rsync", "-a", "-s", "--relative", "--partial"]
+      rsyncCmd.append("--info=progress2" if streams == 1 else "--stats")
+      rsyncCmd += ["-e", sshStr,
+                   f"{self.remoteUsername}@{self.remoteIP}:{sourceRoot.rstrip(os.path.sep)}/./{relativePath}",
+                   destinationDir]
+      return RemoteOperations.runCommand(rsyncCmd, basicCMD=True, outputToStdout=streams == 1)
+    
+    success = True
+    totalBytes = {"file": 0, "transferred": 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, streams)) as executor:
+      futureToPath = {executor.submit(_restorePath, path): path for path in relativePaths}
+      for i, future in enumerate(concurrent.futures.as_completed(futureToPath)):
+        cmdOutput = future.result()
+        if cmdOutput["returncode"] != 0:
+          logger.error(f"restore: {futureToPath[future]}: rsync exited with {cmdOutput['returncode']}: {cmdOutput['stderr']}")
+          success = False
+        elif cmdOutput["stderr"] != "":
+          logger.warning(f"restore: {futureToPath[future]}: {cmdOutput['stderr']}")
+        
+        # running totals over all streams, from each rsync's --stats
+        for kind, statName in [("file", "Total file size"), ("transferred", "Total transferred file size")]:
+          statMatch = re.search(rf"^{statName}: ([\d,]+) bytes", cmdOutput["stdout"], re.MULTILINE)
+          if statMatch is not None:
+            totalBytes[kind] += int(statMatch.group(1).replace(",", ""))
+        progressStr = "" if streams == 1 else \
+          f" ({LocalOperations.formatBytes(totalBytes['file'])} restored so far, " \
+          f"{LocalOperations.formatBytes(totalBytes['transferred'])} transferred)"
+        logger.info(f"Restored [{i+1}/{len(relativePaths)}]: {futureToPath[future]}{progressStr}")
+    
+    return success
+
+
+  def openChunkStore(self) -> ChunkStore:
+    """
+    # Start a chunk store session with the remote destination directory
+    #  -copies chunkStoreServer.py over first, so the remote side always
+    #   matches this version
+    #  -the whole session runs over this one SSH channel
+    #
+    :return:
+    """
+    
+    sshCmd = self._assembleSSHCommandList()
+    serverLoc = os.path.join(self.remoteDestinationDir, ChunkStore.SERVER_FILENAME)
+    
+    # copy the server script over
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "chunkStoreServer.py"), "rb") as f:
+      ret = subprocess.run(sshCmd + [f"mkdir -p {self.remoteDestinationDir} && cat > {serverLoc}"],
+                           stdin=f, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+      logger.error(f"openChunkStore: could not copy the chunk store server: {ret.stderr.decode('utf-8')}")
+      raise SystemError("could not copy the chunk store server to the remote machine")
+    
+    process = subprocess.Popen(sshCmd + [f"python3 -u {serverLoc} {self.remoteDestinationDir}"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return ChunkStore(process)
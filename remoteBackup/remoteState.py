@@ -0,0 +1,92 @@
+
+import copy
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RemoteState:
+  """
+  # Facts about the remote machine, fetched once per run
+  #  -each fact is a kind (e.g., poolStatus, diskSpace) and a key within it
+  #   (e.g., the pool or directory name)
+  #  -operations that change the remote machine invalidate just the kinds of
+  #   fact they can change, so the next read fetches them again
+  #  -hits and fetches are counted per kind
+  """
+
+  # kinds of fact
+  #  -poolStatus: from 'zpool status -p'
+  #  -luksOpen:   whether the LUKS mapping exists
+  #  -diskSpace:  from 'df -B1', per directory; also tells what is mounted where
+  #  -spaceInfo:  ZFS space accounting, from 'zfs get -Hp'
+  #  -snapshots:  ZFS snapshot names, per dataset
+  #  -mountpoint: ZFS mountpoints, per dataset
+  #  -keyStatus:  whether the ZFS encryption key is loaded
+  KINDS = ["poolStatus", "luksOpen", "diskSpace", "spaceInfo", "snapshots", "mountpoint", "keyStatus"]
+
+  # operation -> kinds of fact it can change
+  INVALIDATED_BY = {
+    "import":    ["poolStatus", "diskSpace", "spaceInfo", "snapshots", "mountpoint", "keyStatus"],
+    "export":    ["poolStatus", "diskSpace", "spaceInfo", "snapshots", "mountpoint", "keyStatus"],
+    "openLUKS":  ["luksOpen", "poolStatus"],
+    "closeLUKS": ["luksOpen", "poolStatus"],
+    "mount":     ["diskSpace"],
+    "unmount":   ["diskSpace"],
+    "loadKey":   ["keyStatus", "diskSpace"],
+    "unloadKey": ["keyStatus", "diskSpace"],
+    "dataset":   ["diskSpace", "spaceInfo", "snapshots", "mountpoint"],
+    "snapshot":  ["snapshots", "spaceInfo"],
+    "destroy":   ["snapshots", "spaceInfo", "diskSpace"],
+    "transfer":  ["diskSpace", "spaceInfo", "poolStatus"],
+    "scrub":     ["poolStatus"]
+  }
+
+
+  def __init__(self):
+    self.facts   = {}
+    self.hits    = {kind: 0 for kind in RemoteState.KINDS}
+    self.fetches = {kind: 0 for kind in RemoteState.KINDS}
+
+
+  def get(self, kind: str, key, fetch, fresh=False):
+    """
+    # A fact, fetched only if it isn't already known
+    #  -a copy is returned, so callers can't change the cached fact
+    #
+    :param kind:  (str) one of KINDS
+    :param key:   what the fact is about, e.g., the pool or directory name
+    :param fetch: (function) fetches the fact from the remote machine
+    :param fresh: (bool) fetch it even if known, e.g., to follow a scrub
+    :return:
+    """
+    if not fresh and (kind, key) in self.facts:
+      self.hits[kind] += 1
+      return copy.deepcopy(self.facts[(kind, key)])
+
+    self.fetches[kind] += 1
+    self.facts[(kind, key)] = fetch()
+    return copy.deepcopy(self.facts[(kind, key)])
+
+
+  def invalidate(self, operation: str):
+    """
+    # Forget the facts an operation can change
+    #
+    :param operation: (str) one of INVALIDATED_BY
+    :return:
+    """
+    kinds = RemoteState.INVALIDATED_BY[operation]
+    self.facts = {(kind, key): fact for (kind, key), fact in self.facts.items() if kind not in kinds}
+    logger.debug(f"RemoteState: {operation}: invalidated {', '.join(kinds)}")
+
+
+  def getStats(self) -> dict:
+    """
+    # Cache hits and fetches, in total and per kind of fact
+    :return:
+    """
+    return {
+      "hits":    sum(self.hits.values()),
+      "fetches": sum(self.fetches.values()),
+      "kinds":   {kind: {"hits": self.hits[kind], "fetches": self.fetches[kind]} for kind in RemoteState.KINDS}
+    }
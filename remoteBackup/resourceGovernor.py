@@ -0,0 +1,243 @@
+
+import os
+import signal
+import subprocess
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ResourceGovernor(threading.Thread):
+  """
+  # Keep backup work from getting in the way of other work on the source host
+  #  -lowers the CPU/IO priority of this process, which rsync and ssh inherit,
+  #   and can run rsync in a cgroup v2 slice through systemd-run
+  #  -watches the load average and I/O pressure (PSI), pausing transfer streams
+  #   one at a time (SIGSTOP) while over the limits, and resuming them
+  #   (SIGCONT) once back under
+  #  -work done within this process (hashing, chunking) waits at throttle()
+  #   while any stream is held
+  """
+
+  # seconds between pressure checks
+  CHECK_SECONDS = 5
+
+  # resume once pressure drops below this fraction of its limit
+  RESUME_FRACTION = 0.8
+
+  # ionice class names -> ionice -c values
+  IONICE_CLASSES = {"none": None, "best-effort": "2", "idle": "3"}
+
+  # I/O pressure file, on kernels with PSI
+  IO_PRESSURE_FILE = "/proc/pressure/io"
+
+
+  @staticmethod
+  def readLoadPerCPU() -> float:
+    """
+    # One minute load average, per CPU
+    :return:
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+  @staticmethod
+  def readIOPressure():
+    """
+    # Share of the last 10 seconds some task was stalled on I/O, in percent
+    #  -the "some avg10" figure of /proc/pressure/io
+    :return: (float) or None if PSI isn't available
+    """
+    try:
+      with open(ResourceGovernor.IO_PRESSURE_FILE, "r") as f:
+        for line in f:
+          if line.startswith("some "):
+            return float(dict(field.split("=") for field in line.split()[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+      return None
+    return None
+
+
+  @staticmethod
+  def _priorityCommand(niceLevel: int, ioniceClass: str) -> list:
+    """
+    # nice/ionice command prefix for the given priority
+    :return:
+    """
+    command = []
+    if niceLevel > 0:
+      command += ["nice", "-n", str(niceLevel)]
+    if ResourceGovernor.IONICE_CLASSES[ioniceClass] is not None:
+      command += ["ionice", "-c", ResourceGovernor.IONICE_CLASSES[ioniceClass]]
+    return command
+
+
+  def __init__(self, governorOptions: dict):
+    """
+    #
+    :param governorOptions: (dict) governorOptions from the config file
+    """
+    super().__init__(name="ResourceGovernor", daemon=True)
+    self.options = governorOptions
+
+    # transfer processes, each the leader of its own process group
+    self.processes = []
+    self.paused    = []
+    self.lock      = threading.Lock()
+
+    # clear while streams are held, for work within this process
+    self.clearToRun = threading.Event()
+    self.clearToRun.set()
+    self.stopEvent  = threading.Event()
+
+    # number of times a stream was paused
+    self.pauseCount = 0
+
+
+  def applyLocalPriority(self):
+    """
+    # Lower the CPU and I/O priority of this process
+    #  -call before starting other threads or processes, so they inherit it
+    :return:
+    """
+    if self.options["niceLevel"] > 0:
+      os.nice(self.options["niceLevel"])
+    ioniceClass = ResourceGovernor.IONICE_CLASSES[self.options["ioniceClass"]]
+    if ioniceClass is not None:
+      try:
+        ret = subprocess.run(["ionice", "-c", ioniceClass, "-p", str(os.getpid())],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if ret.returncode != 0:
+          logger.warning(f"applyLocalPriority: ionice failed: {ret.stderr.decode('utf-8')}")
+      except OSError as e:
+        logger.warning(f"applyLocalPriority: ionice not available: {e}")
+
+
+  def wrapCommand(self, cmdList: list) -> list:
+    """
+    # Run a command in the configured cgroup slice, with its CPU and IO weights
+    #
+    :param cmdList:
+    :return:
+    """
+    if not self.options["cgroupSlice"]:
+      return cmdList
+    wrapper = ["systemd-run", "--user", "--scope", "--quiet", f"--slice={self.options['cgroupSlice']}"]
+    if self.options["cpuWeight"] > 0:
+      wrapper += ["-p", f"CPUWeight={self.options['cpuWeight']}"]
+    if self.options["ioWeight"] > 0:
+      wrapper += ["-p", f"IOWeight={self.options['ioWeight']}"]
+    return wrapper + cmdList
+
+
+  def remoteRsyncPath(self) -> str:
+    """
+    # Value for rsync's --rsync-path, running the remote rsync at the configured priority
+    :return: (str) or "" to leave the remote priority alone
+    """
+    command = ResourceGovernor._priorityCommand(self.options["remoteNiceLevel"], self.options["remoteIoniceClass"])
+    return " ".join(command + ["rsync"]) if command else ""
+
+
+  def register(self, process):
+    """
+    # Add a transfer process to be paused and resumed
+    #
+    :param process: (subprocess.Popen) started in its own process group
+    :return:
+    """
+    with self.lock:
+      self.processes.append(process)
+
+
+  def throttle(self):
+    """
+    # Wait while transfer streams are held
+    :return:
+    """
+    self.clearToRun.wait()
+
+
+  def _signal(self, process, signalNumber) -> bool:
+    try:
+      os.killpg(process.pid, signalNumber)
+      return True
+    except (ProcessLookupError, PermissionError):
+      return False
+
+
+  def _overLimits(self, fraction=1.0) -> bool:
+    """
+    # Whether the load or I/O pressure is over <fraction> of its limit
+    :return:
+    """
+    if self.options["maxLoadPerCPU"] > 0 and \
+       ResourceGovernor.readLoadPerCPU() > fraction * self.options["maxLoadPerCPU"]:
+      return True
+    if self.options["maxIOPressure"] > 0:
+      ioPressure = ResourceGovernor.readIOPressure()
+      if ioPressure is not None and ioPressure > fraction * self.options["maxIOPressure"]:
+        return True
+    return False
+
+
+  def _check(self):
+    """
+    # Pause one more stream while over the limits, resume one once well under
+    :return:
+    """
+    with self.lock:
+      self.processes = [process for process in self.processes if process.poll() is None]
+      self.paused    = [process for process in self.paused if process.poll() is None]
+      running = [process for process in self.processes if process not in self.paused]
+
+      if self._overLimits():
+        self.clearToRun.clear()
+        if len(running) > 0 and self._signal(running[-1], signal.SIGSTOP):
+          self.paused.append(running[-1])
+          self.pauseCount += 1
+          logger.info(f"Resource governor: pressure over the limit, paused a stream ({len(self.paused)} paused)")
+
+      elif not self._overLimits(ResourceGovernor.RESUME_FRACTION):
+        if len(self.paused) > 0:
+          self._signal(self.paused.pop(), signal.SIGCONT)
+          logger.info(f"Resource governor: pressure back down, resumed a stream ({len(self.paused)} paused)")
+        if len(self.paused) == 0:
+          self.clearToRun.set()
+
+
+  def run(self):
+    if self.options["maxLoadPerCPU"] <= 0 and self.options["maxIOPressure"] <= 0:
+      return
+    if self.options["maxIOPressure"] > 0 and ResourceGovernor.readIOPressure() is None:
+      logger.warning("Resource governor: I/O pressure (PSI) not available; only the load average is watched")
+    while not self.stopEvent.wait(ResourceGovernor.CHECK_SECONDS):
+      self._check()
+
+
+  def terminateAll(self):
+    """
+    # Stop every registered transfer that is still running, e.g., on Ctrl-C
+    #  -they run in their own sessions, so the terminal's SIGINT doesn't reach them
+    :return:
+    """
+    with self.lock:
+      for process in self.processes:
+        if process.poll() is None:
+          self._signal(process, signal.SIGTERM)
+          self._signal(process, signal.SIGCONT)
+      self.paused = []
+    self.clearToRun.set()
+
+
+  def stop(self):
+    """
+    # Stop watching, and resume anything still paused
+    :return:
+    """
+    self.stopEvent.set()
+    with self.lock:
+      for process in self.paused:
+        self._signal(process, signal.SIGCONT)
+      self.paused = []
+    self.clearToRun.set()
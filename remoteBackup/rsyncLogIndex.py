@@ -0,0 +1,333 @@
+
+import os
+import re
+import gzip
+import shutil
+import sqlite3
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RsyncLogIndex:
+  """
+  # Searchable index of the files changed by each run, built from rsync log files
+  #  -stored in SQLite, with each path stored once and referenced by id
+  """
+
+  # name of the index database within the local state directory
+  INDEX_FILENAME = "rsyncLogIndex.sqlite"
+
+  # format we ask rsync to use when writing its log file
+  #  -itemized changes, file length, bytes transferred, file name (and symlink target)
+  LOG_FILE_FORMAT = "%i %l %b %n%L"
+
+  # prefix and date format of the log files we generate
+  LOG_FILE_PREFIX = "rsync-log--"
+  RUN_NAME_FORMAT = "%Y-%m-%d--%H-%M-%S"
+
+  # number of rows to insert at once when ingesting a log file
+  INSERT_BATCH_SIZE = 10000
+
+  # <date> <time> [<pid>] <itemize> [<length> <bytes>] <name>
+  LOG_LINE_REGEX = re.compile(r"^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[\d+\] (\S+) +(?:(\d+) (\d+) )?(.+)$")
+
+  # itemized change strings, e.g., ">f+++++++++", ".d..t......", "*deleting"
+  ITEMIZE_REGEX = re.compile(r"^([<>ch.][fdLDS][^ ]{7,9}|\*deleting)$")
+
+
+  @staticmethod
+  def parseLogLine(line: str):
+    """
+    # Parse a single line of an rsync log file
+    #  -returns None for lines that aren't a file change (e.g., "building file list")
+    #
+    :param line:
+    :return: (tuple) itemize, file length, bytes transferred, path
+    """
+
+    match = RsyncLogIndex.LOG_LINE_REGEX.match(line.rstrip("\n"))
+    if match is None:
+      return None
+
+    itemize, fileBytes, transferBytes, path = match.groups()
+    if not RsyncLogIndex.ITEMIZE_REGEX.match(itemize):
+      return None
+
+    # deletions are padded, e.g., "*deleting   dir/file"
+    path = path.strip()
+
+    # drop the symlink target
+    if itemize[1:2] == "L" and " -> " in path:
+      path = path.split(" -> ")[0]
+
+    return (
+      itemize,
+      None if fileBytes is None else int(fileBytes),
+      None if transferBytes is None else int(transferBytes),
+      path
+    )
+
+
+  @staticmethod
+  def runNameFromLogFilename(logFilename: str):
+    """
+    # Recover the run name (date and time) from one of our log filenames
+    #
+    :param logFilename:
+    :return:
+    """
+    baseName = os.path.basename(logFilename)
+    if not baseName.startswith(RsyncLogIndex.LOG_FILE_PREFIX):
+      return None
+    runName = baseName[len(RsyncLogIndex.LOG_FILE_PREFIX):][:len("YYYY-mm-dd--HH-MM-SS")]
+    try:
+      datetime.datetime.strptime(runName, RsyncLogIndex.RUN_NAME_FORMAT)
+    except ValueError:
+      return None
+    return runName
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory holding the index and archived logs
+    """
+    self.stateDir   = stateDir
+    self.logArchive = os.path.join(self.stateDir, "rsyncLogs")
+    os.makedirs(self.logArchive, exist_ok=True)
+
+    self.connection = sqlite3.connect(os.path.join(self.stateDir, RsyncLogIndex.INDEX_FILENAME))
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.executescript("""
+      CREATE TABLE IF NOT EXISTS runs (
+        runId        INTEGER PRIMARY KEY,
+        runName      TEXT NOT NULL,
+        sourceDir    TEXT,
+        logName      TEXT NOT NULL UNIQUE,
+        snapshotName TEXT,
+        fileCount    INTEGER,
+        totalBytes   INTEGER
+      );
+      CREATE TABLE IF NOT EXISTS paths (
+        pathId INTEGER PRIMARY KEY,
+        path   TEXT NOT NULL UNIQUE
+      );
+      CREATE TABLE IF NOT EXISTS changes (
+        runId         INTEGER NOT NULL,
+        pathId        INTEGER NOT NULL,
+        itemize       TEXT NOT NULL,
+        fileBytes     INTEGER,
+        transferBytes INTEGER
+      );
+      CREATE INDEX IF NOT EXISTS changesByPath ON changes (pathId);
+      CREATE INDEX IF NOT EXISTS changesByRun  ON changes (runId);
+      CREATE INDEX IF NOT EXISTS runsByName    ON runs (runName);
+    """)
+    self.connection.commit()
+
+
+  def close(self):
+    self.connection.close()
+
+
+  def _internPaths(self, paths: set) -> dict:
+    """
+    # Map each path to its id, adding any paths not yet in the index
+    #
+    :param paths:
+    :return:
+    """
+    self.connection.executemany("INSERT OR IGNORE INTO paths (path) VALUES (?)", ((p,) for p in paths))
+    pathIds = {}
+    pathList = list(paths)
+    for i in range(0, len(pathList), 500):
+      batch = pathList[i:i+500]
+      query = f"SELECT path, pathId FROM paths WHERE path IN ({','.join('?' * len(batch))})"
+      pathIds.update(self.connection.execute(query, batch).fetchall())
+    return pathIds
+
+
+  def _addRun(self, runName: str, sourceDir, logName: str, snapshotName, entries, totalBytes=None) -> dict:
+    """
+    # Add a run and its changes to the index
+    #
+    :param runName:      (str)
+    :param sourceDir:    (str) local source directory, or None
+    :param logName:      (str) unique name of what the changes came from
+    :param snapshotName: (str) snapshot taken after the run, if any
+    :param entries:      (iterable) of (itemize, file length, bytes transferred, path)
+    :param totalBytes:   (int) bytes transferred by the run, if not the sum over its entries
+    :return: (dict) number of changes and total bytes transferred
+    """
+
+    cursor = self.connection.execute(
+      "INSERT INTO runs (runName, sourceDir, logName, snapshotName) VALUES (?, ?, ?, ?)",
+      (runName, sourceDir, logName, snapshotName)
+    )
+    runId = cursor.lastrowid
+
+    fileCount  = 0
+    entryBytes = 0
+
+    def _insertBatch(batch):
+      pathIds = self._internPaths({entry[3] for entry in batch})
+      self.connection.executemany(
+        "INSERT INTO changes (runId, pathId, itemize, fileBytes, transferBytes) VALUES (?, ?, ?, ?, ?)",
+        ((runId, pathIds[path], itemize, fileBytes, transferBytes)
+         for itemize, fileBytes, transferBytes, path in batch)
+      )
+
+    batch = []
+    for entry in entries:
+      batch.append(entry)
+      fileCount  += 1
+      entryBytes += entry[2] or 0
+      if len(batch) >= RsyncLogIndex.INSERT_BATCH_SIZE:
+        _insertBatch(batch)
+        batch = []
+    if batch:
+      _insertBatch(batch)
+
+    totalBytes = entryBytes if totalBytes is None else totalBytes
+    self.connection.execute("UPDATE runs SET fileCount = ?, totalBytes = ? WHERE runId = ?",
+                            (fileCount, totalBytes, runId))
+    self.connection.commit()
+    return {"fileCount": fileCount, "totalBytes": totalBytes}
+
+
+  def ingestLogFile(self, logFileLoc: str, runName=None, sourceDir=None, snapshotName=None,
+                    retention="compress") -> dict:
+    """
+    # Add the file changes from an rsync log file to the index
+    #  -afterwards the raw log is compressed into the archive, deleted, or kept as-is
+    #
+    :param logFileLoc:   (str) rsync log file
+    :param runName:      (str) run the log belongs to; taken from the filename if None
+    :param sourceDir:    (str) local source directory the log was written for
+    :param snapshotName: (str) snapshot taken after the run, if any
+    :param retention:    (str) "compress", "delete" or "keep"
+    :return: (dict) number of changes and total bytes transferred
+    """
+
+    logName = os.path.basename(logFileLoc)
+    if runName is None:
+      runName = RsyncLogIndex.runNameFromLogFilename(logName) or logName
+
+    # CHECK: not already indexed
+    if self.connection.execute("SELECT 1 FROM runs WHERE logName = ?", (logName,)).fetchone() is not None:
+      logger.info(f"ingestLogFile: already indexed: {logName}")
+      return {"fileCount": 0, "totalBytes": 0}
+
+    with open(logFileLoc, "r", encoding="utf-8", errors="replace") as f:
+      indexInfo = self._addRun(runName, sourceDir, logName, snapshotName,
+                               (entry for entry in map(RsyncLogIndex.parseLogLine, f) if entry is not None))
+
+    # deal with the raw log now it's indexed
+    if retention == "compress":
+      with open(logFileLoc, "rb") as fIn, gzip.open(os.path.join(self.logArchive, logName + ".gz"), "wb") as fOut:
+        shutil.copyfileobj(fIn, fOut)
+      os.remove(logFileLoc)
+    elif retention == "delete":
+      os.remove(logFileLoc)
+
+    return indexInfo
+
+
+  def ingestTransfers(self, runName: str, transferName: str, entries: list, sourceDir=None, snapshotName=None,
+                      totalBytes=None) -> dict:
+    """
+    # Add changes sent outside rsync to the index, e.g., by the large file
+    # transfer or the chunk store, so they count as written too
+    #
+    :param runName:      (str) run they belong to
+    :param transferName: (str) what sent them, e.g., "largeFiles"
+    :param entries:      (list) of (itemize, file length, bytes transferred, path)
+    :param sourceDir:    (str) local source directory they came from, if any
+    :param snapshotName: (str) snapshot taken after the run, if any
+    :param totalBytes:   (int) bytes sent, if they can't be put down to each change,
+                         e.g., chunks shared between files
+    :return: (dict) number of changes and total bytes transferred
+    """
+    logName = f"{transferName}--{runName}" + ("" if sourceDir is None else f"--{sourceDir}")
+
+    # CHECK: not already indexed
+    if self.connection.execute("SELECT 1 FROM runs WHERE logName = ?", (logName,)).fetchone() is not None:
+      logger.info(f"ingestTransfers: already indexed: {logName}")
+      return {"fileCount": 0, "totalBytes": 0}
+
+    return self._addRun(runName, sourceDir, logName, snapshotName, entries, totalBytes=totalBytes)
+
+
+  def findRunsForPath(self, pathPattern: str) -> list:
+    """
+    # Which runs touched the given path
+    #  -supports glob patterns, e.g., "photos/2022/*"
+    #
+    :param pathPattern:
+    :return: (list) of dicts, oldest run first
+    """
+    operator = "GLOB" if any(c in pathPattern for c in "*?[") else "="
+    rows = self.connection.execute(f"""
+      SELECT runs.runName, runs.snapshotName, runs.sourceDir, paths.path,
+             changes.itemize, changes.fileBytes, changes.transferBytes
+      FROM paths
+      JOIN changes ON changes.pathId = paths.pathId
+      JOIN runs    ON runs.runId     = changes.runId
+      WHERE paths.path {operator} ?
+      ORDER BY runs.runName, paths.path
+    """, (pathPattern,)).fetchall()
+    return [RsyncLogIndex._rowToDict(row) for row in rows]
+
+
+  def findChangesForRun(self, runName: str) -> list:
+    """
+    # What changed in the given run
+    #  -matches on either the run name or the snapshot name
+    #
+    :param runName:
+    :return: (list) of dicts
+    """
+    if "@" in runName:
+      runName = runName.split("@")[1]
+    rows = self.connection.execute("""
+      SELECT runs.runName, runs.snapshotName, runs.sourceDir, paths.path,
+             changes.itemize, changes.fileBytes, changes.transferBytes
+      FROM runs
+      JOIN changes ON changes.runId = runs.runId
+      JOIN paths   ON paths.pathId  = changes.pathId
+      WHERE runs.runName = ? OR runs.snapshotName = ? OR runs.snapshotName LIKE ?
+      ORDER BY paths.path
+    """, (runName, runName, f"%@{runName}")).fetchall()
+    return [RsyncLogIndex._rowToDict(row) for row in rows]
+
+
+  def getRuns(self) -> list:
+    """
+    # Summary of every indexed run
+    :return:
+    """
+    rows = self.connection.execute("""
+      SELECT runName, snapshotName, sourceDir, fileCount, totalBytes
+      FROM runs ORDER BY runName, sourceDir
+    """).fetchall()
+    return [dict(zip(["runName", "snapshotName", "sourceDir", "fileCount", "totalBytes"], row)) for row in rows]
+
+
+  def getBytesTransferredSince(self, sinceTime: datetime.datetime) -> int:
+    """
+    # Total bytes sent by the runs started after the given time
+    #  -rsync logs, and the transfers added with ingestTransfers
+    #  -run names are UTC, so <sinceTime> must be too
+    #
+    :param sinceTime: (datetime) naive, in UTC
+    :return:
+    """
+    row = self.connection.execute("SELECT SUM(totalBytes) FROM runs WHERE runName >= ?",
+                                  (sinceTime.strftime(RsyncLogIndex.RUN_NAME_FORMAT),)).fetchone()
+    return row[0] or 0
+
+
+  @staticmethod
+  def _rowToDict(row) -> dict:
+    return dict(zip(["runName", "snapshotName", "sourceDir", "path", "itemize", "fileBytes", "transferBytes"], row))
@@ -0,0 +1,140 @@
+
+import os
+import json
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ScrubPolicy:
+  """
+  # Decide whether a backup should scrub the ZFS pool
+  #  -scrub when the last completed scrub is too old, or too much has been
+  #   written since
+  #  -completed scrubs are recorded, giving the pool's scrub throughput, so
+  #   long scrubs can be started without holding the backup
+  """
+
+  # name of the scrub history file within the local state directory
+  HISTORY_FILENAME = "scrubHistory.json"
+
+
+  def __init__(self, stateDir: str, maxAgeDays: int, maxBytesWritten: int, maxBlockingMinutes: int):
+    """
+    #
+    :param stateDir:           (str) local state directory
+    :param maxAgeDays:         (int) scrub once the last scrub is this old
+    :param maxBytesWritten:    (int) scrub once this much has been written since the last scrub; 0 to ignore
+    :param maxBlockingMinutes: (int) longest expected scrub to wait for, else it runs in the background; 0 to always wait
+    """
+    os.makedirs(stateDir, exist_ok=True)
+    self.historyFile        = os.path.join(stateDir, ScrubPolicy.HISTORY_FILENAME)
+    self.maxAge             = datetime.timedelta(days=maxAgeDays)
+    self.maxBytesWritten    = maxBytesWritten
+    self.maxBlockingMinutes = maxBlockingMinutes
+
+    self.history = []
+    if os.path.exists(self.historyFile):
+      with open(self.historyFile, "r") as f:
+        self.history = json.load(f)
+
+
+  def recordCompletedScrub(self, scrubInfo: dict, poolUsedBytes=None):
+    """
+    # Record a completed scrub, if not already recorded
+    #
+    :param scrubInfo:     (dict) the "scrub" entry of the pool status
+    :param poolUsedBytes: (int) bytes used in the pool when the scrub ran, to work out the scrub throughput
+    :return:
+    """
+
+    # CHECK: a completed scrub
+    if scrubInfo.get("completionTime") is None or scrubInfo.get("duration") is None:
+      return
+
+    completionTime = scrubInfo["completionTime"].isoformat()
+    if any(entry["completionTime"] == completionTime for entry in self.history):
+      return
+
+    self.history.append({
+      "completionTime":  completionTime,
+      "durationSeconds": scrubInfo["duration"].total_seconds(),
+      "errors":          scrubInfo.get("errors"),
+      "poolUsedBytes":   poolUsedBytes
+    })
+    self.history.sort(key=lambda entry: entry["completionTime"])
+
+    tempFile = self.historyFile + ".tmp"
+    with open(tempFile, "w") as f:
+      json.dump(self.history, f, indent=2)
+    os.replace(tempFile, self.historyFile)
+
+
+  def getThroughput(self):
+    """
+    # Average scrub throughput of the recorded scrubs, in bytes per second
+    :return: (float) or None if unknown
+    """
+    samples = [entry for entry in self.history if entry["poolUsedBytes"] and entry["durationSeconds"] > 0]
+    if len(samples) == 0:
+      return None
+    return sum(entry["poolUsedBytes"] for entry in samples) / sum(entry["durationSeconds"] for entry in samples)
+
+
+  def decide(self, scrubInfo: dict, bytesWrittenSince, poolUsedBytes=None, alwaysScrub=False) -> dict:
+    """
+    # Decide whether to scrub now, and whether to wait for it
+    #
+    :param scrubInfo:         (dict) the "scrub" entry of the pool status, with times in UTC
+    :param bytesWrittenSince: (function) bytes written since the given UTC datetime
+    :param poolUsedBytes:     (int) bytes used in the pool
+    :param alwaysScrub:       (bool) scrub regardless of age and bytes written
+    :return: (dict) scrub, blocking, reason and estimatedDuration
+    """
+
+    decision = {
+      "scrub":             False,
+      "blocking":          True,
+      "reason":            "",
+      "estimatedDuration": None
+    }
+
+    # CHECK: scrub already running
+    if scrubInfo.get("inProgress"):
+      decision["reason"] = "scrub already in progress"
+      return decision
+
+    # how long a scrub should take
+    throughput = self.getThroughput()
+    if throughput is not None and poolUsedBytes is not None:
+      decision["estimatedDuration"] = datetime.timedelta(seconds=int(poolUsedBytes / throughput))
+
+    # time and data since the last scrub
+    lastCompleted = scrubInfo.get("completionTime")
+    if alwaysScrub:
+      decision["scrub"]  = True
+      decision["reason"] = "scrubAfterBackup is set"
+    elif lastCompleted is None:
+      decision["scrub"]  = True
+      decision["reason"] = "no completed scrub found"
+    else:
+      scrubAge     = datetime.datetime.utcnow() - lastCompleted
+      bytesWritten = bytesWrittenSince(lastCompleted)
+      if scrubAge >= self.maxAge:
+        decision["scrub"]  = True
+        decision["reason"] = f"last scrub was {scrubAge.days} days ago"
+      elif self.maxBytesWritten > 0 and bytesWritten >= self.maxBytesWritten:
+        decision["scrub"]  = True
+        decision["reason"] = f"{bytesWritten} bytes written since the last scrub"
+      else:
+        decision["reason"] = f"last scrub {scrubAge.days} days ago, {bytesWritten} bytes written since"
+
+    # don't hold the backup for a long scrub
+    #  -a limit of 0 always waits
+    #  -without a duration estimate yet (e.g., the pool's first scrub), it
+    #   could be a long one, so it runs in the background too
+    if self.maxBlockingMinutes > 0 and (decision["estimatedDuration"] is None or
+       decision["estimatedDuration"] > datetime.timedelta(minutes=self.maxBlockingMinutes)):
+      decision["blocking"] = False
+
+    return decision
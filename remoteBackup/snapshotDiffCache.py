@@ -0,0 +1,240 @@
+
+import os
+import re
+import gzip
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SnapshotDiffCache:
+  """
+  # Local cache of the 'zfs diff' output between successive snapshots
+  #  -one gzipped file per snapshot, holding its changes since the previous snapshot
+  #  -differences between any two cached snapshots are composed from these, so
+  #   the pool doesn't need to be online to answer them
+  """
+
+  # name of the cache directory, and of its index, within the local state directory
+  CACHE_DIRNAME  = "snapshotDiffs"
+  INDEX_FILENAME = "index.json"
+
+  # zfs escapes each byte of a path that isn't printable ASCII, and spaces and
+  # backslashes, as \oooo, e.g., "\0040" for a space; a UTF-8 character
+  # outside ASCII is one escape per byte
+  ESCAPE_REGEX = re.compile(rb"\\([0-7]{3,4})")
+
+
+  @staticmethod
+  def _unescapePath(field: str) -> str:
+    """
+    # Path from its escaped form in 'zfs diff' output
+    #  -the escapes are decoded to bytes, and the whole path then as UTF-8;
+    #   bytes that aren't UTF-8 are kept as surrogates, as os.fsdecode does
+    #
+    :param field:
+    :return:
+    """
+    raw = SnapshotDiffCache.ESCAPE_REGEX.sub(lambda m: bytes([int(m.group(1), 8) & 0xff]),
+                                             field.encode("utf-8", "surrogateescape"))
+    return raw.decode("utf-8", "surrogateescape")
+
+
+  @staticmethod
+  def _escapePath(path: str) -> str:
+    """
+    # Path escaped as 'zfs diff' does, the reverse of _unescapePath
+    #
+    :param path:
+    :return:
+    """
+    return "".join(chr(byte) if 0x20 < byte < 0x7f and byte != ord("\\") else f"\\{byte:04o}"
+                   for byte in path.encode("utf-8", "surrogateescape"))
+
+
+  @staticmethod
+  def parseDiffLine(line: str):
+    """
+    # Parse a line of 'zfs diff -H' output
+    #  -"<change>\t<path>" or, for renames, "R\t<old path>\t<new path>"
+    #
+    :param line:
+    :return: (tuple) change type, path, new path (or None)
+    """
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) < 2 or fields[0] not in ["+", "-", "M", "R"]:
+      return None
+    paths = [SnapshotDiffCache._unescapePath(field) for field in fields[1:]]
+    return fields[0], paths[0], paths[1] if len(paths) > 1 else None
+
+
+  @staticmethod
+  def formatDiffLine(changeType: str, path: str, newPath=None) -> str:
+    """
+    # Format a change as a line of 'zfs diff -H' output, escaping as zfs does
+    #
+    :param changeType:
+    :param path:
+    :param newPath:
+    :return:
+    """
+    fields = [changeType, SnapshotDiffCache._escapePath(path)] + \
+             ([] if newPath is None else [SnapshotDiffCache._escapePath(newPath)])
+    return "\t".join(fields)
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory
+    """
+    self.cacheDir  = os.path.join(stateDir, SnapshotDiffCache.CACHE_DIRNAME)
+    self.indexFile = os.path.join(self.cacheDir, SnapshotDiffCache.INDEX_FILENAME)
+    os.makedirs(self.cacheDir, exist_ok=True)
+
+    # snapshot name -> name of the snapshot its diff starts from
+    self.index = {}
+    if os.path.exists(self.indexFile):
+      with open(self.indexFile, "r") as f:
+        self.index = json.load(f)
+
+
+  def _saveIndex(self):
+    tempFile = self.indexFile + ".tmp"
+    with open(tempFile, "w") as f:
+      json.dump(self.index, f, indent=2, sort_keys=True)
+    os.replace(tempFile, self.indexFile)
+
+
+  def _diffFile(self, snapshotName: str) -> str:
+    return os.path.join(self.cacheDir, snapshotName.replace("/", ".") + ".diff.gz")
+
+
+  def storeDiff(self, fromSnapshot: str, toSnapshot: str, diffLines) -> int:
+    """
+    # Store the diff between two successive snapshots
+    #  -written to a temporary file first, so a failed stream leaves no partial entry
+    #
+    :param fromSnapshot: (str) previous snapshot
+    :param toSnapshot:   (str) new snapshot
+    :param diffLines:    (iterable) lines of 'zfs diff -H' output
+    :return: (int) number of changes stored
+    """
+
+    diffFile = self._diffFile(toSnapshot)
+    tempFile = diffFile + ".tmp"
+
+    changeCount = 0
+    try:
+      with gzip.open(tempFile, "wt", encoding="utf-8") as f:
+        for line in diffLines:
+          if SnapshotDiffCache.parseDiffLine(line) is None:
+            continue
+          f.write(line.rstrip("\n") + "\n")
+          changeCount += 1
+    except Exception:
+      os.remove(tempFile)
+      raise
+
+    os.replace(tempFile, diffFile)
+    self.index[toSnapshot] = fromSnapshot
+    self._saveIndex()
+    return changeCount
+
+
+  def getCachedSnapshots(self) -> list:
+    """
+    # Snapshots with a cached diff, and the snapshot each diff starts from
+    :return: (list) of (from, to) tuples, ordered by snapshot name
+    """
+    return sorted([(fromSnapshot, toSnapshot) for toSnapshot, fromSnapshot in self.index.items()],
+                  key=lambda entry: entry[1])
+
+
+  def getDiff(self, fromSnapshot: str, toSnapshot: str) -> list:
+    """
+    # What changed between two snapshots, composed from the cached diffs
+    #  -changes are relative to <fromSnapshot>, e.g., a file added then removed
+    #   in between doesn't appear
+    #
+    :param fromSnapshot: (str) earlier snapshot
+    :param toSnapshot:   (str) later snapshot
+    :return: (list) of (change type, path, new path) tuples, ordered by path
+    """
+
+    # walk back from the later snapshot to the earlier one
+    chain = []
+    snapshotName = toSnapshot
+    while snapshotName != fromSnapshot:
+      if snapshotName not in self.index:
+        raise FileNotFoundError(f"No cached diff chain from {fromSnapshot} to {toSnapshot}; missing: {snapshotName}")
+      chain.append(snapshotName)
+      snapshotName = self.index[snapshotName]
+
+    # current path -> (change type, path it had in <fromSnapshot>)
+    changes = {}
+
+    for snapshotName in reversed(chain):
+      with gzip.open(self._diffFile(snapshotName), "rt", encoding="utf-8") as f:
+        for line in f:
+          changeType, path, newPath = SnapshotDiffCache.parseDiffLine(line)
+          previous = changes.get(path, None)
+
+          if changeType == "+":
+            changes[path] = ("M", path) if previous is not None and previous[0] == "-" else ("+", None)
+
+          elif changeType == "-":
+            if previous is None or previous[0] == "M":
+              changes[path] = ("-", path)
+            elif previous[0] == "+":
+              del changes[path]
+            elif previous[0] == "R":
+              del changes[path]
+              changes[previous[1]] = ("-", previous[1])
+
+          elif changeType == "M":
+            if previous is None:
+              changes[path] = ("M", path)
+
+          elif changeType == "R":
+            previous = changes.pop(path, None)
+            if previous is not None and previous[0] == "+":
+              changes[newPath] = ("+", None)
+            else:
+              changes[newPath] = ("R", path if previous is None else previous[1])
+
+    # back to (change type, path, new path)
+    diff = []
+    for path, (changeType, originalPath) in changes.items():
+      if changeType == "R":
+        diff.append(("R", originalPath, path))
+      else:
+        diff.append((changeType, path, None))
+    return sorted(diff, key=lambda entry: entry[1])
+
+
+  def pruneDiffs(self, keepSnapshots: list):
+    """
+    # Merge away the diffs of snapshots that have been destroyed
+    #  -keeps the chain unbroken for the snapshots that remain
+    #
+    :param keepSnapshots: (list) snapshots that still exist
+    :return:
+    """
+    for toSnapshot in keepSnapshots:
+      if toSnapshot not in self.index:
+        continue
+
+      # fold destroyed snapshots' diffs into their successor's
+      while self.index[toSnapshot] not in keepSnapshots and self.index[toSnapshot] in self.index:
+        mergedFrom = self.index[self.index[toSnapshot]]
+        merged = self.getDiff(mergedFrom, toSnapshot)
+        self.storeDiff(mergedFrom, toSnapshot, (SnapshotDiffCache.formatDiffLine(*entry) for entry in merged))
+
+    # drop the diffs of destroyed snapshots
+    for toSnapshot in list(self.index.keys()):
+      if toSnapshot not in keepSnapshots:
+        del self.index[toSnapshot]
+        if os.path.exists(self._diffFile(toSnapshot)):
+          os.remove(self._diffFile(toSnapshot))
+    self._saveIndex()
@@ -0,0 +1,191 @@
+
+import os
+import json
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TransferProfiles:
+  """
+  # Per-directory rsync transfer settings
+  #  -set in the config, or chosen automatically by sampling how well each
+  #   directory's files compress
+  #  -automatic choices are cached until the directory's content mix changes
+  """
+
+  # name of the cache file within the local state directory
+  CACHE_FILENAME = "transferProfiles.json"
+
+  # known profile settings
+  PROFILE_KEYS = ["compress", "compressLevel", "skipCompress", "inplace", "arguments"]
+
+  # bytes read from the start of each sampled file
+  SAMPLE_BYTES = 64 * 1024
+
+  # compressed/original size ratios
+  #  -above NO_COMPRESS_RATIO compression isn't worth the CPU
+  #  -suffixes above SKIP_COMPRESS_RATIO are added to rsync's skip-compress list
+  #  -below FAST_COMPRESS_RATIO the cheapest level already gives most of the gain
+  NO_COMPRESS_RATIO   = 0.9
+  SKIP_COMPRESS_RATIO = 0.95
+  FAST_COMPRESS_RATIO = 0.4
+
+  # share of the bytes in large files for rsync to update them in place
+  INPLACE_SHARE = 0.5
+
+  # how far the content mix can move (0 to 1) before re-sampling
+  MIX_CHANGE_THRESHOLD = 0.25
+
+
+  @staticmethod
+  def _contentMix(suffixBytes: dict) -> dict:
+    """
+    # Fraction of the bytes in each file suffix
+    #
+    :param suffixBytes: (dict) suffix -> bytes
+    :return:
+    """
+    totalBytes = sum(suffixBytes.values())
+    if totalBytes == 0:
+      return {}
+    return {suffix: numBytes / totalBytes for suffix, numBytes in suffixBytes.items()}
+
+
+  @staticmethod
+  def _mixChange(mixA: dict, mixB: dict) -> float:
+    """
+    # How different two content mixes are, from 0 (same) to 1 (nothing in common)
+    :return:
+    """
+    return sum(abs(mixA.get(suffix, 0) - mixB.get(suffix, 0)) for suffix in set(mixA) | set(mixB)) / 2
+
+
+  @staticmethod
+  def sampleCompressibility(sampleFiles: list) -> dict:
+    """
+    # Compress the start of each sampled file with a fast compressor (zlib level 1)
+    #
+    :param sampleFiles: (list) file paths
+    :return: (dict) suffix -> compressed/original size ratio
+    """
+    originalBytes   = {}
+    compressedBytes = {}
+    for fileLoc in sampleFiles:
+      try:
+        with open(fileLoc, "rb") as f:
+          data = f.read(TransferProfiles.SAMPLE_BYTES)
+      except OSError:
+        continue
+      if len(data) == 0:
+        continue
+      suffix = os.path.splitext(fileLoc)[1][1:].lower()
+      originalBytes[suffix]   = originalBytes.get(suffix, 0) + len(data)
+      compressedBytes[suffix] = compressedBytes.get(suffix, 0) + len(zlib.compress(data, 1))
+    return {suffix: min(1.0, compressedBytes[suffix] / originalBytes[suffix]) for suffix in originalBytes}
+
+
+  @staticmethod
+  def profileToArguments(profile: dict) -> str:
+    """
+    # rsync arguments for a profile, added after rsyncOptions.arguments
+    #
+    :param profile:
+    :return:
+    """
+    arguments = []
+    if profile.get("compress") is True:
+      arguments.append("--compress")
+      if profile.get("compressLevel") is not None:
+        arguments.append(f"--compress-level={profile['compressLevel']}")
+      if profile.get("skipCompress"):
+        arguments.append(f"--skip-compress={'/'.join(profile['skipCompress'])}")
+    elif profile.get("compress") is False:
+      arguments.append("--no-compress")
+    if profile.get("inplace"):
+      arguments.append("--inplace")
+    if profile.get("arguments"):
+      arguments.append(profile["arguments"])
+    return " ".join(arguments)
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory
+    """
+    os.makedirs(stateDir, exist_ok=True)
+    self.cacheFile = os.path.join(stateDir, TransferProfiles.CACHE_FILENAME)
+
+    # source directory -> {"contentMix", "profile"}
+    self.cache = {}
+    if os.path.exists(self.cacheFile):
+      with open(self.cacheFile, "r") as f:
+        self.cache = json.load(f)
+
+
+  def _save(self):
+    tempFile = self.cacheFile + ".tmp"
+    with open(tempFile, "w") as f:
+      json.dump(self.cache, f, indent=2, sort_keys=True)
+    os.replace(tempFile, self.cacheFile)
+
+
+  def _autoProfile(self, scanInfo: dict) -> dict:
+    """
+    # Choose a profile from the directory's sampled compressibility and size mix
+    #  -re-uses the cached choice while the content mix stays similar
+    #
+    :param scanInfo: (dict) from LocalOperations.scanSourceDirectory
+    :return:
+    """
+
+    sourceDir  = scanInfo["directory"]
+    contentMix = TransferProfiles._contentMix(scanInfo["suffixBytes"])
+
+    cached = self.cache.get(sourceDir, None)
+    if cached is not None and \
+       TransferProfiles._mixChange(cached["contentMix"], contentMix) < TransferProfiles.MIX_CHANGE_THRESHOLD:
+      return cached["profile"]
+
+    # overall ratio, weighting each suffix by its share of the bytes
+    #  -suffixes missing from the sample are assumed not to compress
+    suffixRatios = TransferProfiles.sampleCompressibility(scanInfo["sampleFiles"])
+    ratio = sum(share * suffixRatios.get(suffix, 1.0) for suffix, share in contentMix.items()) if contentMix else 1.0
+
+    profile = {"compress": ratio < TransferProfiles.NO_COMPRESS_RATIO}
+    if profile["compress"]:
+      profile["compressLevel"] = 1 if ratio < TransferProfiles.FAST_COMPRESS_RATIO else 6
+      profile["skipCompress"]  = sorted(suffix for suffix, suffixRatio in suffixRatios.items()
+                                        if suffix != "" and suffixRatio > TransferProfiles.SKIP_COMPRESS_RATIO)
+
+    # mostly large files, e.g., disk images: only rewrite the changed blocks
+    if scanInfo["totalBytes"] > 0 and \
+       scanInfo["largeFileBytes"] / scanInfo["totalBytes"] > TransferProfiles.INPLACE_SHARE:
+      profile["inplace"] = True
+
+    logger.debug(f"_autoProfile: {sourceDir}: compressed ratio {ratio:.2f}, profile {profile}")
+    self.cache[sourceDir] = {"contentMix": contentMix, "compressedRatio": ratio, "profile": profile}
+    self._save()
+    return profile
+
+
+  def chooseProfile(self, scanInfo: dict, configProfile=None, autoProfile=False) -> dict:
+    """
+    # Transfer profile for a source directory
+    #  -settings in the config win; any left out are chosen automatically when
+    #   <autoProfile> is on, or when any setting is "auto"
+    #
+    :param scanInfo:      (dict) from LocalOperations.scanSourceDirectory
+    :param configProfile: (dict) the directory's profile from the config, if any
+    :param autoProfile:   (bool) choose unset settings automatically
+    :return:
+    """
+    configProfile = configProfile or {}
+    autoProfile   = autoProfile or "auto" in configProfile.values()
+    configProfile = {key: value for key, value in configProfile.items() if value != "auto"}
+    if not autoProfile:
+      return configProfile
+    profile = dict(self._autoProfile(scanInfo))
+    profile.update(configProfile)
+    return profile
@@ -0,0 +1,193 @@
+
+import os
+import gzip
+import json
+import time
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+from localOperations import LocalOperations
+
+
+class TreeProfile:
+  """
+  # Profile of the local source directories: where the files and bytes are,
+  # and where they change
+  #  -built on the same scan as the backup's pre-scan
+  #  -totals are kept per subtree, SUBTREE_DEPTH levels below each source
+  #   directory, so successive profiles can be compared to find growth
+  #  -profiles are kept as gzipped JSON in the local state directory
+  """
+
+  # name of the profile directory within the local state directory
+  PROFILE_DIRNAME = "treeProfiles"
+
+  # number of profiles kept
+  PROFILE_LIMIT = 20
+
+  # depth below a source directory at which totals are kept per subtree
+  #  -shallower directories only count the files directly in them
+  SUBTREE_DEPTH = 3
+
+  # without a previous backup, files modified this recently count as changed
+  CHANGED_WINDOW = datetime.timedelta(days=7)
+
+  # directory names that usually hold caches or build output, rebuilt rather than restored
+  EXCLUDE_CANDIDATES = ["node_modules", "__pycache__", ".cache", ".tox", ".venv", ".gradle",
+                        ".npm", ".Trash", ".thumbnails", ".pytest_cache", ".mypy_cache"]
+
+  # subtrees of at least this many files, of this average size or smaller, are
+  # suggested for archiving or excluding, as rsync pays per file
+  TINY_FILES_MIN_COUNT = 100000
+  TINY_FILES_MAX_AVERAGE_BYTES = 16 * 1024
+
+
+  @staticmethod
+  def scanTree(sourceDirs: list, modifiedSince=None, threads=None) -> dict:
+    """
+    # Profile the source directories, with LocalOperations.scanSourceDirectory
+    #
+    :param sourceDirs:    (list) local source directories
+    :param modifiedSince: (dict) source directory -> unix timestamp after which
+                          files count as changed, e.g., its last backup
+    :param threads:       (int) scanner threads, default LocalOperations.SCAN_THREADS
+    :return: (dict) the profile
+    """
+
+    startTime = time.time()
+    modifiedSince = modifiedSince or {}
+    defaultCutOff = startTime - TreeProfile.CHANGED_WINDOW.total_seconds()
+
+    profile = {
+      "time":       datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+      "scanTime":   0.0,
+      "sourceDirs": {},
+      "subtrees":   {},
+      "candidates": []
+    }
+    for sourceDir in sourceDirs:
+      scanInfo = LocalOperations.scanSourceDirectory(sourceDir, modifiedSince=modifiedSince.get(sourceDir, defaultCutOff),
+                                                     threads=threads, subtreeDepth=TreeProfile.SUBTREE_DEPTH,
+                                                     candidateNames=TreeProfile.EXCLUDE_CANDIDATES)
+      profile["sourceDirs"][sourceDir] = {key: scanInfo[key] for key in ["fileCount", "totalBytes", "changedFileCount",
+                                                                         "changedBytes", "dirCount", "sizeHistogram",
+                                                                         "dirFileHistogram"]}
+      profile["sourceDirs"][sourceDir]["changedSince"] = scanInfo["modifiedSince"]
+      for path, totals in scanInfo["subtrees"].items():
+        profile["subtrees"][path] = dict(totals, sourceDir=sourceDir)
+      profile["candidates"] += [dict(totals, sourceDir=sourceDir, path=path) for path, totals in scanInfo["candidates"].items()]
+
+    profile["scanTime"] = time.time() - startTime
+    return profile
+
+
+  @staticmethod
+  def topSubtrees(profile: dict, key: str, count=10) -> list:
+    """
+    # Subtrees with the most of something
+    #
+    :param profile:
+    :param key:     (str) fileCount, totalBytes, changedFileCount or changedBytes
+    :param count:   (int) number to return
+    :return: (list) of (path, totals), largest first
+    """
+    ranked = sorted(profile["subtrees"].items(), key=lambda subtree: subtree[1][key], reverse=True)
+    return [(path, totals) for path, totals in ranked[:count] if totals[key] > 0]
+
+
+  @staticmethod
+  def suggestExcludes(profile: dict) -> list:
+    """
+    # rsync exclude patterns worth considering
+    #  -cache and build directories, by name, wherever they occur
+    #  -subtrees of very many small files, anchored to the transfer root
+    #
+    :param profile:
+    :return: (list) of dicts: pattern, reason, fileCount and totalBytes, most files first
+    """
+
+    suggestions = {}
+    for candidate in profile["candidates"]:
+      pattern = os.path.basename(candidate["path"]) + "/"
+      suggestion = suggestions.setdefault(pattern, {"pattern": pattern, "reason": "cache or build output",
+                                                    "fileCount": 0, "totalBytes": 0})
+      suggestion["fileCount"]  += candidate["fileCount"]
+      suggestion["totalBytes"] += candidate["totalBytes"]
+
+    for path, totals in profile["subtrees"].items():
+      if path == totals["sourceDir"] or totals["fileCount"] < TreeProfile.TINY_FILES_MIN_COUNT or \
+         totals["totalBytes"] > totals["fileCount"] * TreeProfile.TINY_FILES_MAX_AVERAGE_BYTES:
+        continue
+      if any(name in TreeProfile.EXCLUDE_CANDIDATES for name in path.split(os.path.sep)):
+        continue
+      pattern = "/" + LocalOperations.transferPath(totals["sourceDir"], path) + "/"
+      suggestions[pattern] = {"pattern": pattern, "reason": "many small files",
+                              "fileCount": totals["fileCount"], "totalBytes": totals["totalBytes"]}
+
+    return sorted((suggestion for suggestion in suggestions.values() if suggestion["fileCount"] > 0),
+                  key=lambda suggestion: suggestion["fileCount"], reverse=True)
+
+
+  @staticmethod
+  def diffProfiles(oldProfile: dict, newProfile: dict, count=10) -> dict:
+    """
+    # Growth between two profiles
+    #
+    :param oldProfile:
+    :param newProfile:
+    :param count:      (int) number of subtrees to return
+    :return: (dict) per source directory, and the subtrees that changed most
+                    (by bytes), as file count and byte changes
+    """
+    _change = lambda old, new: {"fileCount":  new.get("fileCount", 0) - old.get("fileCount", 0),
+                                "totalBytes": new.get("totalBytes", 0) - old.get("totalBytes", 0)}
+    sourceDirs = {sourceDir: _change(oldProfile["sourceDirs"].get(sourceDir, {}), sourceInfo)
+                  for sourceDir, sourceInfo in newProfile["sourceDirs"].items()}
+    subtrees = [(path, _change(oldProfile["subtrees"].get(path, {}), newProfile["subtrees"].get(path, {})))
+                for path in set(oldProfile["subtrees"]) | set(newProfile["subtrees"])]
+    subtrees = sorted((subtree for subtree in subtrees if subtree[1]["totalBytes"] != 0 or subtree[1]["fileCount"] != 0),
+                      key=lambda subtree: abs(subtree[1]["totalBytes"]), reverse=True)
+    return {"sourceDirs": sourceDirs, "subtrees": subtrees[:count]}
+
+
+  def __init__(self, stateDir: str):
+    """
+    #
+    :param stateDir: (str) local state directory
+    """
+    self.profileDir = os.path.join(stateDir, TreeProfile.PROFILE_DIRNAME)
+    os.makedirs(self.profileDir, exist_ok=True)
+
+
+  def getProfileNames(self) -> list:
+    """
+    # Saved profiles, oldest first
+    :return:
+    """
+    return sorted(name[:-len(".json.gz")] for name in os.listdir(self.profileDir) if name.endswith(".json.gz"))
+
+
+  def loadProfile(self, profileName: str) -> dict:
+    with gzip.open(os.path.join(self.profileDir, profileName + ".json.gz"), "rt", encoding="utf-8") as f:
+      return json.load(f)
+
+
+  def saveProfile(self, profile: dict) -> str:
+    """
+    # Save a profile, removing the oldest over PROFILE_LIMIT
+    #
+    :param profile:
+    :return: (str) name of the saved profile
+    """
+    profileName = "profile--" + profile["time"].replace("T", "--").replace(":", "-")
+    profileFile = os.path.join(self.profileDir, profileName + ".json.gz")
+    tempFile    = profileFile + ".tmp"
+    with gzip.open(tempFile, "wt", encoding="utf-8") as f:
+      json.dump(profile, f)
+    os.replace(tempFile, profileFile)
+
+    profileNames = self.getProfileNames()
+    for oldName in profileNames[:max(0, len(profileNames) - TreeProfile.PROFILE_LIMIT)]:
+      os.remove(os.path.join(self.profileDir, oldName + ".json.gz"))
+    return profileName
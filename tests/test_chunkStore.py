@@ -0,0 +1,186 @@
+
+import os
+import sys
+import random
+import hashlib
+import subprocess
+
+import pytest
+
+import chunkStore
+from chunkStore import ChunkStore
+
+
+SERVER_LOC = os.path.join(os.path.dirname(os.path.abspath(chunkStore.__file__)), "chunkStoreServer.py")
+
+
+def _randomBytes(numBytes: int, seed=0) -> bytes:
+  return random.Random(seed).getrandbits(8 * numBytes).to_bytes(numBytes, "little")
+
+
+@pytest.fixture
+def pythonCutPoints(monkeypatch):
+  """
+  # _findCutPoint without numpy, whether or not it is installed
+  """
+  monkeypatch.setattr(chunkStore, "numpy", None)
+
+
+@pytest.fixture
+def store(tmp_path):
+  """
+  # ChunkStore talking to a local chunkStoreServer.py, in place of one over SSH
+  """
+  process = subprocess.Popen([sys.executable, "-u", SERVER_LOC, str(tmp_path / "store")],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  client = ChunkStore(process)
+  yield client
+  client.close()
+
+
+def test_cut_point_short_data(pythonCutPoints):
+  data = _randomBytes(1000)
+  assert ChunkStore._findCutPoint(data, 0, len(data)) == len(data)
+  assert ChunkStore._findCutPoint(data, 200, len(data)) == 800
+
+
+def test_cut_point_bounds(pythonCutPoints):
+  data = _randomBytes(2 * ChunkStore.MAX_CHUNK_BYTES)
+  start = 0
+  while start < len(data):
+    cutPoint = ChunkStore._findCutPoint(data, start, len(data))
+    assert cutPoint <= ChunkStore.MAX_CHUNK_BYTES
+    assert cutPoint > ChunkStore.MIN_CHUNK_BYTES or start + cutPoint == len(data)
+    start += cutPoint
+
+
+def test_cut_point_of_uniform_data_is_the_maximum(pythonCutPoints):
+  data = bytes(ChunkStore.MAX_CHUNK_BYTES + 1000)
+  assert ChunkStore._findCutPoint(data, 0, len(data)) == ChunkStore.MAX_CHUNK_BYTES
+
+
+def test_vectorised_cut_points_match(monkeypatch):
+  pytest.importorskip("numpy")
+  data = _randomBytes(3 * ChunkStore.MAX_CHUNK_BYTES, seed=1) + bytes(ChunkStore.MAX_CHUNK_BYTES)
+  starts = [0, 12345, ChunkStore.MAX_CHUNK_BYTES, len(data) - ChunkStore.MAX_CHUNK_BYTES - 100,
+            len(data) - ChunkStore.MIN_CHUNK_BYTES - 1]
+  vectorised = [ChunkStore._findCutPoint(data, start, len(data)) for start in starts]
+  monkeypatch.setattr(chunkStore, "numpy", None)
+  assert [ChunkStore._findCutPoint(data, start, len(data)) for start in starts] == vectorised
+
+
+def test_chunkFile_concatenates_to_the_file(tmp_path):
+  data = _randomBytes(5 * ChunkStore.MAX_CHUNK_BYTES + 777, seed=2)
+  fileLoc = tmp_path / "data.bin"
+  fileLoc.write_bytes(data)
+  chunks = list(ChunkStore.chunkFile(str(fileLoc)))
+  assert b"".join(chunks) == data
+  assert all(len(chunk) <= ChunkStore.MAX_CHUNK_BYTES for chunk in chunks)
+  assert len(chunks) > 1
+
+
+def test_chunkFile_empty_file(tmp_path):
+  fileLoc = tmp_path / "empty"
+  fileLoc.write_bytes(b"")
+  assert list(ChunkStore.chunkFile(str(fileLoc))) == []
+
+
+def test_chunks_are_content_defined(tmp_path):
+  data = _randomBytes(4 * ChunkStore.MAX_CHUNK_BYTES, seed=3)
+  (tmp_path / "a").write_bytes(data)
+  (tmp_path / "b").write_bytes(b"inserted" + data)
+  digests = lambda name: [hashlib.sha256(chunk).digest() for chunk in ChunkStore.chunkFile(str(tmp_path / name))]
+  before, after = digests("a"), digests("b")
+  assert before[0] != after[0]
+  assert before[1:] == after[1:]
+
+
+def _makeTree(rootDir):
+  os.makedirs(os.path.join(rootDir, "sub", "deeper"))
+  os.makedirs(os.path.join(rootDir, "empty"))
+  with open(os.path.join(rootDir, "big.bin"), "wb") as f:
+    f.write(_randomBytes(3 * ChunkStore.MAX_CHUNK_BYTES, seed=4))
+  with open(os.path.join(rootDir, "sub", "small.txt"), "w") as f:
+    f.write("small file\n")
+  with open(os.path.join(rootDir, "sub", "deeper", "empty.txt"), "w"):
+    pass
+  os.symlink("sub/small.txt", os.path.join(rootDir, "link"))
+  os.chmod(os.path.join(rootDir, "sub", "small.txt"), 0o640)
+  os.chmod(os.path.join(rootDir, "empty"), 0o700)
+  os.utime(os.path.join(rootDir, "sub", "small.txt"), ns=(1_500_000_000_000_000_000, 1_500_000_000_000_000_000))
+  os.utime(os.path.join(rootDir, "empty"), ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+
+
+def _listTree(rootDir):
+  """
+  # Everything under a directory, with what a restore should preserve
+  :return: (dict) relative path -> (kind, mode, mtime, content or link target)
+  """
+  tree = {}
+  for dirLoc, dirNames, fileNames in os.walk(rootDir):
+    for name in dirNames + fileNames:
+      path = os.path.join(dirLoc, name)
+      pathStat = os.lstat(path)
+      if os.path.islink(path):
+        tree[os.path.relpath(path, rootDir)] = ("link", os.readlink(path))
+      elif os.path.isdir(path):
+        tree[os.path.relpath(path, rootDir)] = ("dir", pathStat.st_mode, pathStat.st_mtime_ns)
+      else:
+        with open(path, "rb") as f:
+          tree[os.path.relpath(path, rootDir)] = ("file", pathStat.st_mode, pathStat.st_mtime_ns, f.read())
+  return tree
+
+
+def test_backup_and_restore_round_trip(tmp_path, store):
+  sourceDir = str(tmp_path / "source")
+  _makeTree(sourceDir)
+  expected = _listTree(sourceDir)
+
+  stats = store.backupDirectories([sourceDir], "run1")
+  assert stats["fileCount"] == 4
+  assert stats["sentChunks"] > 1
+  assert store.listManifests() == ["run1"]
+
+  restoreDir = str(tmp_path / "restored")
+  restored = store.restoreFiles(store.getManifest("run1"), "source", restoreDir)
+  assert restored == 4
+  assert _listTree(os.path.join(restoreDir, "source")) == expected
+
+
+def test_restore_pattern(tmp_path, store):
+  sourceDir = str(tmp_path / "source")
+  _makeTree(sourceDir)
+  store.backupDirectories([sourceDir], "run1")
+
+  restoreDir = str(tmp_path / "restored")
+  assert store.restoreFiles(store.getManifest("run1"), "source/sub/small*", restoreDir) == 1
+  with open(os.path.join(restoreDir, "source", "sub", "small.txt")) as f:
+    assert f.read() == "small file\n"
+  assert not os.path.exists(os.path.join(restoreDir, "source", "big.bin"))
+
+
+def test_second_backup_reuses_unchanged_files(tmp_path, store):
+  sourceDir = str(tmp_path / "source")
+  _makeTree(sourceDir)
+  store.backupDirectories([sourceDir], "run1")
+
+  with open(os.path.join(sourceDir, "sub", "new.txt"), "w") as f:
+    f.write("new file\n")
+  stats = store.backupDirectories([sourceDir], "run2", previousManifest=store.getManifest("run1"))
+  assert stats["fileCount"] == 5
+  assert stats["unchangedFiles"] == 3
+  assert stats["sentChunks"] == 1
+  assert store.listManifests() == ["run1", "run2"]
+
+  restoreDir = str(tmp_path / "restored")
+  store.restoreFiles(store.getManifest("run2"), "source", restoreDir)
+  assert _listTree(os.path.join(restoreDir, "source")) == _listTree(sourceDir)
+
+
+def test_missingDigests(tmp_path, store):
+  sourceDir = str(tmp_path / "source")
+  _makeTree(sourceDir)
+  store.backupDirectories([sourceDir], "run1")
+  stored  = [bytes.fromhex(hexDigest) for fileInfo in store.getManifest("run1")["files"] for hexDigest in fileInfo["chunks"]]
+  unknown = hashlib.sha256(b"not stored").digest()
+  assert store.missingDigests(stored + [unknown]) == [unknown]
@@ -0,0 +1,89 @@
+
+import pytest
+
+from costModel import CostModel
+
+
+def _scanInfo(sourceDir="/data", fileCount=1000, changedBytes=0):
+  return {"directory": sourceDir, "fileCount": fileCount, "changedFileCount": fileCount, "changedBytes": changedBytes}
+
+
+def _record(costModel, sourceDir, startTime, fileCount, transferredBytes, seconds, largeFiles=()):
+  """
+  # Record a run that sent all of its changed bytes
+  """
+  scanInfo = _scanInfo(sourceDir, fileCount, transferredBytes)
+  rsyncResult = {"sourceDir": sourceDir, "startTime": startTime, "endTime": startTime + seconds,
+                 "largeFiles": list(largeFiles)}
+  indexInfo = {"totalBytes": transferredBytes, "fileCount": 10}
+  return costModel.recordRun(f"run{startTime}", scanInfo, costModel.predict(scanInfo), rsyncResult, indexInfo)
+
+
+def test_defaults_without_history(tmp_path):
+  prediction = CostModel(str(tmp_path)).predict(_scanInfo(fileCount=1000, changedBytes=CostModel.DEFAULT_THROUGHPUT))
+  assert prediction["bytes"] == CostModel.DEFAULT_THROUGHPUT
+  assert prediction["seconds"] == pytest.approx(1000 * CostModel.DEFAULT_SECONDS_PER_FILE + 1)
+
+
+def test_fit_recovers_both_costs(tmp_path):
+  costModel = CostModel(str(tmp_path))
+  # 0.001s per file, 1MB/s
+  for startTime, (fileCount, numBytes) in enumerate([(1000, 10 ** 6), (5000, 2 * 10 ** 6), (2000, 8 * 10 ** 6)]):
+    _record(costModel, "/data", startTime, fileCount, numBytes, 0.001 * fileCount + numBytes / 10 ** 6)
+  params = costModel._fitDirectory("/data")
+  assert params["secondsPerFile"] == pytest.approx(0.001)
+  assert params["throughput"] == pytest.approx(10 ** 6)
+  assert costModel.predict(_scanInfo("/data", 3000, 4 * 10 ** 6))["seconds"] == pytest.approx(7.0)
+
+
+def test_single_run_is_put_down_to_throughput(tmp_path):
+  costModel = CostModel(str(tmp_path))
+  _record(costModel, "/data", 0, 1000, 10 ** 6, 2.0)
+  params = costModel._fitDirectory("/data")
+  assert params["secondsPerFile"] == 0.0
+  assert params["throughput"] == pytest.approx(5 * 10 ** 5)
+
+
+def test_history_persists_and_is_capped(tmp_path):
+  costModel = CostModel(str(tmp_path))
+  for startTime in range(CostModel.HISTORY_LENGTH + 5):
+    _record(costModel, "/data", startTime, 1000, 10 ** 6, 1.0)
+  reloaded = CostModel(str(tmp_path))
+  assert len(reloaded.history["/data"]) == CostModel.HISTORY_LENGTH
+  assert reloaded.getLastRunTimes() == {"/data": CostModel.HISTORY_LENGTH + 4}
+
+
+def test_recordRun_counts_sent_large_files(tmp_path):
+  largeFiles = [{"sentBytes": 5000, "skipped": False}, {"sentBytes": 7000, "skipped": True}]
+  run = _record(CostModel(str(tmp_path)), "/data", 0, 1000, 1000, 1.0, largeFiles)
+  assert run["transferredBytes"] == 6000
+  assert run["transferredFiles"] == 11
+
+
+def test_predictWallTime():
+  predictions = [{"sourceDir": f"/data{i}", "bytes": 0, "seconds": seconds} for i, seconds in enumerate([5, 4, 3, 3])]
+  assert CostModel.predictWallTime(predictions, 1) == 15
+  assert CostModel.predictWallTime(predictions, 2) == 8
+  assert CostModel.predictWallTime(predictions, 8) == 5
+
+
+def test_fitToDeadline():
+  predictions = [{"sourceDir": f"/data{i}", "bytes": 0, "seconds": seconds} for i, seconds in enumerate([10, 6, 3])]
+  toRun, leftOut = CostModel.fitToDeadline(predictions, 1, secondsAvailable=9)
+  assert [prediction["sourceDir"] for prediction in toRun] == ["/data1", "/data2"]
+  assert [prediction["sourceDir"] for prediction in leftOut] == ["/data0"]
+
+  toRun, leftOut = CostModel.fitToDeadline(predictions, 1, secondsAvailable=10, priorities={"/data2": 1})
+  assert [prediction["sourceDir"] for prediction in toRun] == ["/data2", "/data1"]
+  assert [prediction["sourceDir"] for prediction in leftOut] == ["/data0"]
+
+
+def test_prediction_from_history_alone(tmp_path):
+  costModel = CostModel(str(tmp_path))
+  assert costModel.predictFromHistory("/data") == {"sourceDir": "/data", "bytes": 0, "files": 0, "seconds": 0}
+  _record(costModel, "/data", 0, 1000, 10 ** 6, 2.0)
+  _record(costModel, "/data", 1, 1000, 3 * 10 ** 6, 4.0)
+  prediction = costModel.predictFromHistory("/data")
+  assert prediction["bytes"] == 2 * 10 ** 6
+  assert prediction["files"] == 10
+  assert prediction["seconds"] == pytest.approx(3.0)
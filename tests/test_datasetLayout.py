@@ -0,0 +1,55 @@
+import os
+
+from datasetLayout import DatasetLayout
+
+
+def _scanInfo(tmp_path, files):
+  """
+  # Scan info for a directory holding <files>, all of them sampled
+  #  -files given as a size are created sparse, so they read as zeros
+  #
+  :param tmp_path:
+  :param files: (dict) file name -> content, or size
+  :return:
+  """
+  suffixBytes = {}
+  for name, data in files.items():
+    with open(tmp_path / name, "wb") as f:
+      if isinstance(data, int):
+        f.truncate(data)
+      else:
+        f.write(data)
+    suffix = os.path.splitext(name)[1][1:].lower()
+    suffixBytes[suffix] = suffixBytes.get(suffix, 0) + os.path.getsize(tmp_path / name)
+  return {"directory": str(tmp_path), "suffixBytes": suffixBytes, "sampleFiles": [str(tmp_path / name) for name in files]}
+
+
+def test_datasetName_replaces_characters_zfs_does_not_allow():
+  assert DatasetLayout.datasetName("pool", "/home/user/My Photos (2024)/") == "pool/My_Photos__2024_"
+  assert DatasetLayout.datasetName("pool", "/") == "pool/root"
+
+
+def test_random_write_files_get_a_small_recordsize(tmp_path):
+  properties = DatasetLayout.chooseProperties(_scanInfo(tmp_path, {"vm.qcow2": os.urandom(100000),
+                                                                   "notes.txt": os.urandom(10000)}))
+  assert properties["recordsize"] == "64K"
+  assert properties["atime"] == "off"
+
+
+def test_big_sequential_files_get_a_large_recordsize(tmp_path):
+  properties = DatasetLayout.chooseProperties(_scanInfo(tmp_path, {"a.mkv": 8 * 1024 * 1024, "b.mkv": 6 * 1024 * 1024,
+                                                                   "c.srt": 1000}))
+  assert properties["recordsize"] == "1M"
+
+
+def test_small_files_keep_the_default_recordsize(tmp_path):
+  properties = DatasetLayout.chooseProperties(_scanInfo(tmp_path, {f"{i}.txt": os.urandom(5000) for i in range(5)}))
+  assert properties["recordsize"] == "128K"
+
+
+def test_compression_level_follows_the_sampled_ratio(tmp_path):
+  assert DatasetLayout.chooseProperties(_scanInfo(tmp_path, {"a.jpg": os.urandom(50000)}))["compression"] == "zstd-1"
+  assert DatasetLayout.chooseProperties(_scanInfo(tmp_path, {"b.txt": b"hello world " * 5000}))["compression"] == "zstd-6"
+  # half of the bytes compress, half don't
+  assert DatasetLayout.chooseProperties(_scanInfo(tmp_path, {"c.csv": b"1,2,3\n" * 10000,
+                                                             "d.bin": os.urandom(60000)}))["compression"] == "zstd"
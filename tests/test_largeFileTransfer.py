@@ -0,0 +1,128 @@
+import os
+import hashlib
+
+from largeFileTransfer import LargeFileTransfer
+
+
+# run the "remote" commands in a local shell, in place of ssh
+LOCAL_SHELL = ["bash", "-c"]
+
+
+def _writeFile(fileLoc, data, mtime=None):
+  with open(fileLoc, "wb") as f:
+    f.write(data)
+  if mtime is not None:
+    os.utime(fileLoc, (mtime, mtime))
+
+
+def _read(fileLoc):
+  with open(fileLoc, "rb") as f:
+    return f.read()
+
+
+def test_verified_copy_replaces_the_remote_file(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote" / "local.img")
+  _writeFile(localLoc, os.urandom(10000), mtime=1000000)
+
+  result = LargeFileTransfer(LOCAL_SHELL, streams=2, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  assert result["verified"] and not result["skipped"]
+  assert _read(remoteLoc) == _read(localLoc)
+  assert int(os.stat(remoteLoc).st_mtime) == 1000000
+  assert not os.path.exists(LargeFileTransfer.partialLoc(remoteLoc))
+
+
+def test_unverified_copy_leaves_the_remote_file(tmp_path, monkeypatch):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  _writeFile(remoteLoc, b"old" * 3000)
+  _writeFile(localLoc, os.urandom(10000))
+
+  monkeypatch.setattr(LargeFileTransfer, "_remoteFileHash", lambda self, remoteLoc: "0" * 64)
+  result = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  assert not result["verified"]
+  assert _read(remoteLoc) == b"old" * 3000
+  assert _read(LargeFileTransfer.partialLoc(remoteLoc)) == _read(localLoc)
+
+
+def test_partial_copy_is_picked_up_by_the_next_run(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  data = os.urandom(4 * 4096)
+  _writeFile(localLoc, data, mtime=2000000)
+  _writeFile(remoteLoc, b"\0" * len(data), mtime=1000000)
+  # a stopped run got as far as the first three ranges
+  _writeFile(LargeFileTransfer.partialLoc(remoteLoc), data[:3 * 4096] + b"\0" * 4096)
+
+  result = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  assert result["verified"]
+  assert result["changedRanges"] == 1
+  assert _read(remoteLoc) == data
+
+
+def test_only_changed_ranges_are_sent(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  data = bytearray(os.urandom(8 * 4096))
+  _writeFile(remoteLoc, bytes(data), mtime=1000000)
+  data[2 * 4096 + 10] ^= 0xff
+  data[5 * 4096]      ^= 0xff
+  _writeFile(localLoc, bytes(data), mtime=2000000)
+
+  result = LargeFileTransfer(LOCAL_SHELL, streams=3, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  assert (result["rangeCount"], result["changedRanges"], result["sentBytes"]) == (8, 2, 2 * 4096)
+  assert result["verified"]
+  assert _read(remoteLoc) == bytes(data)
+
+
+def test_shorter_file_truncates_the_remote_copy(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  data = os.urandom(6 * 4096)
+  _writeFile(remoteLoc, data, mtime=1000000)
+  _writeFile(localLoc, data[:2 * 4096 + 100], mtime=2000000)
+
+  result = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  # only the last, now partial, range differs
+  assert (result["rangeCount"], result["changedRanges"], result["sentBytes"]) == (3, 1, 100)
+  assert _read(remoteLoc) == data[:2 * 4096 + 100]
+
+
+def test_longer_file_sends_the_new_ranges(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  data = os.urandom(5 * 4096)
+  _writeFile(remoteLoc, data[:2 * 4096], mtime=1000000)
+  _writeFile(localLoc, data, mtime=2000000)
+
+  result = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096).transferFile(localLoc, remoteLoc)
+  assert (result["changedRanges"], result["sentBytes"]) == (3, 3 * 4096)
+  assert _read(remoteLoc) == data
+
+
+def test_attributes_are_set_and_unchanged_files_skipped(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  _writeFile(localLoc, os.urandom(3 * 4096), mtime=1500000)
+  os.chmod(localLoc, 0o640)
+
+  transfer = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096)
+  assert transfer.transferFile(localLoc, remoteLoc)["verified"]
+  remoteStat = os.stat(remoteLoc)
+  assert (int(remoteStat.st_mtime), remoteStat.st_mode & 0o777) == (1500000, 0o640)
+
+  # same size and modification time: rsync's quick check
+  result = transfer.transferFile(localLoc, remoteLoc)
+  assert result["skipped"] and result["sentBytes"] == 0
+
+
+def test_stops_at_the_deadline(tmp_path):
+  localLoc, remoteLoc = str(tmp_path / "local.img"), str(tmp_path / "remote.img")
+  _writeFile(localLoc, os.urandom(3 * 4096))
+
+  result = LargeFileTransfer(LOCAL_SHELL, rangeBytes=4096, stopTime=0).transferFile(localLoc, remoteLoc)
+  assert result["stopped"] and not result["verified"]
+  assert result["sentBytes"] == 0
+  assert not os.path.exists(remoteLoc)
+
+
+def test_hashLocalRange_matches_sha256(tmp_path):
+  localLoc = str(tmp_path / "local.img")
+  data = os.urandom(10000)
+  _writeFile(localLoc, data)
+  assert LargeFileTransfer.hashLocalRange(localLoc, 100, 5000) == hashlib.sha256(data[100:5100]).hexdigest()
+  # a range running past the end stops at it
+  assert LargeFileTransfer.hashLocalRange(localLoc, 9000, 5000) == hashlib.sha256(data[9000:]).hexdigest()
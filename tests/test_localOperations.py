@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+
+from localOperations import LocalOperations, SourceScan
+
+
+def _makeTree(rootDir, files):
+  for relativePath, size in files.items():
+    fileLoc = os.path.join(rootDir, relativePath)
+    os.makedirs(os.path.dirname(fileLoc), exist_ok=True)
+    with open(fileLoc, "wb") as f:
+      f.write(b"x" * size)
+
+
+# relative path -> size
+TREE = {"a.txt": 100, "big.img": 5000, "docs/x.txt": 200, "docs/y.txt": 300, "docs/deep/z.txt": 400,
+        "docs/deep/deeper/w.txt": 500, "node_modules/pkg/m.js": 50}
+
+
+@pytest.fixture
+def sourceDir(tmp_path):
+  """
+  # Source directory holding TREE, with big.img and docs/x.txt modified since 2000
+  """
+  sourceDir = str(tmp_path / "src")
+  _makeTree(sourceDir, TREE)
+  for relativePath in TREE:
+    modifiedTime = 3000 if relativePath in ["big.img", "docs/x.txt"] else 1000
+    os.utime(os.path.join(sourceDir, relativePath), (modifiedTime, modifiedTime))
+  return sourceDir
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_scanSourceDirectory_totals(sourceDir, threads):
+  scanInfo = LocalOperations.scanSourceDirectory(sourceDir, modifiedSince=2000, largeFileListBytes=1000, threads=threads)
+  assert (scanInfo["fileCount"], scanInfo["totalBytes"]) == (7, 6550)
+  assert (scanInfo["changedFileCount"], scanInfo["changedBytes"]) == (2, 5200)
+  assert scanInfo["dirCount"] == 6
+  assert scanInfo["largeFiles"] == [(os.path.join(sourceDir, "big.img"), 5000)]
+  assert scanInfo["suffixBytes"] == {"txt": 1500, "img": 5000, "js": 50}
+  assert sum(count for count, _ in scanInfo["sizeHistogram"]) == 7
+  assert sum(numBytes for _, numBytes in scanInfo["sizeHistogram"]) == 6550
+  # files per directory: node_modules has none, the rest from 1 to 9
+  assert scanInfo["dirFileHistogram"][:3] == [1, 5, 0]
+  assert sorted(scanInfo["sampleFiles"]) == sorted(os.path.join(sourceDir, path) for path in TREE)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_scanSourceDirectory_subtrees_and_candidates(sourceDir, threads):
+  scanInfo = LocalOperations.scanSourceDirectory(sourceDir, threads=threads, subtreeDepth=2,
+                                                 candidateNames=["node_modules"])
+  subtrees = {os.path.relpath(path, sourceDir): (totals["fileCount"], totals["totalBytes"])
+              for path, totals in scanInfo["subtrees"].items()}
+  # anything deeper counts towards the subtree two levels down
+  assert subtrees == {".": (2, 5100), "docs": (2, 500), "docs/deep": (2, 900),
+                      "node_modules": (0, 0), "node_modules/pkg": (1, 50)}
+  assert {os.path.relpath(path, sourceDir): totals["fileCount"] for path, totals in scanInfo["candidates"].items()} == \
+    {"node_modules": 1}
+  # without a cut-off, every file has changed
+  assert scanInfo["changedFileCount"] == 7
+
+
+def test_findLargeFiles(sourceDir):
+  assert [(os.path.relpath(fileLoc, sourceDir), fileStat.st_size)
+          for fileLoc, fileStat in LocalOperations.findLargeFiles(sourceDir, 400)] == \
+    [("big.img", 5000), ("docs/deep/deeper/w.txt", 500), ("docs/deep/z.txt", 400)]
+
+
+def test_source_scan_result_per_directory(tmp_path, monkeypatch):
+  for name in ["first", "second"]:
+    _makeTree(str(tmp_path / name), {"small": 10, "big": 1000})
+
+  # hold the scan of the second directory, to show the first can be had without it
+  release = threading.Event()
+  scanSourceDirectory = LocalOperations.scanSourceDirectory
+  def _scan(dirLoc, **kwargs):
+    if dirLoc.endswith("second"):
+      release.wait(5)
+    return scanSourceDirectory(dirLoc, **kwargs)
+  monkeypatch.setattr(LocalOperations, "scanSourceDirectory", staticmethod(_scan))
+
+  sourceScan = SourceScan([str(tmp_path / "first"), str(tmp_path / "second")], largeFileListBytes=100)
+  sourceScan.start()
+  first = sourceScan.getResult(str(tmp_path / "first"))
+  assert [os.path.basename(fileLoc) for fileLoc, _ in first["largeFiles"]] == ["big"]
+  assert sourceScan.is_alive()
+
+  release.set()
+  assert [scanInfo["directory"] for scanInfo in sourceScan.getResults()] == [str(tmp_path / "first"),
+                                                                             str(tmp_path / "second")]
+  assert sourceScan.waitTime >= 0.0
+
+
+def test_source_scan_error_reaches_waiters(tmp_path, monkeypatch):
+  def _scan(dirLoc, **kwargs):
+    raise RuntimeError("scan failed")
+  monkeypatch.setattr(LocalOperations, "scanSourceDirectory", staticmethod(_scan))
+
+  sourceScan = SourceScan([str(tmp_path)])
+  sourceScan.start()
+  with pytest.raises(RuntimeError, match="scan failed"):
+    sourceScan.getResult(str(tmp_path))
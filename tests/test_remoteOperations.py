@@ -0,0 +1,312 @@
+
+import os
+import time
+import shlex
+import subprocess
+
+import pytest
+
+import remoteOperations
+from remoteOperations import RemoteOperations
+from remoteState import RemoteState
+from resourceGovernor import ResourceGovernor
+
+
+class _InterruptedPopen(subprocess.Popen):
+  """
+  # Popen whose first wait for the command is interrupted, as by Ctrl-C
+  """
+  started = []
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.interrupted = False
+    _InterruptedPopen.started.append(self)
+
+  def communicate(self, *args, **kwargs):
+    if not self.interrupted:
+      self.interrupted = True
+      raise KeyboardInterrupt()
+    return super().communicate(*args, **kwargs)
+
+
+@pytest.fixture
+def interruptedPopen(monkeypatch):
+  _InterruptedPopen.started = []
+  monkeypatch.setattr(remoteOperations.subprocess, "Popen", _InterruptedPopen)
+  return _InterruptedPopen
+
+
+def test_runCommand_output():
+  result = RemoteOperations.runCommand(["echo", "out;", "echo", "err", ">&2;", "exit", "3"], basicCMD=False)
+  assert (result["stdout"], result["stderr"], result["returncode"], result["timedOut"]) == ("out\n", "err\n", 3, False)
+
+
+def test_runCommand_timeout():
+  startTime = time.time()
+  result = RemoteOperations.runCommand(["sleep", "30"], basicCMD=False, timeout=0.5)
+  assert result["timedOut"]
+  assert time.time() - startTime < 10
+
+
+@pytest.mark.parametrize("options", [{}, {"timeout": 60}, {"onStart": lambda process: None}])
+def test_runCommand_interrupt_stops_the_command(interruptedPopen, options):
+  startTime = time.time()
+  with pytest.raises(KeyboardInterrupt):
+    RemoteOperations.runCommand(["sleep", "30"], basicCMD=False, **options)
+  assert interruptedPopen.started[0].returncode is not None
+  assert time.time() - startTime < 10
+
+
+SNAPSHOT_LISTING = """NAME                              USED  AVAIL     REFER  MOUNTPOINT
+backup@2022-08-01--01-00-00          0B      -       96K  -
+backup@2022-08-02--01-00-00          0B      -       96K  -
+backup/docs@2022-08-01--01-00-00     0B      -       96K  -
+backup/docs@2022-08-02--01-00-00     0B      -       96K  -
+backup/photos@2022-08-02--01-00-00   0B      -       96K  -
+"""
+
+
+@pytest.fixture
+def remoteOps(monkeypatch):
+  """
+  # RemoteOperations for a pool with a dataset per source directory, with the
+  # remote commands run by a local shell
+  """
+  ops = RemoteOperations.__new__(RemoteOperations)
+  ops.zfsPoolName = "backup"
+  ops.zfsDatasetPerSource = True
+  ops.remoteState = RemoteState()
+  ops.commands = []
+
+  def _assembleRemoteCommandList(command):
+    ops.commands.append(command)
+    return ["printf", "'%s\\n'", shlex.quote(command)]
+  monkeypatch.setattr(ops, "_assembleRemoteCommandList", _assembleRemoteCommandList)
+  ops.remoteState.get("snapshots", "backup", lambda: SNAPSHOT_LISTING)
+  return ops
+
+
+def test_zfsGetChildDatasets(remoteOps):
+  assert remoteOps.zfsGetChildDatasets() == ["backup/docs", "backup/photos"]
+  assert remoteOps.zfsGetSnapshots("backup/photos") == ["backup/photos@2022-08-02--01-00-00"]
+
+
+def test_zfsStreamDiff_diffs_each_dataset(remoteOps):
+  lines = list(remoteOps.zfsStreamDiff("backup@2022-08-01--01-00-00", "backup@2022-08-02--01-00-00"))
+  # photos has no earlier snapshot to diff against
+  assert lines == ["sudo zfs diff -H backup@2022-08-01--01-00-00 backup@2022-08-02--01-00-00\n",
+                   "sudo zfs diff -H backup/docs@2022-08-01--01-00-00 backup/docs@2022-08-02--01-00-00\n"]
+
+
+def test_zfsGetSpaceInfo_sums_snapshot_usage(remoteOps, monkeypatch):
+  output = "\n".join(["backup\tused\t1000", "backup\tavailable\t9000", "backup\tusedbysnapshots\t10",
+                      "backup/docs\tused\t600", "backup/docs\tavailable\t9000", "backup/docs\tusedbysnapshots\t200",
+                      "backup/photos\tused\t300", "backup/photos\tusedbysnapshots\t50"])
+  monkeypatch.setattr(RemoteOperations, "runCommand", staticmethod(lambda *args, **kwargs: {"stdout": output}))
+  assert remoteOps.zfsGetSpaceInfo() == {"usedBytes": 1000, "availableBytes": 9000, "usedBySnapshotsBytes": 260}
+  assert "-r" in remoteOps.commands[-1].split()
+
+
+@pytest.fixture
+def localShellOps(monkeypatch):
+  """
+  # RemoteOperations running its "remote" commands in a local shell, quoted as for ssh
+  """
+  ops = RemoteOperations.__new__(RemoteOperations)
+  monkeypatch.setattr(ops, "_assembleRemoteCommandList", lambda command: ["bash", "-c", f"'{command}'"])
+  return ops
+
+
+NASTY_NAMES = ["plain", "with space", "semi;colon", "dollar$HOME", "quote'd", "amp&er", "back`tick`", "star*"]
+
+
+def test_escapeRemotePath_survives_both_shells(localShellOps, tmp_path):
+  for name in NASTY_NAMES:
+    (tmp_path / name).write_text(name)
+  for name in NASTY_NAMES:
+    path = str(tmp_path / name)
+    result = RemoteOperations.runCommand(localShellOps._assembleRemoteCommandList(
+      f"cat -- {RemoteOperations._escapeRemotePath(path)}"), basicCMD=False)
+    assert result["stdout"] == name
+
+
+def test_listRemoteMatches_keeps_globs(localShellOps, tmp_path):
+  for name in ["a.txt", "b.txt", "c.log"]:
+    (tmp_path / name).write_text(name)
+  assert localShellOps.listRemoteMatches(str(tmp_path), "*.txt") == ["a.txt", "b.txt"]
+  assert localShellOps.listRemoteMatches(str(tmp_path), "[!a].txt") == ["b.txt"]
+
+
+def test_listRemoteDirectory_does_not_run_names(localShellOps, tmp_path):
+  rootDir = tmp_path / "root"
+  for name in NASTY_NAMES:
+    (rootDir / name).mkdir(parents=True)
+    (rootDir / name / "file").write_text("")
+  (rootDir / "a").mkdir()
+  for name in NASTY_NAMES:
+    assert localShellOps.listRemoteDirectory(str(rootDir), name) == [f"{name}/file"]
+  assert localShellOps.listRemoteDirectory(str(rootDir), f"a;touch {tmp_path}/pwned") == []
+  assert not (tmp_path / "pwned").exists()
+
+
+@pytest.fixture
+def rsyncOps(monkeypatch, tmp_path):
+  """
+  # RemoteOperations whose rsync commands are recorded rather than run
+  #  -each command "runs" for the seconds in ops.rsyncSeconds, if any, and
+  #   times out if that runs past its timeout
+  """
+  ops = RemoteOperations.__new__(RemoteOperations)
+  ops.configData = {"remoteDestinationDir": "/backup"}
+  ops.remoteUsername, ops.remoteIP, ops.sshPort, ops.sshPrivateKey = "user", "host", 22, "key"
+  ops.localSourceDirectories = ["/data0", "/data1"]
+  ops.rsyncArguments = "-a"
+  ops.rsyncLogOutput = False
+  ops.rsyncLogDir    = str(tmp_path / "rsyncLogs")
+  ops.rsyncParallelStreams = 1
+  ops.largeFileBytes = 0
+  ops.zfsDatasetPerSource = False
+  ops.runName     = "run"
+  ops.remoteState = RemoteState()
+  ops.governor    = ResourceGovernor({"niceLevel": 0, "ioniceClass": "none", "cgroupSlice": "", "cpuWeight": 0,
+                                      "ioWeight": 0, "remoteNiceLevel": 0, "remoteIoniceClass": "none",
+                                      "maxLoadPerCPU": 0, "maxIOPressure": 0})
+  ops.rsyncSeconds = 0
+  ops.commands = []
+
+  def _runCommand(cmdList, basicCMD=False, outputToStdout=False, timeout=None, onStart=None):
+    ops.commands.append((" ".join(cmdList), timeout))
+    return {"stdout": "", "stderr": "", "timedOut": timeout is not None and ops.rsyncSeconds > timeout}
+  monkeypatch.setattr(RemoteOperations, "runCommand", staticmethod(_runCommand))
+  return ops
+
+
+def test_rsync_not_started_after_the_deadline(rsyncOps):
+  rsyncOps.rsyncParallelStreams = 2
+  rsyncOps.performRsync(stopTime=time.time() - 1)
+  assert [(result["sourceDir"], result["stopped"]) for result in rsyncOps.rsyncResults] == \
+    [("/data0", True), ("/data1", True)]
+  assert rsyncOps.commands == []
+
+
+def test_rsync_keeps_partial_files_with_a_deadline(rsyncOps):
+  rsyncOps.performRsync(sourceDirs=["/data0"])
+  command, timeout = rsyncOps.commands[-1]
+  assert "--partial" not in command and timeout is None
+
+  rsyncOps.performRsync(sourceDirs=["/data0"], stopTime=time.time() + 60)
+  command, timeout = rsyncOps.commands[-1]
+  assert "--partial" in command and 0 < timeout <= 60
+  assert not rsyncOps.rsyncResults[0]["stopped"]
+
+  # already asked for, or not needed with --inplace
+  rsyncOps.performRsync(sourceDirs=["/data0"], extraArguments={"/data0": "--inplace"}, stopTime=time.time() + 60)
+  assert "--partial" not in rsyncOps.commands[-1][0]
+
+
+def test_rsync_stopped_at_the_deadline(rsyncOps):
+  rsyncOps.rsyncSeconds = 120
+  rsyncOps.performRsync(stopTime=time.time() + 60)
+  assert [result["stopped"] for result in rsyncOps.rsyncResults] == [True, True]
+
+
+def test_large_files_not_started_after_the_deadline(rsyncOps, tmp_path, monkeypatch):
+  rsyncOps.largeFileBytes = 1000
+  rsyncOps.largeFileStreams, rsyncOps.largeFileRangeBytes = 2, 4096
+  monkeypatch.setattr(rsyncOps, "_assembleSSHCommandList", lambda: ["bash", "-c"])
+  # the deadline passes while rsync runs
+  monkeypatch.setattr(remoteOperations.time, "time", lambda: 1000.0 if len(rsyncOps.commands) == 0 else 2000.0)
+
+  rsyncOps.performRsync(sourceDirs=["/data0"], stopTime=1500.0,
+                        largeFiles=lambda sourceDir: [(str(tmp_path / "disk.img"), 5000)])
+  assert "--max-size=999" in rsyncOps.commands[-1][0]
+  assert rsyncOps.rsyncResults[0]["stopped"]
+  assert rsyncOps.rsyncResults[0]["largeFiles"] == []
+
+
+FAKE_ZFS = """#!/bin/bash
+# stands in for zfs: logs each call, keeps the key status in a file
+echo "zfs $*" >> "$FAKE_ZFS_DIR/calls"
+case "$1" in
+  load-key)   cat > "$FAKE_ZFS_DIR/key"; echo available > "$FAKE_ZFS_DIR/keystatus" ;;
+  unload-key) echo unavailable > "$FAKE_ZFS_DIR/keystatus" ;;
+  get)        cat "$FAKE_ZFS_DIR/keystatus" ;;
+  list)       printf 'backup\\nbackup/docs\\nbackup/docs/old\\n' ;;
+  send)       if [ -e "$FAKE_ZFS_DIR/sendFails" ]; then echo "no such snapshot" >&2; exit 1; fi
+              printf 'stream: %s' "$*" ;;
+esac
+"""
+
+
+@pytest.fixture
+def fakeZFSOps(monkeypatch, tmp_path):
+  """
+  # RemoteOperations for a natively encrypted pool, running its "remote"
+  # commands in a local shell, with fake sudo and zfs commands
+  """
+  binDir = tmp_path / "bin"
+  binDir.mkdir()
+  (binDir / "zfs").write_text(FAKE_ZFS)
+  (binDir / "sudo").write_text('#!/bin/bash\nexec "$@"\n')
+  for name in ["zfs", "sudo"]:
+    (binDir / name).chmod(0o755)
+  (tmp_path / "keystatus").write_text("unavailable\n")
+  monkeypatch.setenv("PATH", f"{binDir}:{os.environ['PATH']}")
+  monkeypatch.setenv("FAKE_ZFS_DIR", str(tmp_path))
+
+  ops = RemoteOperations.__new__(RemoteOperations)
+  ops.zfsPoolName = "backup"
+  ops.zfsEncryptionRoot = "backup"
+  ops.zfsDatasetPerSource = False
+  ops.zfsKeyFile  = ""
+  ops.remoteState = RemoteState()
+  monkeypatch.setattr(ops, "_assembleRemoteCommandList", lambda command: ["bash", "-c", f"'{command}'"])
+  monkeypatch.setattr(ops, "_assembleSSHCommandList", lambda: ["bash", "-c"])
+  ops.calls = lambda: (tmp_path / "calls").read_text().splitlines()
+  return ops
+
+
+def test_zfsLoadKey_pipes_the_key_file(fakeZFSOps, tmp_path):
+  (tmp_path / "pool.key").write_bytes(b"secret passphrase\n")
+  fakeZFSOps.zfsKeyFile = str(tmp_path / "pool.key")
+  assert fakeZFSOps.zfsGetKeyStatus() == "unavailable"
+
+  assert fakeZFSOps.zfsLoadKey()
+  assert fakeZFSOps.zfsKeyLoaded
+  assert (tmp_path / "key").read_bytes() == b"secret passphrase\n"
+  assert fakeZFSOps.calls()[1:3] == ["zfs load-key -L prompt backup", "zfs mount -a"]
+
+
+def test_zfsLoadKey_uses_the_keylocation_without_a_key_file(fakeZFSOps, tmp_path):
+  assert fakeZFSOps.zfsLoadKey()
+  assert (tmp_path / "key").read_bytes() == b""
+  assert fakeZFSOps.calls()[0] == "zfs load-key -r backup"
+
+
+def test_zfsUnloadKey_unmounts_children_first(fakeZFSOps):
+  assert fakeZFSOps.zfsLoadKey()
+  assert fakeZFSOps.zfsUnloadKey()
+  assert not fakeZFSOps.zfsKeyLoaded
+  assert fakeZFSOps.calls()[-5:-1] == ["zfs unmount backup/docs/old", "zfs unmount backup/docs", "zfs unmount backup",
+                                       "zfs unload-key -r backup"]
+
+
+def test_zfsSendRaw(fakeZFSOps, tmp_path):
+  outputLoc = str(tmp_path / "backup.zstream")
+  assert fakeZFSOps.zfsSendRaw("backup@snap2", outputLoc, fromSnapshot="backup@snap1")
+  assert (tmp_path / "backup.zstream").read_text() == "stream: send -w -i backup@snap1 backup@snap2"
+
+  fakeZFSOps.zfsDatasetPerSource = True
+  assert fakeZFSOps.zfsSendRaw("backup@snap2", outputLoc)
+  assert (tmp_path / "backup.zstream").read_text() == "stream: send -w -R backup@snap2"
+
+  with pytest.raises(SystemError):
+    fakeZFSOps.zfsSendRaw("backup", outputLoc)
+
+
+def test_zfsSendRaw_failure_leaves_no_file(fakeZFSOps, tmp_path):
+  (tmp_path / "sendFails").write_text("")
+  assert not fakeZFSOps.zfsSendRaw("backup@snap2", str(tmp_path / "backup.zstream"))
+  assert not (tmp_path / "backup.zstream").exists()
+  assert not (tmp_path / "backup.zstream.tmp").exists()
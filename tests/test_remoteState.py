@@ -0,0 +1,94 @@
+
+import pytest
+
+from remoteState import RemoteState
+
+
+class _Fetcher:
+  """
+  # Stand-in for a remote command, counting its calls
+  """
+  def __init__(self, value):
+    self.value = value
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    return self.value
+
+
+def test_get_fetches_once():
+  state = RemoteState()
+  fetch = _Fetcher({"state": "ONLINE"})
+  assert state.get("poolStatus", "backup", fetch) == {"state": "ONLINE"}
+  assert state.get("poolStatus", "backup", fetch) == {"state": "ONLINE"}
+  assert fetch.calls == 1
+
+
+def test_get_keys_are_separate():
+  state = RemoteState()
+  first, second = _Fetcher(1), _Fetcher(2)
+  assert state.get("diskSpace", "/mnt/a", first) == 1
+  assert state.get("diskSpace", "/mnt/b", second) == 2
+  assert (first.calls, second.calls) == (1, 1)
+
+
+def test_get_fresh_fetches_again():
+  state = RemoteState()
+  fetch = _Fetcher("ONLINE")
+  state.get("poolStatus", "backup", fetch)
+  state.get("poolStatus", "backup", fetch, fresh=True)
+  assert fetch.calls == 2
+
+
+def test_get_returns_copies():
+  state = RemoteState()
+  fetch = _Fetcher(["snap1"])
+  state.get("snapshots", "backup/data", fetch).append("changed")
+  assert state.get("snapshots", "backup/data", fetch) == ["snap1"]
+
+
+def test_invalidate_only_drops_affected_kinds():
+  state = RemoteState()
+  fetches = {kind: _Fetcher(kind) for kind in RemoteState.KINDS}
+  for kind in RemoteState.KINDS:
+    state.get(kind, "key", fetches[kind])
+
+  state.invalidate("snapshot")
+  for kind in RemoteState.KINDS:
+    state.get(kind, "key", fetches[kind])
+    expectedCalls = 2 if kind in RemoteState.INVALIDATED_BY["snapshot"] else 1
+    assert fetches[kind].calls == expectedCalls, kind
+
+
+def test_transfer_invalidates_pool_status():
+  state = RemoteState()
+  fetch = _Fetcher("ONLINE")
+  state.get("poolStatus", "backup", fetch)
+  state.invalidate("transfer")
+  state.get("poolStatus", "backup", fetch)
+  assert fetch.calls == 2
+
+
+@pytest.mark.parametrize("operation", sorted(RemoteState.INVALIDATED_BY))
+def test_invalidated_kinds_are_known(operation):
+  assert set(RemoteState.INVALIDATED_BY[operation]) <= set(RemoteState.KINDS)
+
+
+def test_invalidate_unknown_operation():
+  with pytest.raises(KeyError):
+    RemoteState().invalidate("reboot")
+
+
+def test_getStats():
+  state = RemoteState()
+  fetch = _Fetcher("ONLINE")
+  state.get("poolStatus", "backup", fetch)
+  state.get("poolStatus", "backup", fetch)
+  state.get("poolStatus", "backup", fetch)
+  state.get("keyStatus", "backup", _Fetcher("available"))
+  stats = state.getStats()
+  assert (stats["hits"], stats["fetches"]) == (2, 2)
+  assert stats["kinds"]["poolStatus"] == {"hits": 2, "fetches": 1}
+  assert stats["kinds"]["keyStatus"] == {"hits": 0, "fetches": 1}
+  assert stats["kinds"]["diskSpace"] == {"hits": 0, "fetches": 0}
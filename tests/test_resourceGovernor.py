@@ -0,0 +1,132 @@
+import time
+import subprocess
+
+import pytest
+
+from resourceGovernor import ResourceGovernor
+
+
+OPTIONS = {"niceLevel": 0, "ioniceClass": "none", "cgroupSlice": "", "cpuWeight": 0, "ioWeight": 0,
+           "remoteNiceLevel": 0, "remoteIoniceClass": "none", "maxLoadPerCPU": 2.0, "maxIOPressure": 10.0}
+
+
+def _state(process) -> str:
+  # process state from /proc: "T" while stopped
+  with open(f"/proc/{process.pid}/stat", "r") as f:
+    return f.read().rsplit(")", 1)[1].split()[0]
+
+
+def _assertStates(processes, expected):
+  """
+  # Check the processes are stopped ("T") or running, allowing a few seconds
+  # for the signals to be delivered
+  """
+  deadline = time.time() + 5
+  while True:
+    states = ["T" if _state(process) in "Tt" else "running" for process in processes]
+    if states == expected or time.time() > deadline:
+      break
+    time.sleep(0.01)
+  assert states == expected
+
+
+@pytest.fixture
+def streams():
+  """
+  # Two stand-in transfer streams, each in its own session as runCommand starts them
+  """
+  processes = [subprocess.Popen(["sleep", "30"], start_new_session=True) for _ in range(2)]
+  yield processes
+  for process in processes:
+    process.kill()
+    process.wait()
+
+
+@pytest.fixture
+def pressure(monkeypatch):
+  """
+  # Load per CPU and I/O pressure the governor reads, set by the test
+  """
+  readings = {"load": 0.0, "io": 0.0}
+  monkeypatch.setattr(ResourceGovernor, "readLoadPerCPU", staticmethod(lambda: readings["load"]))
+  monkeypatch.setattr(ResourceGovernor, "readIOPressure", staticmethod(lambda: readings["io"]))
+  return readings
+
+
+def test_pauses_one_stream_per_check_and_resumes_in_reverse(streams, pressure):
+  governor = ResourceGovernor(OPTIONS)
+  for process in streams:
+    governor.register(process)
+
+  pressure["load"] = 3.0
+  governor._check()
+  _assertStates(streams, ["running", "T"])
+  assert not governor.clearToRun.is_set()
+  governor._check()
+  _assertStates(streams, ["T", "T"])
+  assert governor.pauseCount == 2
+
+  # under the limit, but not yet under the resume fraction of it: stay paused
+  pressure["load"] = 1.8
+  governor._check()
+  _assertStates(streams, ["T", "T"])
+
+  pressure["load"] = 1.0
+  governor._check()
+  _assertStates(streams, ["running", "T"])
+  assert not governor.clearToRun.is_set()
+  governor._check()
+  _assertStates(streams, ["running", "running"])
+  assert governor.clearToRun.is_set()
+
+
+def test_io_pressure_alone_pauses(streams, pressure):
+  governor = ResourceGovernor(OPTIONS)
+  governor.register(streams[0])
+  pressure["io"] = 25.0
+  governor._check()
+  _assertStates(streams[:1], ["T"])
+
+  # stop resumes whatever is still paused
+  governor.stop()
+  _assertStates(streams[:1], ["running"])
+  assert governor.clearToRun.is_set()
+
+
+def test_limits_of_zero_are_off(streams, pressure):
+  governor = ResourceGovernor(dict(OPTIONS, maxLoadPerCPU=0, maxIOPressure=0))
+  governor.register(streams[0])
+  pressure["load"], pressure["io"] = 100.0, 100.0
+  governor._check()
+  _assertStates(streams[:1], ["running"])
+
+
+def test_finished_streams_are_dropped(streams, pressure):
+  governor = ResourceGovernor(OPTIONS)
+  for process in streams:
+    governor.register(process)
+  streams[1].kill()
+  streams[1].wait()
+  pressure["load"] = 3.0
+  governor._check()
+  assert governor.processes == [streams[0]]
+  _assertStates(streams[:1], ["T"])
+
+
+def test_terminateAll_stops_paused_streams(streams, pressure):
+  governor = ResourceGovernor(OPTIONS)
+  governor.register(streams[0])
+  pressure["load"] = 3.0
+  governor._check()
+  governor.terminateAll()
+  assert streams[0].wait(5) < 0
+  assert governor.clearToRun.is_set()
+
+
+def test_priority_commands():
+  governor = ResourceGovernor(dict(OPTIONS, cgroupSlice="backup.slice", cpuWeight=20, remoteNiceLevel=10,
+                                   remoteIoniceClass="idle"))
+  assert governor.wrapCommand(["rsync"]) == ["systemd-run", "--user", "--scope", "--quiet", "--slice=backup.slice",
+                                             "-p", "CPUWeight=20", "rsync"]
+  assert governor.remoteRsyncPath() == "nice -n 10 ionice -c 3 rsync"
+  assert ResourceGovernor(OPTIONS).remoteRsyncPath() == ""
@@ -0,0 +1,56 @@
+
+import datetime
+
+from rsyncLogIndex import RsyncLogIndex
+
+
+LOG_LINES = [
+  "2022/08/08 01:07:27 [123] building file list\n",
+  "2022/08/08 01:07:28 [123] >f+++++++++ 1000 1000 data/new.txt\n",
+  "2022/08/08 01:07:28 [123] >f.st...... 5000 200 data/changed.txt\n",
+  "2022/08/08 01:07:29 [123] cL+++++++++ data/link -> new.txt\n",
+  "2022/08/08 01:07:29 [123] *deleting   data/old.txt\n"
+]
+
+
+def _writeLog(tmp_path, runName):
+  logFileLoc = tmp_path / f"{RsyncLogIndex.LOG_FILE_PREFIX}{runName}.log"
+  logFileLoc.write_text("".join(LOG_LINES))
+  return str(logFileLoc)
+
+
+def test_parseLogLine():
+  assert RsyncLogIndex.parseLogLine(LOG_LINES[0]) is None
+  assert RsyncLogIndex.parseLogLine(LOG_LINES[1]) == (">f+++++++++", 1000, 1000, "data/new.txt")
+  assert RsyncLogIndex.parseLogLine(LOG_LINES[3]) == ("cL+++++++++", None, None, "data/link")
+  assert RsyncLogIndex.parseLogLine(LOG_LINES[4]) == ("*deleting", None, None, "data/old.txt")
+
+
+def test_ingestLogFile(tmp_path):
+  logIndex = RsyncLogIndex(str(tmp_path / "state"))
+  logFileLoc = _writeLog(tmp_path, "2022-08-08--01-07-27")
+  assert logIndex.ingestLogFile(logFileLoc, retention="keep") == {"fileCount": 4, "totalBytes": 1200}
+  assert logIndex.ingestLogFile(logFileLoc, retention="keep") == {"fileCount": 0, "totalBytes": 0}
+  assert [change["path"] for change in logIndex.findChangesForRun("2022-08-08--01-07-27")] == \
+    ["data/changed.txt", "data/link", "data/new.txt", "data/old.txt"]
+  logIndex.close()
+
+
+def test_transfers_count_as_written(tmp_path):
+  logIndex = RsyncLogIndex(str(tmp_path / "state"))
+  logIndex.ingestLogFile(_writeLog(tmp_path, "2022-08-08--01-07-27"), runName="2022-08-08--01-07-27", retention="delete")
+  largeFiles = logIndex.ingestTransfers("2022-08-08--01-07-27", "largeFiles", [(">f.st......", 10 ** 9, 4000, "data/disk.img")],
+                                        sourceDir="/data")
+  chunkStore = logIndex.ingestTransfers("2022-08-09--01-00-00", "chunkStore",
+                                        [(">f.st......", 100, None, "data/a"), (">f.st......", 100, None, "data/b")],
+                                        totalBytes=150)
+  assert largeFiles == {"fileCount": 1, "totalBytes": 4000}
+  assert chunkStore == {"fileCount": 2, "totalBytes": 150}
+
+  assert logIndex.getBytesTransferredSince(datetime.datetime(2022, 8, 1)) == 1200 + 4000 + 150
+  assert logIndex.getBytesTransferredSince(datetime.datetime(2022, 8, 9)) == 150
+  assert [run["runName"] for run in logIndex.findRunsForPath("data/disk.img")] == ["2022-08-08--01-07-27"]
+
+  # already indexed
+  assert logIndex.ingestTransfers("2022-08-09--01-00-00", "chunkStore", [], totalBytes=150)["totalBytes"] == 0
+  logIndex.close()
@@ -0,0 +1,65 @@
+
+import datetime
+
+from scrubPolicy import ScrubPolicy
+from capacityHistory import CapacityHistory
+
+
+GB = 1024 ** 3
+
+
+def _scrubInfo(daysAgo=None, hours=2):
+  if daysAgo is None:
+    return {"inProgress": False, "completionTime": None, "duration": None}
+  return {"inProgress": False, "errors": 0, "duration": datetime.timedelta(hours=hours),
+          "completionTime": datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(days=daysAgo)}
+
+
+def test_first_scrub_runs_in_the_background(tmp_path):
+  decision = ScrubPolicy(str(tmp_path), 35, 0, 60).decide(_scrubInfo(), lambda sinceTime: 0, poolUsedBytes=100 * GB)
+  assert decision["scrub"]
+  assert decision["estimatedDuration"] is None
+  assert not decision["blocking"]
+
+
+def test_no_blocking_limit_always_waits(tmp_path):
+  decision = ScrubPolicy(str(tmp_path), 35, 0, 0).decide(_scrubInfo(), lambda sinceTime: 0, poolUsedBytes=100 * GB)
+  assert decision["scrub"] and decision["blocking"]
+
+
+def test_estimate_decides_blocking(tmp_path):
+  policy = ScrubPolicy(str(tmp_path), 35, 0, 60)
+  policy.recordCompletedScrub(_scrubInfo(daysAgo=40, hours=2), poolUsedBytes=100 * GB)
+
+  decision = policy.decide(_scrubInfo(daysAgo=40, hours=2), lambda sinceTime: 0, poolUsedBytes=10 * GB)
+  assert decision["scrub"] and decision["blocking"]
+  assert decision["estimatedDuration"] == datetime.timedelta(minutes=12)
+
+  decision = policy.decide(_scrubInfo(daysAgo=40, hours=2), lambda sinceTime: 0, poolUsedBytes=200 * GB)
+  assert decision["scrub"] and not decision["blocking"]
+
+
+def test_bytes_written_trigger(tmp_path):
+  policy = ScrubPolicy(str(tmp_path), 35, 50 * GB, 0)
+  assert not policy.decide(_scrubInfo(daysAgo=5), lambda sinceTime: 10 * GB)["scrub"]
+  assert policy.decide(_scrubInfo(daysAgo=5), lambda sinceTime: 60 * GB)["scrub"]
+  assert policy.decide(_scrubInfo(daysAgo=40), lambda sinceTime: 0)["scrub"]
+
+
+def test_completed_scrub_recorded_once(tmp_path):
+  policy = ScrubPolicy(str(tmp_path), 35, 0, 60)
+  scrubInfo = _scrubInfo(daysAgo=1, hours=1)
+  policy.recordCompletedScrub(scrubInfo, poolUsedBytes=36 * GB)
+  policy.recordCompletedScrub(scrubInfo, poolUsedBytes=36 * GB)
+  assert len(ScrubPolicy(str(tmp_path), 35, 0, 60).history) == 1
+  assert policy.getThroughput() == 36 * GB / 3600
+
+
+def test_usage_when_the_scrub_ran(tmp_path):
+  history = CapacityHistory(str(tmp_path))
+  with open(history.historyFile, "w") as f:
+    f.write('{"time": "2022-08-01T01:00:00", "usedBytes": 100, "availableBytes": 900, "totalBytes": 1000}\n')
+    f.write('{"time": "2022-08-08T01:00:00", "usedBytes": 300, "availableBytes": 700, "totalBytes": 1000}\n')
+  assert history.getUsedBytesAt(datetime.datetime(2022, 7, 1)) is None
+  assert history.getUsedBytesAt(datetime.datetime(2022, 8, 1, 2)) == 100
+  assert history.getUsedBytesAt(datetime.datetime(2022, 8, 9)) == 300
@@ -0,0 +1,103 @@
+
+import pytest
+
+from snapshotDiffCache import SnapshotDiffCache
+
+
+def _cache(tmp_path, *diffs):
+  """
+  # Cache holding successive diffs, snap1 -> snap2 -> ...
+  #
+  :param tmp_path:
+  :param diffs: (list) of lists of (change type, path, new path) per snapshot
+  :return:
+  """
+  cache = SnapshotDiffCache(str(tmp_path))
+  for i, diff in enumerate(diffs):
+    cache.storeDiff(f"pool/data@snap{i + 1}", f"pool/data@snap{i + 2}",
+                    (SnapshotDiffCache.formatDiffLine(*entry) for entry in diff))
+  return cache
+
+
+def test_parseDiffLine_unescapes_paths():
+  assert SnapshotDiffCache.parseDiffLine("M\t/data/a\\0040b\n") == ("M", "/data/a b", None)
+  assert SnapshotDiffCache.parseDiffLine("R\t/data/a\t/data/b") == ("R", "/data/a", "/data/b")
+  assert SnapshotDiffCache.parseDiffLine("X\t/data/a") is None
+  assert SnapshotDiffCache.parseDiffLine("garbage") is None
+
+
+def test_formatDiffLine_round_trip():
+  for entry in [("+", "/data/tab\there", None), ("R", "/data/back\\slash", "/data/new\nline")]:
+    assert SnapshotDiffCache.parseDiffLine(SnapshotDiffCache.formatDiffLine(*entry)) == entry
+
+
+def test_non_ascii_paths_decode_as_utf8():
+  # zfs escapes each byte of "é" on its own
+  assert SnapshotDiffCache.parseDiffLine("+\t/data/caf\\0303\\0251") == ("+", "/data/café", None)
+  assert SnapshotDiffCache.formatDiffLine("+", "/data/café") == "+\t/data/caf\\0303\\0251"
+  # bytes that aren't UTF-8 survive the round trip
+  for entry in [("M", "/data/日本語 ファイル", None), ("R", "/data/café", "/data/bad\udcff")]:
+    assert SnapshotDiffCache.parseDiffLine(SnapshotDiffCache.formatDiffLine(*entry)) == entry
+
+
+def test_getDiff_single_snapshot(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/b", None), ("-", "/data/a", None), ("M", "/data/c", None)])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap2") == \
+    [("-", "/data/a", None), ("+", "/data/b", None), ("M", "/data/c", None)]
+
+
+def test_getDiff_added_then_removed_disappears(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/a", None)], [("M", "/data/a", None)], [("-", "/data/a", None)])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap4") == []
+
+
+def test_getDiff_removed_then_added_is_modified(tmp_path):
+  cache = _cache(tmp_path, [("-", "/data/a", None)], [("+", "/data/a", None)])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap3") == [("M", "/data/a", None)]
+
+
+def test_getDiff_modified_then_removed(tmp_path):
+  cache = _cache(tmp_path, [("M", "/data/a", None)], [("-", "/data/a", None)])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap3") == [("-", "/data/a", None)]
+
+
+def test_getDiff_renames_compose(tmp_path):
+  cache = _cache(tmp_path, [("R", "/data/a", "/data/b")], [("M", "/data/b", None)], [("R", "/data/b", "/data/c")])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap4") == [("R", "/data/a", "/data/c")]
+
+
+def test_getDiff_added_then_renamed_is_added(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/a", None)], [("R", "/data/a", "/data/b")])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap3") == [("+", "/data/b", None)]
+
+
+def test_getDiff_renamed_then_removed_removes_original(tmp_path):
+  cache = _cache(tmp_path, [("R", "/data/a", "/data/b")], [("-", "/data/b", None)])
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap3") == [("-", "/data/a", None)]
+
+
+def test_getDiff_partial_range(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/a", None)], [("+", "/data/b", None)], [("M", "/data/a", None)])
+  assert cache.getDiff("pool/data@snap2", "pool/data@snap4") == [("M", "/data/a", None), ("+", "/data/b", None)]
+  assert cache.getDiff("pool/data@snap2", "pool/data@snap2") == []
+
+
+def test_getDiff_missing_chain(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/a", None)])
+  with pytest.raises(FileNotFoundError):
+    cache.getDiff("pool/data@snap1", "pool/data@snap9")
+
+
+def test_index_persists(tmp_path):
+  _cache(tmp_path, [("+", "/data/a", None)], [("+", "/data/b", None)])
+  cache = SnapshotDiffCache(str(tmp_path))
+  assert cache.getCachedSnapshots() == [("pool/data@snap1", "pool/data@snap2"), ("pool/data@snap2", "pool/data@snap3")]
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap3") == [("+", "/data/a", None), ("+", "/data/b", None)]
+
+
+def test_pruneDiffs_keeps_composed_diff(tmp_path):
+  cache = _cache(tmp_path, [("+", "/data/a", None)], [("R", "/data/a", "/data/b")], [("+", "/data/c", None)])
+  expected = cache.getDiff("pool/data@snap1", "pool/data@snap4")
+  cache.pruneDiffs(["pool/data@snap1", "pool/data@snap4"])
+  assert cache.getCachedSnapshots() == [("pool/data@snap1", "pool/data@snap4")]
+  assert cache.getDiff("pool/data@snap1", "pool/data@snap4") == expected
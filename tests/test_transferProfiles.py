@@ -0,0 +1,73 @@
+import os
+
+from transferProfiles import TransferProfiles
+
+
+def _scanInfo(tmp_path, files, largeFileBytes=0):
+  """
+  # Scan info for a directory holding <files>, all of them sampled
+  #
+  :param tmp_path:
+  :param files: (dict) file name -> content
+  :return:
+  """
+  suffixBytes = {}
+  for name, data in files.items():
+    with open(tmp_path / name, "wb") as f:
+      f.write(data)
+    suffix = os.path.splitext(name)[1][1:].lower()
+    suffixBytes[suffix] = suffixBytes.get(suffix, 0) + len(data)
+  return {"directory": str(tmp_path), "suffixBytes": suffixBytes, "sampleFiles": [str(tmp_path / name) for name in files],
+          "totalBytes": sum(suffixBytes.values()), "largeFileBytes": largeFileBytes}
+
+
+def test_compressible_files_use_the_fast_level(tmp_path):
+  scanInfo = _scanInfo(tmp_path, {"a.txt": b"hello world " * 5000, "b.log": b"line\n" * 10000})
+  profile = TransferProfiles(str(tmp_path / "state")).chooseProfile(scanInfo, autoProfile=True)
+  assert profile == {"compress": True, "compressLevel": 1, "skipCompress": []}
+
+
+def test_incompressible_files_turn_compression_off(tmp_path):
+  scanInfo = _scanInfo(tmp_path, {"a.jpg": os.urandom(50000), "b.zip": os.urandom(50000)})
+  profile = TransferProfiles(str(tmp_path / "state")).chooseProfile(scanInfo, autoProfile=True)
+  assert profile == {"compress": False}
+  assert TransferProfiles.profileToArguments(profile) == "--no-compress"
+
+
+def test_mixed_files_skip_the_incompressible_suffixes(tmp_path):
+  scanInfo = _scanInfo(tmp_path, {"a.txt": b"hello world " * 20000, "b.jpg": os.urandom(20000)})
+  profile = TransferProfiles(str(tmp_path / "state")).chooseProfile(scanInfo, autoProfile=True)
+  assert profile["compress"] and profile["skipCompress"] == ["jpg"]
+  assert TransferProfiles.profileToArguments(profile) == "--compress --compress-level=1 --skip-compress=jpg"
+
+
+def test_mostly_large_files_are_updated_in_place(tmp_path):
+  scanInfo = _scanInfo(tmp_path, {"disk.img": os.urandom(50000)}, largeFileBytes=50000)
+  assert TransferProfiles(str(tmp_path / "state")).chooseProfile(scanInfo, autoProfile=True)["inplace"] is True
+
+
+def test_config_settings_win(tmp_path):
+  scanInfo = _scanInfo(tmp_path, {"a.txt": b"hello world " * 5000})
+  transferProfiles = TransferProfiles(str(tmp_path / "state"))
+  assert transferProfiles.chooseProfile(scanInfo, {"compress": False}) == {"compress": False}
+  assert transferProfiles.chooseProfile(scanInfo, {"compress": "auto", "inplace": True}) == \
+    {"compress": True, "compressLevel": 1, "skipCompress": [], "inplace": True}
+
+
+def test_choice_is_cached_until_the_content_mix_changes(tmp_path, monkeypatch):
+  scanInfo = _scanInfo(tmp_path, {"a.txt": b"hello world " * 5000})
+  TransferProfiles(str(tmp_path / "state")).chooseProfile(scanInfo, autoProfile=True)
+
+  # a new instance reads the cache, and doesn't sample again for the same mix
+  samples = []
+  sampleCompressibility = TransferProfiles.sampleCompressibility
+  monkeypatch.setattr(TransferProfiles, "sampleCompressibility",
+                      staticmethod(lambda sampleFiles: samples.append(sampleFiles) or sampleCompressibility(sampleFiles)))
+  transferProfiles = TransferProfiles(str(tmp_path / "state"))
+  assert transferProfiles.chooseProfile(scanInfo, autoProfile=True)["compress"] is True
+  assert samples == []
+
+  # mostly incompressible files now
+  scanInfo = _scanInfo(tmp_path, {"a.txt": b"hello world " * 5000, "b.jpg": os.urandom(1000000)})
+  assert transferProfiles.chooseProfile(scanInfo, autoProfile=True)["compress"] is False
+  assert len(samples) == 1
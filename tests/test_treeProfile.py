@@ -0,0 +1,67 @@
+import os
+
+from treeProfile import TreeProfile
+
+
+def _makeTree(rootDir, files):
+  for relativePath, size in files.items():
+    fileLoc = os.path.join(rootDir, relativePath)
+    os.makedirs(os.path.dirname(fileLoc), exist_ok=True)
+    with open(fileLoc, "wb") as f:
+      f.write(b"x" * size)
+
+
+def test_scanTree_keeps_subtrees_and_candidates(tmp_path):
+  sourceDir = str(tmp_path / "src")
+  _makeTree(sourceDir, {"a/b/c/d/deep.txt": 100, "a/top.txt": 10, "web/node_modules/x/y.js": 20,
+                        "web/node_modules/z.js": 30})
+
+  profile = TreeProfile.scanTree([sourceDir], threads=2)
+  assert profile["sourceDirs"][sourceDir]["fileCount"] == 4
+  assert profile["sourceDirs"][sourceDir]["totalBytes"] == 160
+  # a file more than SUBTREE_DEPTH levels down counts towards the subtree at that depth
+  assert profile["subtrees"][os.path.join(sourceDir, "a", "b", "c")]["totalBytes"] == 100
+  assert profile["subtrees"][os.path.join(sourceDir, "a")]["totalBytes"] == 10
+  assert all(totals["sourceDir"] == sourceDir for totals in profile["subtrees"].values())
+  assert [(candidate["path"], candidate["fileCount"], candidate["totalBytes"]) for candidate in profile["candidates"]] == \
+    [(os.path.join(sourceDir, "web", "node_modules"), 2, 50)]
+
+  assert [path for path, _ in TreeProfile.topSubtrees(profile, "totalBytes", count=2)] == \
+    [os.path.join(sourceDir, "a", "b", "c"), os.path.join(sourceDir, "web", "node_modules")]
+
+
+def test_suggestExcludes(tmp_path, monkeypatch):
+  monkeypatch.setattr(TreeProfile, "TINY_FILES_MIN_COUNT", 5)
+  monkeypatch.setattr(TreeProfile, "TINY_FILES_MAX_AVERAGE_BYTES", 100)
+  sourceDir = str(tmp_path / "src")
+  files = {f"mail/cur/{i}": 50 for i in range(6)}
+  files.update({f"media/{i}.jpg": 1000 for i in range(6)})
+  files.update({"one/.cache/a": 10, "two/.cache/b": 20, "app/node_modules/c/d": 5})
+  _makeTree(sourceDir, files)
+
+  suggestions = TreeProfile.suggestExcludes(TreeProfile.scanTree([sourceDir]))
+  assert [(suggestion["pattern"], suggestion["fileCount"], suggestion["totalBytes"]) for suggestion in suggestions] == \
+    [("/src/mail/cur/", 6, 300), (".cache/", 2, 30), ("node_modules/", 1, 5)]
+
+
+def test_diffProfiles():
+  oldProfile = {"sourceDirs": {"/src": {"fileCount": 10, "totalBytes": 1000}},
+                "subtrees": {"/src/a": {"fileCount": 5, "totalBytes": 500}, "/src/b": {"fileCount": 5, "totalBytes": 500},
+                             "/src/gone": {"fileCount": 1, "totalBytes": 50}}}
+  newProfile = {"sourceDirs": {"/src": {"fileCount": 12, "totalBytes": 4000}},
+                "subtrees": {"/src/a": {"fileCount": 5, "totalBytes": 500}, "/src/b": {"fileCount": 6, "totalBytes": 3550},
+                             "/src/new": {"fileCount": 1, "totalBytes": 100}}}
+  diff = TreeProfile.diffProfiles(oldProfile, newProfile)
+  assert diff["sourceDirs"] == {"/src": {"fileCount": 2, "totalBytes": 3000}}
+  assert diff["subtrees"] == [("/src/b", {"fileCount": 1, "totalBytes": 3050}),
+                              ("/src/new", {"fileCount": 1, "totalBytes": 100}),
+                              ("/src/gone", {"fileCount": -1, "totalBytes": -50})]
+
+
+def test_saved_profiles_are_capped(tmp_path, monkeypatch):
+  monkeypatch.setattr(TreeProfile, "PROFILE_LIMIT", 2)
+  treeProfile = TreeProfile(str(tmp_path))
+  names = [treeProfile.saveProfile({"time": f"2022-08-0{day}T01:00:00", "sourceDirs": {}, "subtrees": {}})
+           for day in range(1, 4)]
+  assert treeProfile.getProfileNames() == names[1:]
+  assert treeProfile.loadProfile(names[-1])["time"] == "2022-08-03T01:00:00"